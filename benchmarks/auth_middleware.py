@@ -0,0 +1,125 @@
+import io
+import os
+import sys
+import time
+import tarfile
+import argparse
+import http.client
+import statistics
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
+from zstandard import ZstdCompressor
+
+from common import API_KEY, LocalServer, report
+
+
+def legacy_app():
+    # The BaseHTTPMiddleware version of authorize_api_key, swapped in for the pure ASGI middleware
+    from fastapi import Request
+    from fastapi.responses import JSONResponse
+    from starlette.middleware.base import BaseHTTPMiddleware
+    from deploykit_server.app import app, get_settings
+    from deploykit_server.auth import APIKeyMiddleware
+
+    async def authorize_api_key(request: Request, call_next):
+        request.state.started_at = time.perf_counter()
+        if request.url.path == "/health":
+            return await call_next(request)
+        authorization = request.headers.get("Authorization")
+        if not authorization:
+            return JSONResponse(status_code=401,
+                                content={"detail": "Unauthorized: Missing 'Authorization' header"})
+        if not authorization.startswith("APIKey "):
+            return JSONResponse(status_code=401,
+                                content={"detail": "Unauthorized: Malformed 'Authorization' header, should start with 'APIKey '"})
+        api_key = authorization[len("APIKey "):].strip()
+        if api_key != get_settings().api_key:
+            return JSONResponse(status_code=401,
+                                content={"detail": "Unauthorized: Invalid API key"})
+        response = await call_next(request)
+        return response
+
+    app.user_middleware = [x for x in app.user_middleware if x.cls is not APIKeyMiddleware]
+    app.add_middleware(BaseHTTPMiddleware, dispatch=authorize_api_key)
+    return app
+
+
+def archive_bytes(size: int) -> bytes:
+    # Incompressible content, so the request body is as large as the site
+    with io.BytesIO() as buffer:
+        with tarfile.open(fileobj=buffer, mode="w") as tar:
+            info = tarfile.TarInfo("public/blob.bin")
+            info.size = size
+            tar.addfile(info, io.BytesIO(os.urandom(size)))
+        return ZstdCompressor(level=1).compress(buffer.getvalue())
+
+
+def latencies(url: str, requests: int) -> list:
+    target = urlparse(url)
+    connection = http.client.HTTPConnection(target.hostname, target.port)
+    headers = {"Authorization": f"APIKey {API_KEY}"}
+    results = []
+    for _ in range(requests):
+        started_at = time.perf_counter()
+        connection.request("GET", "/stats", headers=headers)
+        connection.getresponse().read()
+        results.append(time.perf_counter() - started_at)
+    connection.close()
+    return results
+
+
+def upload(url: str, body: bytes) -> float:
+    target = urlparse(url)
+    boundary = "deploykit-benchmark"
+    payload = (f"--{boundary}\r\nContent-Disposition: form-data; name=\"upload\"; filename=\"site.tar.zst\"\r\n"
+               f"Content-Type: application/zstd\r\n\r\n").encode() + body + f"\r\n--{boundary}--\r\n".encode()
+    connection = http.client.HTTPConnection(target.hostname, target.port)
+    started_at = time.perf_counter()
+    connection.request("POST", "/projects/benchmark/deployments", body=payload,
+                       headers={"Authorization": f"APIKey {API_KEY}",
+                                "Content-Type": f"multipart/form-data; boundary={boundary}"})
+    response = connection.getresponse()
+    response.read()
+    elapsed = time.perf_counter() - started_at
+    connection.close()
+    if response.status != 200:
+        raise RuntimeError(f"Upload failed with status {response.status}")
+    return elapsed
+
+
+def measure(server: LocalServer, args: argparse.Namespace, body: bytes) -> dict:
+    latencies(server.url, 100)
+    serial = latencies(server.url, args.requests)
+    started_at = time.perf_counter()
+    with ThreadPoolExecutor(args.clients) as executor:
+        concurrent = sum(executor.map(lambda _: latencies(server.url, args.requests // args.clients),
+                                      range(args.clients)), [])
+    concurrent_seconds = time.perf_counter() - started_at
+    uploads = [upload(server.url, body) for _ in range(args.uploads)]
+    quantiles = statistics.quantiles(serial, n=100)
+    return {"latency_p50_ms": quantiles[49] * 1000, "latency_p99_ms": quantiles[98] * 1000,
+            "concurrent_requests_per_second": len(concurrent) / concurrent_seconds,
+            "upload_mb_per_second": len(body) / statistics.median(uploads) / 1024 / 1024}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Request latency and upload throughput of the API key middleware")
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--uploads", type=int, default=5)
+    parser.add_argument("--upload-size", type=int, default=64, help="Upload size in MiB")
+    args = parser.parse_args()
+
+    body = archive_bytes(args.upload_size * 1024 * 1024)
+    results = {"upload_size": len(body)}
+    # No fsync, so the uploads measure the request path rather than the disk
+    env = {"DURABILITY": "none"}
+    for name, server in [("base_http_middleware", LocalServer(env=env, app="auth_middleware:legacy_app", factory=True)),
+                         ("asgi_middleware", LocalServer(env=env))]:
+        with server:
+            results[name] = measure(server, args, body)
+    report("auth_middleware", results)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,116 @@
+import os
+import sys
+import json
+import time
+import random
+import socket
+import tempfile
+import subprocess
+import urllib.request
+from typing import Optional
+
+
+BENCHMARKS_PATH = os.path.dirname(os.path.abspath(__file__))
+SRC_PATH = os.path.join(os.path.dirname(BENCHMARKS_PATH), "src")
+API_KEY = "benchmark-api-key"
+
+
+def generate_small_files(path: str, count: int = 2000, seed: int = 0) -> None:
+    # Small HTML/JSON/CSS files sharing most of their structure, like a static site build
+    rng = random.Random(seed)
+    words = ["deploy", "static", "site", "page", "asset", "content", "header", "footer", "index", "article"]
+    for i in range(count):
+        directory = os.path.join(path, f"section-{i % 20}")
+        os.makedirs(directory, exist_ok=True)
+        text = " ".join(rng.choice(words) for _ in range(rng.randint(50, 400)))
+        kind = i % 3
+        if kind == 0:
+            content = f"<!DOCTYPE html><html><head><title>Page {i}</title></head><body><p>{text}</p></body></html>"
+            name = f"page-{i}.html"
+        elif kind == 1:
+            content = json.dumps({"id": i, "title": f"Article {i}", "tags": text.split()[:8], "body": text})
+            name = f"data-{i}.json"
+        else:
+            content = "".join(f".{w}-{i} {{ margin: {rng.randint(0, 9)}px; color: #{rng.randint(0, 0xffffff):06x}; }}\n"
+                              for w in text.split()[:20])
+            name = f"style-{i}.css"
+        with open(os.path.join(directory, name), "w") as f:
+            f.write(content)
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class LocalServer:
+    def __init__(self, app_path: Optional[str] = None, workers: int = 1, env: Optional[dict] = None,
+                 app: str = "deploykit_server.app:app", factory: bool = False):
+        self.app = app
+        self.factory = factory
+        self.app_path = app_path or tempfile.mkdtemp(prefix="deploykit-benchmark-")
+        self.port = free_port()
+        self.workers = workers
+        self.env = env or {}
+        self.process = None
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+    def __enter__(self) -> "LocalServer":
+        env = {**os.environ, "API_KEY": API_KEY, "APP_PATH": self.app_path,
+               "PYTHONPATH": os.pathsep.join([SRC_PATH, BENCHMARKS_PATH]), **self.env}
+        self.process = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", self.app, "--port", str(self.port), "--workers", str(self.workers),
+             "--log-level", "warning", *(["--factory"] if self.factory else [])], env=env)
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline:
+            try:
+                urllib.request.urlopen(f"{self.url}/health", timeout=1)
+                return self
+            except OSError:
+                time.sleep(0.1)
+        raise RuntimeError("Server did not become healthy")
+
+    def __exit__(self, *_) -> None:
+        self.process.terminate()
+        self.process.wait()
+
+
+def deployctl(server: LocalServer, project: str, *args: str, cwd: Optional[str] = None) -> float:
+    env = {**os.environ, "API_KEY": API_KEY, "API_URL": server.url, "PROJECT": project, "PYTHONPATH": SRC_PATH}
+    started_at = time.perf_counter()
+    subprocess.run([sys.executable, "-c", "import sys; from deploykit_client import main; sys.exit(main())", *args],
+                   env=env, cwd=cwd, check=True, stdout=subprocess.DEVNULL)
+    return time.perf_counter() - started_at
+
+
+def measure_deployctl(server: LocalServer, project: str, *args: str, cwd: Optional[str] = None) -> dict:
+    # Same as deployctl, but keeps the output and the peak RSS of the client process
+    env = {**os.environ, "API_KEY": API_KEY, "API_URL": server.url, "PROJECT": project, "PYTHONPATH": SRC_PATH}
+    started_at = time.perf_counter()
+    process = subprocess.Popen([sys.executable, "-c", "import sys; from deploykit_client import main; sys.exit(main())",
+                                *args], env=env, cwd=cwd, stdout=subprocess.PIPE, text=True)
+    output = process.stdout.read()
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, args, output)
+    return {"seconds": time.perf_counter() - started_at, "output": output, "peak_rss": usage.ru_maxrss * 1024}
+
+
+def peak_rss(pid: int) -> Optional[int]:
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except FileNotFoundError:
+        pass
+    return None
+
+
+def report(name: str, results: dict) -> None:
+    print(json.dumps({"benchmark": name, "python": sys.version.split()[0], "results": results}, indent=2))
@@ -0,0 +1,185 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import statistics
+import subprocess
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+from common import API_KEY, SRC_PATH, LocalServer, measure_deployctl, peak_rss, report
+
+sys.path.insert(0, SRC_PATH)
+from deploykit_server import __version__
+from deploykit_client import pipeline
+
+
+MB = 1024 * 1024
+# Server stages that are not spent extracting, the upload itself is timed by the client
+NOT_EXTRACTION = {"receive", "symlink"}
+
+
+def write(path: str, content: bytes) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(content)
+
+
+def generate_tiny(path: str, scale: float, rng: random.Random) -> None:
+    # Many files of a few hundred bytes, the per-member cost dominates
+    for i in range(int(20000 * scale)):
+        write(os.path.join(path, f"dir-{i % 200}", f"file-{i}.txt"), f"{i} ".encode() * rng.randint(20, 150))
+
+
+def generate_huge(path: str, scale: float, rng: random.Random) -> None:
+    # Half random, half repeated, so the files neither compress away nor stay incompressible
+    size = int(32 * MB * scale)
+    for i in range(3):
+        block = rng.randbytes(MB // 2) + f"block {i} ".encode() * (MB // 16)
+        write(os.path.join(path, f"blob-{i}.bin"), (block * (size // len(block) + 1))[:size])
+
+
+def generate_deep(path: str, scale: float, rng: random.Random) -> None:
+    # Long chains of nested directories with a few files at every level
+    for branch in range(int(50 * scale) or 1):
+        directory = path
+        for depth in range(40):
+            directory = os.path.join(directory, f"level-{depth}")
+            write(os.path.join(directory, f"branch-{branch}.html"), rng.randbytes(64).hex().encode())
+
+
+def generate_duplicates(path: str, scale: float, rng: random.Random) -> None:
+    # Thousands of files sharing a handful of contents, like vendored assets copied into every page
+    contents = [rng.randbytes(rng.randint(1024, 16 * 1024)) for _ in range(20)]
+    for i in range(int(10000 * scale)):
+        write(os.path.join(path, f"page-{i % 100}", f"asset-{i}.js"), contents[i % len(contents)])
+
+
+SHAPES = {
+    "tiny": generate_tiny,
+    "huge": generate_huge,
+    "deep": generate_deep,
+    "duplicates": generate_duplicates,
+}
+
+
+def compress_only(site: str, level: int, threads: int) -> dict:
+    stream = pipeline.CompressedStream([[site, "public"]], level=level, threads=threads)
+    for _ in stream:
+        pass
+    return {"seconds": stream.elapsed, "tar_size": stream.tar_size, "zstd_size": stream.zstd_size,
+            "mb_per_second": stream.tar_size / MB / max(stream.elapsed, 1e-9),
+            "ratio": stream.zstd_size / max(stream.tar_size, 1)}
+
+
+def upload(workdir: str, level: int, threads: int) -> dict:
+    with LocalServer() as server:
+        # The client only uploads paths relative to its working directory
+        result = measure_deployctl(server, "benchmark", "deploy", "upload", "-f", "site", "public", "--no-cache",
+                                   "--level", str(level), "--threads", str(threads), "--json", cwd=workdir)
+        server_peak_rss = peak_rss(server.process.pid)
+        shutil.rmtree(server.app_path, ignore_errors=True)
+    # With '--json' and without '--switch', the server's response is the last line the client prints
+    response = json.loads(result["output"].splitlines()[-1])
+    timings = response["timings"]
+    extraction = sum(seconds for stage, seconds in timings.items() if stage not in NOT_EXTRACTION)
+    return {
+        "client_seconds": result["seconds"],
+        "upload_size": response["upload_size"],
+        "upload_mb_per_second": response["upload_size"] / MB / result["seconds"],
+        "site_mb_per_second": response["extracted_size"] / MB / result["seconds"],
+        "client_peak_rss": result["peak_rss"],
+        "server_peak_rss": server_peak_rss,
+        "files": response["files"],
+        "extraction_seconds": extraction,
+        "extraction_files_per_second": response["files"] / max(extraction, 1e-9),
+        "extraction_mb_per_second": response["extracted_size"] / MB / max(extraction, 1e-9),
+        "server_timings": timings,
+    }
+
+
+def seed_deployments(app_path: str, project: str, count: int) -> None:
+    # Empty deployment directories are enough, the server indexes them when it starts
+    deployments_path = os.path.join(app_path, project, "deployments")
+    os.makedirs(deployments_path)
+    started_at = int(time.time()) - count
+    for i in range(count):
+        timestamp = time.strftime("%Y%m%d-%H%M%S", time.gmtime(started_at + i))
+        os.mkdir(os.path.join(deployments_path, f"{timestamp}-{i % 65536:04x}-{i:012x}"))
+
+
+def get(server: LocalServer, path: str) -> dict:
+    request = urllib.request.Request(f"{server.url}/{path}", headers={"Authorization": f"APIKey {API_KEY}"})
+    with urllib.request.urlopen(request) as response:
+        return json.loads(response.read())
+
+
+def list_latency(count: int, requests: int, concurrency: int) -> dict:
+    app_path = tempfile.mkdtemp(prefix="deploykit-benchmark-")
+    seed_deployments(app_path, "benchmark", count)
+    with LocalServer(app_path) as server:
+        get(server, "projects/benchmark/deployments?limit=100")
+
+        def timed_get(_) -> float:
+            started_at = time.perf_counter()
+            get(server, "projects/benchmark/deployments?limit=100")
+            return time.perf_counter() - started_at
+
+        started_at = time.perf_counter()
+        with ThreadPoolExecutor(concurrency) as executor:
+            latencies = list(executor.map(timed_get, range(requests)))
+        elapsed = time.perf_counter() - started_at
+        # Walking every page is what 'deploy list' users and retention scripts do on large projects
+        started_at, cursor, pages = time.perf_counter(), None, 0
+        while True:
+            page = get(server, "projects/benchmark/deployments?limit=500" + (f"&after={cursor}" if cursor else ""))
+            pages += 1
+            if not (cursor := page["next"]):
+                break
+        walk = time.perf_counter() - started_at
+    shutil.rmtree(app_path, ignore_errors=True)
+    latencies.sort()
+    return {"p50_ms": statistics.median(latencies) * 1000, "p95_ms": latencies[int(len(latencies) * 0.95)] * 1000,
+            "requests_per_second": requests / elapsed, "all_pages_ms": walk * 1000, "pages": pages}
+
+
+def revision() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=SRC_PATH, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Compression, upload, extraction and listing through a local server")
+    parser.add_argument("--shapes", default=",".join(SHAPES), help=f"Site shapes to run, default: {','.join(SHAPES)}")
+    parser.add_argument("--scale", type=float, default=1.0, help="Multiply the number and size of generated files")
+    parser.add_argument("--level", type=int, default=3)
+    parser.add_argument("--threads", type=int, default=-1)
+    parser.add_argument("--deployments", default="10,1000,10000", help="Deployment counts for the list latency")
+    parser.add_argument("--requests", type=int, default=200, help="List requests per deployment count")
+    parser.add_argument("--concurrency", type=int, default=8, help="List requests in flight at once")
+    args = parser.parse_args()
+
+    results = {"version": __version__, "revision": revision(), "level": args.level, "scale": args.scale,
+               "shapes": {}, "list_latency": {}}
+    for name in args.shapes.split(","):
+        workdir = tempfile.mkdtemp(prefix=f"deploykit-{name}-")
+        site = os.path.join(workdir, "site")
+        SHAPES[name](site, args.scale, random.Random(0))
+        results["shapes"][name] = {"compression": compress_only(site, args.level, args.threads),
+                                   "upload": upload(workdir, args.level, args.threads)}
+        shutil.rmtree(workdir, ignore_errors=True)
+    for count in [int(x) for x in args.deployments.split(",")]:
+        results["list_latency"][count] = list_latency(count, args.requests, args.concurrency)
+    report("deploy_pipeline", results)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,66 @@
+import os
+import io
+import sys
+import time
+import tarfile
+import argparse
+import tempfile
+from zstandard import ZstdCompressor, train_dictionary
+
+from common import LocalServer, deployctl, generate_small_files, report
+
+
+def tar_bytes(path: str) -> bytes:
+    with io.BytesIO() as buffer:
+        with tarfile.open(fileobj=buffer, mode="w") as tar:
+            tar.add(path, arcname="public")
+        return buffer.getvalue()
+
+
+def file_contents(path: str) -> list[bytes]:
+    contents = []
+    for root, _, filenames in os.walk(path):
+        for filename in sorted(filenames):
+            with open(os.path.join(root, filename), "rb") as f:
+                contents.append(f.read())
+    return contents
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Compression ratio and upload time with and without a trained dictionary")
+    parser.add_argument("--path", help="Site directory to benchmark, a synthetic small-file site is generated if omitted")
+    parser.add_argument("--files", type=int, default=2000, help="Files in the synthetic site")
+    parser.add_argument("--level", type=int, default=19)
+    parser.add_argument("--dict-size", type=int, default=112640)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="deploykit-dictionary-")
+    site = args.path or os.path.join(workdir, "dist")
+    if not args.path:
+        generate_small_files(site, args.files)
+    data, contents = tar_bytes(site), file_contents(site)
+    dictionary = train_dictionary(args.dict_size, contents)
+
+    results = {"files": len(contents), "tar_size": len(data)}
+    for name, compressor in [("without_dictionary", ZstdCompressor(level=args.level)),
+                             ("with_dictionary", ZstdCompressor(level=args.level, dict_data=dictionary))]:
+        started_at = time.perf_counter()
+        whole = len(compressor.compress(data))
+        elapsed = time.perf_counter() - started_at
+        per_file = sum(len(compressor.compress(x)) for x in contents)
+        results[name] = {"tar_ratio": len(data) / whole, "per_file_ratio": sum(map(len, contents)) / per_file,
+                         "compress_seconds": elapsed}
+
+    with LocalServer() as server:
+        # deployctl only accepts relative paths
+        os.chdir(os.path.dirname(os.path.abspath(site)))
+        upload = ["deploy", "upload", "-f", os.path.basename(site), "public", "--level", str(args.level)]
+        deployctl(server, "benchmark", *upload, "--switch")
+        deployctl(server, "benchmark", "dictionary", "train", "-s", str(args.dict_size // 1024))
+        results["without_dictionary"]["upload_seconds"] = deployctl(server, "benchmark", *upload)
+        results["with_dictionary"]["upload_seconds"] = deployctl(server, "benchmark", *upload, "--dictionary")
+    report("dictionary", results)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
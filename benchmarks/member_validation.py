@@ -0,0 +1,127 @@
+import io
+import os
+import sys
+import time
+import tarfile
+import argparse
+import tracemalloc
+from typing import Optional, Sequence
+
+from common import SRC_PATH, report
+
+sys.path.insert(0, SRC_PATH)
+from deploykit_server.archive import ArchiveLimits, MemberValidator, safe_filter
+
+
+def legacy_is_path_safe(path: str, linkname: Optional[str] = None) -> bool:
+    if (linkname is not None) and (not legacy_is_path_safe(linkname)):
+        return False
+    if os.path.isabs(path):
+        return False
+    for char in ["/", "..", os.sep]:
+        if path.startswith(char):
+            return False
+    return True
+
+
+def legacy_safe_member(member: tarfile.TarInfo, destnation: str) -> Optional[tarfile.TarInfo]:
+    # The filter before the streaming validator, kept here for comparison
+    if member.ischr() or member.isblk() or member.isfifo() or member.isdev():
+        return None
+    if not legacy_is_path_safe(member.name, getattr(member, "linkname", None)):
+        return None
+    if member.issym() or member.islnk():
+        link_abspath = os.path.abspath(os.path.join(destnation, member.linkname))
+        dest_abspath = os.path.abspath(destnation)
+        if not link_abspath.startswith(dest_abspath):
+            return None
+    if member.isdir() or member.issym():
+        member.mode = 0o755
+    else:
+        member.mode = 0o644
+    member.gid = member.uid = member.uname = member.gname = None
+    return member
+
+
+def legacy_safe_filter(members: Sequence[tarfile.TarInfo], destnation: str) -> Sequence[tarfile.TarInfo]:
+    result = []
+    for member in members:
+        member = legacy_safe_member(member, destnation)
+        if member is not None:
+            result.append(member)
+    return result
+
+
+def generate_members(count: int) -> list[tarfile.TarInfo]:
+    # A site tree: files spread over nested directories, with a directory entry and a symlink now and then
+    members = []
+    for i in range(count):
+        directory = f"site/section-{i % 50}/part-{i % 7}/group-{i % 13}"
+        if i % 20 == 0:
+            member = tarfile.TarInfo(f"{directory}/alias-{i}")
+            member.type, member.linkname = tarfile.SYMTYPE, f"page-{i - 1}.html"
+        elif i % 10 == 0:
+            member = tarfile.TarInfo(f"{directory}/dir-{i}")
+            member.type = tarfile.DIRTYPE
+        else:
+            member = tarfile.TarInfo(f"{directory}/page-{i}.html")
+            member.size = 512
+        members.append(member)
+    return members
+
+
+def tar_bytes(members: list[tarfile.TarInfo]) -> bytes:
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w") as tar:
+        for member in members:
+            tar.addfile(member, io.BytesIO(b"x" * member.size) if member.isfile() else None)
+    return buffer.getvalue()
+
+
+def timed(func, *args) -> dict:
+    started_at = time.perf_counter()
+    accepted = func(*args)
+    elapsed = time.perf_counter() - started_at
+    # Memory is measured in a second run, tracing would distort the timing
+    tracemalloc.start()
+    func(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"seconds": elapsed, "peak_memory": peak, "accepted": accepted}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Member validation before and after the streaming validator")
+    parser.add_argument("--members", type=int, default=200000)
+    args = parser.parse_args()
+
+    destnation = "/srv/deploykit/project/deployments/.staging-benchmark"
+    # Filtering alone, on members already in memory
+    legacy = timed(lambda members: len(legacy_safe_filter(members, destnation)), generate_members(args.members))
+    validator = timed(lambda members: sum(1 for _ in safe_filter(members, ArchiveLimits())),
+                      generate_members(args.members))
+
+    # Reading an archive: the list filter needs getmembers(), the validator checks each member as it is read
+    data = tar_bytes(generate_members(args.members))
+
+    def read_all_then_filter() -> int:
+        with tarfile.open(fileobj=io.BytesIO(data), mode="r:") as tar:
+            return len(legacy_safe_filter(tar.getmembers(), destnation))
+
+    def read_streaming() -> int:
+        validator, accepted = MemberValidator(ArchiveLimits()), 0
+        with tarfile.open(fileobj=io.BytesIO(data), mode="r|") as tar:
+            while (member := tar.next()) is not None:
+                accepted += validator.validate(member) is not None
+                tar.members.clear()
+        return accepted
+
+    report("member_validation", {"members": args.members,
+                                 "filter": {"legacy": legacy, "validator": validator,
+                                            "speedup": legacy["seconds"] / validator["seconds"]},
+                                 "archive": {"getmembers_then_filter": timed(read_all_then_filter),
+                                             "streaming_validator": timed(read_streaming)}})
+
+
+if __name__ == "__main__":
+    sys.exit(main())
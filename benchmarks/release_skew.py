@@ -0,0 +1,65 @@
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import statistics
+import urllib.request
+
+from common import API_KEY, LocalServer, deployctl, report
+
+
+def call(server: LocalServer, method: str, path: str, body: dict = None) -> dict:
+    request = urllib.request.Request(f"{server.url}/{path}", method=method,
+                                     data=json.dumps(body).encode() if body is not None else None,
+                                     headers={"Authorization": f"APIKey {API_KEY}", "Content-Type": "application/json"})
+    with urllib.request.urlopen(request) as response:
+        return json.loads(response.read())
+
+
+def summary(skews: list) -> dict:
+    return {"p50_ms": statistics.median(skews) * 1000, "max_ms": max(skews) * 1000}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Skew between projects switched one by one and in a release")
+    parser.add_argument("--projects", type=int, default=3)
+    parser.add_argument("--rounds", type=int, default=200)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="deploykit-release-")
+    os.makedirs(os.path.join(workdir, "dist"))
+    with open(os.path.join(workdir, "dist", "index.html"), "w") as f:
+        f.write("<!DOCTYPE html><html><body>benchmark</body></html>")
+    os.chdir(workdir)
+
+    with LocalServer() as server:
+        projects = [f"project-{i}" for i in range(args.projects)]
+        deployments = {}
+        for project in projects:
+            for _ in range(2):
+                deployctl(server, project, "deploy", "upload", "-f", "dist", "public", "--no-cache")
+            deployments[project] = sorted(os.listdir(os.path.join(server.app_path, project, "deployments")))
+
+        # One PATCH per project, skew is the time from the first project switched to the last one
+        sequential = []
+        for round_number in range(args.rounds):
+            switched_at = []
+            for project in projects:
+                deployment_id = deployments[project][round_number % 2]
+                call(server, "PATCH", f"projects/{project}/current?deployment_id={deployment_id}")
+                switched_at.append(time.perf_counter())
+            sequential.append(switched_at[-1] - switched_at[0])
+
+        released = []
+        for round_number in range(args.rounds):
+            body = {"deployments": [{"name": project, "deployment_id": deployments[project][round_number % 2]}
+                                    for project in projects]}
+            released.append(call(server, "POST", "releases", body)["skew"])
+    report("release_skew", {"projects": args.projects, "rounds": args.rounds,
+                            "switch_one_by_one": summary(sequential), "release": summary(released)})
+
+
+if __name__ == "__main__":
+    sys.exit(main())
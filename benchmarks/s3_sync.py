@@ -0,0 +1,67 @@
+import os
+import sys
+import time
+import logging
+import argparse
+import tempfile
+import boto3.session
+from botocore.config import Config
+from boto3.s3.transfer import TransferConfig
+
+from common import SRC_PATH, free_port, generate_small_files, report
+
+sys.path.insert(0, SRC_PATH)
+from deploykit_client import s3sync
+
+
+def sequential_upload(session: boto3.session.Session, endpoint: str, bucket: str, files: dict) -> float:
+    # The per-file loop deployctl s3 used before the sync
+    s3 = session.resource(service_name="s3", endpoint_url=endpoint)
+    started_at = time.perf_counter()
+    for key, path in files.items():
+        s3.Bucket(bucket).upload_file(path, key, Config=TransferConfig(
+            multipart_threshold=1024 * 25, max_concurrency=8, use_threads=True))
+    return time.perf_counter() - started_at
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Sequential upload versus parallel sync to S3-compatible storage")
+    parser.add_argument("--endpoint", help="S3-compatible endpoint, a local moto server is started if omitted")
+    parser.add_argument("--access-key", default="benchmark")
+    parser.add_argument("--secret-key", default="benchmark")
+    parser.add_argument("--files", type=int, default=2000, help="Files in the synthetic site")
+    parser.add_argument("--concurrency", type=int, default=16)
+    args = parser.parse_args()
+
+    server, endpoint = None, args.endpoint
+    if endpoint is None:
+        from moto.server import ThreadedMotoServer
+        logging.getLogger("werkzeug").setLevel(logging.ERROR)
+        port = free_port()
+        server = ThreadedMotoServer(port=port, verbose=False)
+        server.start()
+        endpoint = f"http://127.0.0.1:{port}"
+
+    site = os.path.join(tempfile.mkdtemp(prefix="deploykit-s3-"), "dist")
+    generate_small_files(site, args.files)
+    os.chdir(os.path.dirname(site))
+    session = boto3.session.Session(args.access_key, args.secret_key, region_name="us-east-1")
+    client = session.client("s3", endpoint_url=endpoint, config=Config(max_pool_connections=args.concurrency))
+    for bucket in ["sequential", "sync"]:
+        client.create_bucket(Bucket=f"benchmark-{bucket}")
+
+    files = s3sync.local_files(["dist"], "site")
+    results = {"files": len(files), "size": sum(os.path.getsize(x) for x in files.values()),
+               "sequential_seconds": sequential_upload(session, endpoint, "benchmark-sequential", files)}
+    sync = s3sync.S3Sync(client, "benchmark-sync", "site", concurrency=args.concurrency)
+    for name in ["cold_sync", "warm_sync"]:
+        result, _ = sync.run(files)
+        results[name] = {"seconds": result.elapsed, "transferred_objects": result.transferred_objects,
+                         "skipped_objects": result.skipped_objects, "throughput": result.throughput}
+    if server is not None:
+        server.stop()
+    report("s3_sync", results)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,58 @@
+import sys
+import argparse
+import statistics
+import subprocess
+
+from common import SRC_PATH, report
+
+
+# Import time budgets in milliseconds, '--version' and '--help' must not import any subcommand module
+SCENARIOS = {
+    "--version": 25,
+    "--help": 25,
+    "deploy --help": 250,
+    "commit --help": 250,
+    "release --help": 250,
+    "s3 --help": 350,
+}
+# Imported by the interpreter before deployctl runs
+INTERPRETER_MODULES = {"site", "encodings", "_frozen_importlib_external", "zipimport", "codecs", "io", "abc"}
+
+
+def import_times(command: str) -> dict:
+    # -X importtime prints "self | cumulative | name" in microseconds, nested imports are indented
+    code = f"import sys; from deploykit_client import main; sys.argv = ['deployctl', *{command.split()!r}]; main()"
+    process = subprocess.run([sys.executable, "-X", "importtime", "-c", code], capture_output=True, text=True,
+                             env={"PYTHONPATH": SRC_PATH, "PROJECT": "benchmark", "API_KEY": "benchmark"})
+    modules = {}
+    for line in process.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if not name.startswith("  ") and name.strip() not in INTERPRETER_MODULES:
+            modules[name.strip()] = int(cumulative) / 1000
+    return modules
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Import time of deployctl commands against a startup budget")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--budget-scale", type=float, default=1.0, help="Multiply every budget, for slower machines")
+    args = parser.parse_args()
+
+    results, over_budget = {}, []
+    for command, budget in SCENARIOS.items():
+        runs = [import_times(command) for _ in range(args.runs)]
+        totals = [sum(modules.values()) for modules in runs]
+        slowest = sorted(runs[-1].items(), key=lambda x: x[1], reverse=True)[:5]
+        results[command] = {"import_ms": statistics.median(totals), "budget_ms": budget * args.budget_scale,
+                            "slowest_imports_ms": dict(slowest)}
+        if statistics.median(totals) > budget * args.budget_scale:
+            over_budget.append(command)
+    results["over_budget"] = over_budget
+    report("startup", results)
+    return 1 if over_budget else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
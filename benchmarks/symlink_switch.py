@@ -0,0 +1,90 @@
+import os
+import sys
+import time
+import argparse
+import tempfile
+import multiprocessing
+import urllib.request
+
+from common import API_KEY, LocalServer, deployctl, report
+
+
+def read_current(path: str, stopping, results) -> None:
+    # Readers are separate processes, like the workers of the web server in front of DeployKit
+    reads, failures = 0, 0
+    while not stopping.is_set():
+        try:
+            with open(path, "rb") as f:
+                f.read()
+        except OSError:
+            failures += 1
+        reads += 1
+    results.put((reads, failures))
+
+
+def hammer(path: str, readers: int, switch) -> dict:
+    stopping, results = multiprocessing.Event(), multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=read_current, args=(path, stopping, results)) for _ in range(readers)]
+    for process in processes:
+        process.start()
+    time.sleep(1)
+    started_at = time.perf_counter()
+    counters = {"switches": switch(), "seconds": time.perf_counter() - started_at, "reads": 0, "failures": 0}
+    stopping.set()
+    for _ in processes:
+        reads, failures = results.get()
+        counters["reads"] += reads
+        counters["failures"] += failures
+    for process in processes:
+        process.join()
+    return counters
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Failed reads through 'current' while it is switched repeatedly")
+    parser.add_argument("--seconds", type=float, default=10, help="Duration of each run")
+    parser.add_argument("--readers", type=int, default=4)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="deploykit-switch-")
+    site = os.path.join(workdir, "dist")
+    os.makedirs(site)
+    with open(os.path.join(site, "index.html"), "w") as f:
+        f.write("<!DOCTYPE html><html><body>benchmark</body></html>")
+    os.chdir(workdir)
+
+    with LocalServer() as server:
+        for _ in range(2):
+            deployctl(server, "benchmark", "deploy", "upload", "-f", "dist", "public")
+        project_path = os.path.join(server.app_path, "benchmark")
+        deployments = sorted(os.listdir(os.path.join(project_path, "deployments")))
+        current = os.path.join(project_path, "current")
+        index = os.path.join(current, "public", "index.html")
+        os.symlink(f"deployments/{deployments[0]}/", current)
+
+        def unlink_and_symlink():
+            # What PATCH /current did before, reproduced directly on the filesystem
+            switches, deadline = 0, time.monotonic() + args.seconds
+            while time.monotonic() < deadline:
+                os.unlink(current)
+                os.symlink(f"deployments/{deployments[switches % 2]}/", current)
+                switches += 1
+            return switches
+
+        def switch_through_api():
+            switches, deadline = 0, time.monotonic() + args.seconds
+            while time.monotonic() < deadline:
+                request = urllib.request.Request(
+                    f"{server.url}/projects/benchmark/current?deployment_id={deployments[switches % 2]}",
+                    method="PATCH", headers={"Authorization": f"APIKey {API_KEY}"})
+                urllib.request.urlopen(request).read()
+                switches += 1
+            return switches
+
+        results = {"unlink_and_symlink": hammer(index, args.readers, unlink_and_symlink),
+                   "atomic_replace": hammer(index, args.readers, switch_through_api)}
+    report("symlink_switch", results)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,51 @@
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import statistics
+from concurrent.futures import ThreadPoolExecutor
+
+from common import LocalServer, deployctl, generate_small_files, report
+
+
+def run(workdir: str, workers: int, uploads: int, concurrency: int, max_global_extractions: int) -> dict:
+    env = {"MAX_GLOBAL_EXTRACTIONS": str(max_global_extractions), "DURABILITY": "none"}
+    with LocalServer(workers=workers, env=env) as server:
+        # Uploads go to different projects, so they are only limited by the extraction pools and not by project locks
+        def upload(i: int) -> float:
+            return deployctl(server, f"benchmark-{i % concurrency}", "deploy", "upload", "-f", "site", "public",
+                             "--no-cache", cwd=workdir)
+
+        started_at = time.perf_counter()
+        with ThreadPoolExecutor(concurrency) as executor:
+            latencies = sorted(executor.map(upload, range(uploads)))
+        elapsed = time.perf_counter() - started_at
+        shutil.rmtree(server.app_path, ignore_errors=True)
+    return {"uploads_per_second": uploads / elapsed, "seconds": elapsed,
+            "p50_seconds": statistics.median(latencies), "p95_seconds": latencies[int(len(latencies) * 0.95)]}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Concurrent upload throughput for several server worker counts")
+    parser.add_argument("--workers", default="1,2,4", help="Worker process counts to run, default: 1,2,4")
+    parser.add_argument("--uploads", type=int, default=24)
+    parser.add_argument("--concurrency", type=int, default=8, help="Uploads in flight at once")
+    parser.add_argument("--files", type=int, default=2000, help="Files in the uploaded site")
+    parser.add_argument("--max-global-extractions", type=int, default=0)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="deploykit-workers-")
+    generate_small_files(os.path.join(workdir, "site"), args.files)
+    results = {"uploads": args.uploads, "concurrency": args.concurrency, "files": args.files,
+               "max_global_extractions": args.max_global_extractions, "cpu_count": os.cpu_count(), "workers": {}}
+    for workers in [int(x) for x in args.workers.split(",")]:
+        results["workers"][workers] = run(workdir, workers, args.uploads, args.concurrency,
+                                          args.max_global_extractions)
+    shutil.rmtree(workdir, ignore_errors=True)
+    report("workers", results)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
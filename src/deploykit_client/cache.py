@@ -0,0 +1,110 @@
+import os
+import time
+import sqlite3
+import threading
+from typing import Optional
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    inode INTEGER NOT NULL,
+    hash TEXT NOT NULL
+);
+"""
+# A file modified this recently may be modified again within the same mtime tick, so its hash is not kept
+RACY_SECONDS = 2
+
+
+def default_path() -> str:
+    return os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "deploykit")
+
+
+class ScanCache:
+    # File hashes keyed by path, size, mtime and inode, and compressed frames keyed by content and compression options
+    def __init__(self, path: str):
+        self.path = path
+        self.frames_path = os.path.join(self.path, "frames")
+        os.makedirs(self.frames_path, exist_ok=True)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(os.path.join(self.path, "files.sqlite3"), timeout=30,
+                                          isolation_level=None, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.executescript(SCHEMA)
+        self.hash_lookups = 0
+        self.hash_hits = 0
+        self.frame_lookups = 0
+        self.frame_hits = 0
+        self.reused_size = 0
+
+    def lookup_hash(self, path: str, file_stat: os.stat_result) -> Optional[str]:
+        with self.lock:
+            self.hash_lookups += 1
+            row = self.connection.execute(
+                "SELECT hash FROM files WHERE path = ? AND size = ? AND mtime_ns = ? AND inode = ?",
+                (path, file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ino)).fetchone()
+            if row is not None:
+                self.hash_hits += 1
+            return row[0] if row else None
+
+    def store_hashes(self, records: list) -> None:
+        now = time.time_ns()
+        rows = [(path, file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ino, digest)
+                for path, file_stat, digest in records
+                if now - file_stat.st_mtime_ns > RACY_SECONDS * 1_000_000_000]
+        with self.lock:
+            self.connection.execute("BEGIN")
+            self.connection.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)", rows)
+            self.connection.execute("COMMIT")
+
+    def frame(self, key: str) -> str:
+        return os.path.join(self.frames_path, key[:2], f"{key}.zst")
+
+    def lookup_frame(self, key: str, size: int) -> Optional[str]:
+        path = self.frame(key)
+        with self.lock:
+            self.frame_lookups += 1
+        try:
+            # Touching the frame keeps it out of the next prune
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        with self.lock:
+            self.frame_hits += 1
+            self.reused_size += size
+        return path
+
+    def new_frame(self, key: str) -> str:
+        os.makedirs(os.path.dirname(self.frame(key)), exist_ok=True)
+        return os.path.join(self.frames_path, f".{key}.{os.getpid()}.{threading.get_ident()}.tmp")
+
+    def prune(self, max_size: int) -> int:
+        frames = []
+        for root, _, filenames in os.walk(self.frames_path):
+            for filename in filenames:
+                path = os.path.join(root, filename)
+                try:
+                    file_stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                frames.append((file_stat.st_mtime, file_stat.st_size, path))
+        total, removed = sum(x[1] for x in frames), 0
+        for _, size, path in sorted(frames):
+            if total <= max_size:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed += 1
+        return removed
+
+    def stats(self) -> dict:
+        return {"hash_lookups": self.hash_lookups, "hash_hits": self.hash_hits,
+                "frame_lookups": self.frame_lookups, "frame_hits": self.frame_hits, "reused_size": self.reused_size}
+
+    def close(self) -> None:
+        self.connection.close()
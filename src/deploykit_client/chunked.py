@@ -0,0 +1,93 @@
+import time
+from typing import Iterable, Iterator, Optional
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from deploykit_client import display
+from deploykit_client.scanner import new_hash
+from deploykit_client.session import Session, SessionError
+from deploykit_client.display import UNDERLINE, NORMAL
+
+
+def rechunk(stream: Iterable[bytes], size: int) -> Iterator[bytes]:
+    buffer = bytearray()
+    for piece in stream:
+        buffer += piece
+        while len(buffer) >= size:
+            yield bytes(buffer[:size])
+            del buffer[:size]
+    if buffer:
+        yield bytes(buffer)
+
+
+class ChunkedUpload:
+    def __init__(self, session: Session, project: str, parallel: int = 4, retries: int = 3):
+        self.session = session
+        self.project = project
+        self.parallel = parallel
+        self.retries = retries
+        self.upload_id = None
+        self.chunk_size = None
+        self.received = {}
+        self.sent_chunks = 0
+        self.skipped_chunks = 0
+
+    def create(self, commit: Optional[str], chunk_size: Optional[int], dictionary_id: Optional[int] = None,
+               sidecars: bool = False, level: Optional[int] = None, long_distance: bool = False) -> None:
+        params = {"commit_hash": commit, "chunk_size": chunk_size, "dictionary_id": dictionary_id,
+                  "sidecars": "true" if sidecars else None, "level": level,
+                  "long_distance": "true" if long_distance else None}
+        params = {k: v for k, v in params.items() if v}
+        response = self.session.request("POST", f"projects/{self.project}/uploads", params=params)
+        self.upload_id, self.chunk_size = response["upload_id"], response["chunk_size"]
+
+    def resume(self, upload_id: str) -> dict:
+        # Returns the session, whose compression settings the resumed upload has to reuse
+        response = self.session.request("GET", f"projects/{self.project}/uploads/{upload_id}")
+        self.upload_id, self.chunk_size = response["upload_id"], response["chunk_size"]
+        self.received = {x["index"]: x["checksum"] for x in response["chunks"]}
+        return response
+
+    def put(self, index: int, data: bytes) -> bool:
+        hasher = new_hash()
+        hasher.update(data)
+        checksum = hasher.hexdigest()
+        if self.received.get(index) == checksum:
+            return False
+        for attempt in range(self.retries):
+            try:
+                self.session.request("PUT", f"projects/{self.project}/uploads/{self.upload_id}/chunks/{index}",
+                                     params={"checksum": checksum}, data=data)
+                return True
+            except SessionError:
+                if attempt == self.retries - 1:
+                    raise
+                time.sleep(2 ** attempt)
+
+    def upload(self, stream: Iterable[bytes]) -> int:
+        display.message(f"Upload session {UNDERLINE}{self.upload_id}{NORMAL}, "
+                        f"resume with '--resume {self.upload_id}' if interrupted")
+        count, pending = 0, set()
+        with ThreadPoolExecutor(max_workers=self.parallel) as executor:
+            for index, data in enumerate(rechunk(stream, self.chunk_size)):
+                # Bound the chunks held in memory to what the workers can send next
+                if len(pending) >= self.parallel * 2:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        self.count(future.result())
+                pending.add(executor.submit(self.put, index, data))
+                count += 1
+            for future in pending:
+                self.count(future.result())
+        return count
+
+    def count(self, sent: bool) -> None:
+        # Only called from the thread running upload(), the pool threads just report what they did
+        if sent:
+            self.sent_chunks += 1
+        else:
+            self.skipped_chunks += 1
+
+    def finalize(self, count: int, checksum: Optional[str] = None) -> dict:
+        params = {"chunks": count, "checksum": checksum} if checksum else {"chunks": count}
+        return self.session.request("POST", f"projects/{self.project}/uploads/{self.upload_id}/finalize",
+                                    params=params)
@@ -9,5 +9,12 @@ class Settings(BaseSettings):
     s3_access_key: str = ""
     s3_secret_key: str = ""
     s3_endpoint: str = ""
+    cache_path: str = ""
+    timeout: float = 300
+    connect_timeout: float = 10
+    retries: int = 3
+    retry_backoff: float = 0.5
+    concurrency: int = 4
+    cache_size: int = 1024
 
 settings = Settings()
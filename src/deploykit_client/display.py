@@ -1,4 +1,5 @@
 import sys
+import json
 from typing import Any, Optional, Literal
 
 RED       = "\033[01;91m"
@@ -39,6 +40,9 @@ def table(headers: list[str], data: list[dict[str, Any]]):
     for record in data:
         print("  ".join(str(record.get(header, "")).ljust(widths[header]) for header in headers))
 
+def json_line(record: Any):
+    print(json.dumps(record, ensure_ascii=False), flush=True)
+
 def tar_progress(operation: Literal["skip", "add"], path: str):
     if operation == "skip":
         prefix = YELLOW + "[SKIP] "
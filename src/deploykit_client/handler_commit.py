@@ -1,28 +1,34 @@
 import argparse
+from typing import Optional
 from pytz import timezone
 from datetime import datetime
 
 from deploykit_client import display
 from deploykit_client.config import settings
-from deploykit_client.session import Session, SessionError
-from deploykit_client.display import UNDERLINE, NORMAL
+from deploykit_client.session import Session, SessionError, read_batch
+from deploykit_client.display import UNDERLINE, NORMAL, YELLOW
 
 __modname__ = "commit"
 session = Session()
 
 
-def register_parser(subparser: argparse.ArgumentParser) -> None:
-    parser = subparser.add_parser(__modname__, help="Actions related to commits")
+def register_parser(parser: argparse.ArgumentParser) -> None:
     action_parser = parser.add_subparsers(dest="action", required=True)
-    action_parser.add_parser("list", help="List commits")
+    list_action = action_parser.add_parser("list", help="List commits")
+    list_action.add_argument("-n", "--limit", type=int, help="Number of commits per page, default: MAX_DEPLOYMENTS of the server")
+    list_action.add_argument("--after", metavar="<cursor>", help="Continue from the cursor printed by the previous page")
 
     delete_action = action_parser.add_parser("delete", help="Delete a commit and related deployment")
-    delete_action.add_argument("commit_hash", metavar="<commit-sha1>", help="Commit hash to delete")
+    delete_action.add_argument("commit_hash", metavar="<commit-sha1>", nargs="?", help="Commit hash to delete")
     delete_action.add_argument("-y", "--yes", action="store_true", help="Skip confirmation prompt")
+    delete_action.add_argument("--batch", action="store_true", help="Read commit hashes from stdin, one per line, requires '--yes'")
 
-def list_commits() -> int:
+def list_commits(limit: Optional[int], after: Optional[str]) -> int:
+    params = {"limit": limit, "after": after}
     try:
-        commits = session.request("GET", f"projects/{settings.project}/commits")["commits"]
+        response = session.request("GET", f"projects/{settings.project}/commits",
+                                   params={k: v for k, v in params.items() if v})
+        commits = response["commits"]
     except SessionError:
         display.error("Could not list commits")
         return 1
@@ -32,6 +38,8 @@ def list_commits() -> int:
             timezone(settings.timezone)
         ).isoformat()
     display.table(["commit_hash", "deployment_id", "created_at"], commits)
+    if response["next"]:
+        display.message(f"More commits available, continue with '--after {response['next']}'")
     return 0
 
 def delete_commit(commit_hash: str, confirmed: bool) -> int:
@@ -48,9 +56,29 @@ def delete_commit(commit_hash: str, confirmed: bool) -> int:
     display.error(str(response), prefix="Deleted")
     return 0
 
+def delete_commits(confirmed: bool) -> int:
+    if not confirmed:
+        display.error("Commit hashes are read from stdin in batch mode, confirm with '--yes'")
+        return 2
+    commit_hashes = [fields[0] for fields in read_batch()]
+    responses, failed = session.batch("POST", f"projects/{settings.project}/commits/delete",
+                                      "commit_hashes", commit_hashes)
+    deleted = [x for response in responses for x in response["deleted"]]
+    not_found = [x for response in responses for x in response["not_found"]]
+    for commit_hash in not_found:
+        display.warning(f"Commit {YELLOW}{commit_hash}{NORMAL} not found")
+    display.error(f"{len(deleted)} commits and their deployments deleted, {len(not_found)} not found, "
+                  f"{len(failed)} failed", prefix="Deleted")
+    return 1 if failed else 0
+
 def main(args: argparse.Namespace) -> int:
     if args.action == "list":
-        return list_commits()
+        return list_commits(limit=args.limit, after=args.after)
     if args.action == "delete":
+        if args.batch:
+            return delete_commits(confirmed=args.yes)
+        if not args.commit_hash:
+            display.error("A commit hash or '--batch' is required")
+            return 1
         return delete_commit(commit_hash=args.commit_hash, confirmed=args.yes)
     return 1
@@ -1,42 +1,73 @@
-import io
 import os
-import tarfile
+import json
+import base64
 import argparse
 from pytz import timezone
-from typing import Optional
+from typing import Iterator, Optional, Tuple
 from datetime import datetime
-from zstandard import ZstdCompressor
+from zstandard import ZstdCompressionDict
 
-from deploykit_client import display
+from deploykit_client import cache, chunked, display, pipeline, scanner
 from deploykit_client.config import settings
-from deploykit_client.session import Session, SessionError
-from deploykit_client.display import UNDERLINE, NORMAL, YELLOW, GREEN
+from deploykit_client.session import Session, SessionError, multipart_body, read_batch
+from deploykit_client.display import UNDERLINE, NORMAL, RED, YELLOW, GREEN
 
 
 __modname__ = "deploy"
 session = Session()
 
 
-def register_parser(subparser: argparse.ArgumentParser) -> None:
-    parser = subparser.add_parser(__modname__, help="Actions related to deployments")
+def register_parser(parser: argparse.ArgumentParser) -> None:
     action_parser = parser.add_subparsers(dest="action", required=True)
-    action_parser.add_parser("list", help="List deployments")
+    list_action = action_parser.add_parser("list", help="List deployments")
+    list_action.add_argument("-n", "--limit", type=int, help="Number of deployments per page, default: MAX_DEPLOYMENTS of the server")
+    list_action.add_argument("--after", metavar="<cursor>", help="Continue from the cursor printed by the previous page")
 
     delete_action = action_parser.add_parser("delete", help="Delete a deployment")
-    delete_action.add_argument("deployment_id", metavar="<deployment-id>", help="Deployment ID to delete")
+    delete_action.add_argument("deployment_id", metavar="<deployment-id>", nargs="?", help="Deployment ID to delete")
     delete_action.add_argument("-y", "--yes", action="store_true", help="Skip confirmation prompt")
+    delete_action.add_argument("--batch", action="store_true", help="Read deployment IDs from stdin, one per line, requires '--yes'")
 
     upload_action = action_parser.add_parser("upload", help="Upload a deployment")
     upload_action.add_argument("-c", "--commit", metavar="<commit-hash>", help="Commit hash to deploy")
     upload_action.add_argument("-f", "--file", nargs=2, metavar="<file> <arcname>", action="append", required=True, help="Directory or file to be uploaded")
     upload_action.add_argument("--switch", action="store_true", help="Switch 'current' to this deployment")
+    upload_action.add_argument("--delta", action="store_true", help="Only upload files whose content is missing on the server")
+    upload_action.add_argument("--level", metavar="<level>", default="19", choices=["auto"] + [str(x) for x in range(1, 23)], help="Zstandard compression level (1-22) or 'auto', default: 19")
+    upload_action.add_argument("--threads", metavar="<threads>", type=int, default=-1, help="Compression threads, -1 for one per CPU core, default: -1")
+    upload_action.add_argument("--long", action="store_true", help="Enable long-distance matching")
+    upload_action.add_argument("--bandwidth", metavar="<MB/s>", type=float, default=10.0, help="Expected upload bandwidth used by '--level auto', default: 10")
+    upload_action.add_argument("--dictionary", action="store_true", help="Compress with the project's trained dictionary")
+    upload_action.add_argument("--sidecars", action="store_true", help="Let the server generate precompressed .gz/.br/.zst files")
+    upload_action.add_argument("--chunked", action="store_true", help="Upload in resumable chunks")
+    upload_action.add_argument("--chunk-size", metavar="<MB>", type=int, help="Chunk size for '--chunked', default: decided by server")
+    upload_action.add_argument("--parallel", metavar="<n>", type=int, default=4, help="Chunks uploaded in parallel, default: 4")
+    upload_action.add_argument("--resume", metavar="<upload-id>", help="Resume an interrupted chunked upload")
+    upload_action.add_argument("--no-cache", action="store_true", help="Do not reuse file hashes and compressed files from earlier uploads")
+    upload_action.add_argument("--json", action="store_true", help="Print the server's response as one JSON line instead of a summary")
+
+    diff_action = action_parser.add_parser("diff", help="Show the files that differ between two deployments")
+    diff_action.add_argument("deployment_id", metavar="<deployment-id>", help="Deployment ID to compare from")
+    diff_action.add_argument("other_deployment_id", metavar="<other-deployment-id>", nargs="?", help="Deployment ID to compare to, default: current")
+    diff_action.add_argument("--json", action="store_true", help="Print the server's NDJSON lines as they are")
+
+    promote_action = action_parser.add_parser("promote", help="Copy a deployment of another project on the server, without uploading")
+    promote_action.add_argument("--from-project", metavar="<project>", required=True, help="Project to copy the deployment from")
+    promote_source = promote_action.add_mutually_exclusive_group(required=True)
+    promote_source.add_argument("-c", "--commit", metavar="<commit-hash>", help="Commit hash to promote")
+    promote_source.add_argument("-d", "--deployment", metavar="<deployment-id>", help="Deployment ID to promote")
+    promote_action.add_argument("--switch", action="store_true", help="Switch 'current' to the new deployment")
 
     switch_action = action_parser.add_parser("switch", help="Switch 'current' to a deployment")
-    switch_action.add_argument("deployment_id", metavar="<deployment-id>", help="Deployment ID to switch to")
+    switch_action.add_argument("deployment_id", metavar="<deployment-id>", nargs="?", help="Deployment ID to switch to")
+    switch_action.add_argument("--batch", action="store_true", help="Read '[<project>] <deployment-id>' lines from stdin and switch every project")
 
-def list_deployments() -> int:
+def list_deployments(limit: Optional[int], after: Optional[str]) -> int:
+    params = {"limit": limit, "after": after}
     try:
-        deployments = session.request("GET", f"projects/{settings.project}/deployments")["deployments"]
+        response = session.request("GET", f"projects/{settings.project}/deployments",
+                                   params={k: v for k, v in params.items() if v})
+        deployments = response["deployments"]
     except SessionError:
         display.error("Could not list deployments")
         return 1
@@ -46,6 +77,8 @@ def list_deployments() -> int:
             timezone(settings.timezone)
         ).isoformat()
     display.table(["deployment_id", "created_at"], deployments)
+    if response["next"]:
+        display.message(f"More deployments available, continue with '--after {response['next']}'")
     return 0
 
 def delete_deployment(deployment_id: str, confirmed: bool) -> int:
@@ -63,37 +96,257 @@ def delete_deployment(deployment_id: str, confirmed: bool) -> int:
     display.error(str(response), prefix="Deleted")
     return 0
 
-def upload_deployment(files: list[list[str]], commit: Optional[str], switch: bool) -> int:
+def delete_deployments(confirmed: bool) -> int:
+    if not confirmed:
+        display.error("IDs are read from stdin in batch mode, confirm with '--yes'")
+        return 2
+    deployment_ids = [fields[0] for fields in read_batch()]
+    responses, failed = session.batch("POST", f"projects/{settings.project}/deployments/delete",
+                                      "deployment_ids", deployment_ids)
+    deleted = [x for response in responses for x in response["deleted"]]
+    not_found = [x for response in responses for x in response["not_found"]]
+    for deployment_id in not_found:
+        display.warning(f"Deployment {YELLOW}{deployment_id}{NORMAL} not found")
+    display.error(f"{len(deleted)} deployments deleted, {len(not_found)} not found, {len(failed)} failed",
+                  prefix="Deleted")
+    return 1 if failed else 0
+
+def describe_change(before: dict, after: dict) -> str:
+    if before["type"] != after["type"]:
+        return f"{before['type']} -> {after['type']}"
+    changes = []
+    if before.get("hash") != after.get("hash"):
+        changes.append(f"{before.get('size')} -> {after.get('size')} bytes" if before.get("size") != after.get("size")
+                       else "content")
+    if before.get("linkname") != after.get("linkname"):
+        changes.append(f"-> {after.get('linkname')}")
+    if before.get("mode") != after.get("mode"):
+        changes.append(f"mode {before.get('mode'):o} -> {after.get('mode'):o}")
+    return ", ".join(changes)
+
+def diff_deployments(deployment_id: str, other_deployment_id: Optional[str], raw: bool) -> int:
+    try:
+        if other_deployment_id is None:
+            other_deployment_id = session.request("GET", f"projects/{settings.project}/deployments",
+                                                  params={"limit": 1})["current"]
+            if other_deployment_id is None:
+                display.error("Project has no current deployment, give a second deployment ID")
+                return 1
+        summary = None
+        # Lines are printed as they arrive, the whole diff is never held in memory
+        for entry in session.stream(f"projects/{settings.project}/deployments/{deployment_id}/diff/{other_deployment_id}"):
+            if raw:
+                display.json_line(entry)
+            elif "summary" in entry:
+                summary = entry["summary"]
+            elif entry["change"] == "added":
+                display.message(f"{GREEN}+{NORMAL} {entry['path']}")
+            elif entry["change"] == "removed":
+                display.message(f"{RED}-{NORMAL} {entry['path']}")
+            else:
+                display.message(f"{YELLOW}~{NORMAL} {entry['path']}  ({describe_change(entry['before'], entry['after'])})")
+    except SessionError:
+        display.error(f"Could not diff deployments {YELLOW}{deployment_id}{NORMAL} and {YELLOW}{other_deployment_id}{NORMAL}")
+        return 1
+    if summary is not None:
+        display.success(f"{summary['added']} added, {summary['removed']} removed, {summary['modified']} modified, "
+                        f"{summary['unchanged']} unchanged", prefix=f"{deployment_id} -> {other_deployment_id}")
+    return 0
+
+def included_files(files: list[list[str]]) -> list[list[str]]:
+    included = []
+    for file, arcname in files:
+        if file.startswith("..") or os.path.isabs(file):
+            display.tar_progress("skip", file)
+            continue
+        display.tar_progress("add", file)
+        included.append([file, arcname])
+    return included
+
+def negotiate_delta(files: list[list[str]], params: dict, scan_cache: Optional[cache.ScanCache],
+                    threads: int) -> Tuple[list[list[str]], dict]:
+    display.message(f"Scanning files...")
+    entries = scanner.scan(files, scan_cache, threads)
+    manifest = [entry for _, entry in entries]
+    response = session.request("POST", f"projects/{settings.project}/deployments/negotiate", json={"files": manifest})
+    missing, members = set(response["missing"]), {}
+    for path, entry in entries:
+        if entry.get("hash") in missing and entry["hash"] not in members:
+            members[entry["hash"]] = [path, entry["hash"]]
+    total = sum(1 for entry in manifest if entry["type"] == "file")
+    display.success(f"{len(members)} of {total} files need to be uploaded, "
+                    f"base deployment {UNDERLINE}{response['base_deployment_id']}{NORMAL}", prefix="Negotiated")
+    if response["base_deployment_id"]:
+        params["base_deployment_id"] = response["base_deployment_id"]
+    return list(members.values()), {"files": manifest}
+
+def fetch_dictionary() -> Tuple[Optional[int], Optional[ZstdCompressionDict]]:
+    try:
+        response = session.request("GET", f"projects/{settings.project}/dictionary")
+    except SessionError:
+        display.warning("No dictionary available, uploading without dictionary")
+        return None, None
+    display.success(f"Using dictionary {UNDERLINE}{response['dictionary_id']}{NORMAL}", prefix="Dictionary")
+    return response["dictionary_id"], ZstdCompressionDict(base64.b64decode(response["content"]))
+
+def resume_chunked(upload: chunked.ChunkedUpload, options: argparse.Namespace) -> dict:
+    # Chunks are only skipped when they come out byte for byte as before, so the compression settings of the
+    # session replace the options given to the resumed run
+    upload_session = upload.resume(options.resume)
+    if upload_session.get("level") is None:
+        display.warning("Upload session does not record how it was compressed, chunks may all be sent again")
+        return upload_session
+    resumed = {"level": str(upload_session["level"]), "long": upload_session["long_distance"],
+               "dictionary": upload_session["dictionary_id"] is not None, "sidecars": upload_session["sidecars"]}
+    changed = [f"--{name} {value}" for name, value in resumed.items() if getattr(options, name) != value]
+    for name, value in resumed.items():
+        setattr(options, name, value)
+    if changed:
+        display.warning("Options changed to match the upload session", ", ".join(changed))
+    return upload_session
+
+def send_chunked(stream: pipeline.CompressedStream, commit: Optional[str], dictionary_id: Optional[int], level: int,
+                 options: argparse.Namespace, upload: Optional[chunked.ChunkedUpload]) -> dict:
+    if upload is None:
+        upload = chunked.ChunkedUpload(session, settings.project, parallel=options.parallel)
+        upload.create(commit, options.chunk_size * 1024 * 1024 if options.chunk_size else None, dictionary_id,
+                      options.sidecars, level, options.long)
+    count = upload.upload(stream)
+    display.success(f"{upload.sent_chunks} chunks sent, {upload.skipped_chunks} already on server", prefix="Chunks")
+    return upload.finalize(count, stream.checksum)
+
+def trailing_checksum(stream: pipeline.CompressedStream) -> Iterator[bytes]:
+    # Sent after the upload field, by then the whole stream has been hashed
+    yield stream.checksum.encode()
+
+def send_single(stream: pipeline.CompressedStream, params: dict, manifest: Optional[dict]) -> dict:
+    fields = [("upload", "upload.tar.zst", "application/zstd", stream)]
+    if manifest is not None:
+        fields.append(("delta_manifest", "manifest.json", "application/json", [json.dumps(manifest).encode()]))
+    fields.append(("upload_checksum", None, None, trailing_checksum(stream)))
+    content_type, body = multipart_body(fields)
+    return session.request("POST", f"projects/{settings.project}/deployments", params=params,
+                           data=body, headers={"Content-Type": content_type})
+
+def report_cache(scan_cache: Optional[cache.ScanCache]) -> None:
+    if scan_cache is None:
+        return
+    stats = scan_cache.stats()
+    rates = []
+    for name, hits, lookups in [("file hashes", stats["hash_hits"], stats["hash_lookups"]),
+                                ("compressed files", stats["frame_hits"], stats["frame_lookups"])]:
+        rate = hits / lookups * 100 if lookups else 0
+        rates.append(f"{name} {hits}/{lookups} ({rate:.0f}%)")
+    display.success(f"{', '.join(rates)}, {stats['reused_size']} bytes not compressed again", prefix="Cache")
+
+def upload_deployment(files: list[list[str]], commit: Optional[str], switch: bool, options: argparse.Namespace) -> int:
+    if options.no_cache:
+        return upload_with_cache(files, commit, switch, options, None)
+    scan_cache = cache.ScanCache(settings.cache_path or cache.default_path())
+    try:
+        return upload_with_cache(files, commit, switch, options, scan_cache)
+    finally:
+        scan_cache.prune(settings.cache_size * 1024 * 1024)
+        scan_cache.close()
+
+def upload_with_cache(files: list[list[str]], commit: Optional[str], switch: bool, options: argparse.Namespace,
+                      scan_cache: Optional[cache.ScanCache]) -> int:
     display.message(f"Uploading deployment with commit={UNDERLINE}{commit}{NORMAL}")
     display.message(f"Current directory: {UNDERLINE}{os.getcwd()}{NORMAL}")
-    with io.BytesIO() as tar_stream, io.BytesIO() as zstd_stream:
-        with tarfile.open(fileobj=tar_stream, mode="w") as tar:
-            for file, arcname in files:
-                if file.startswith("..") or os.path.isabs(file):
-                    display.tar_progress("skip", file)
-                    continue
-                display.tar_progress("add", file)
-                tar.add(os.path.abspath(file), arcname=arcname, recursive=True)
-        tar_size = tar_stream.tell()
-        tar_stream.seek(0)
-        display.message(f"Compressing...")
-        compressor = ZstdCompressor(level=19)
-        compressor.copy_stream(tar_stream, zstd_stream, read_size=tar_size)
-        zstd_size = zstd_stream.tell()
-        zstd_stream.seek(0)
-        display.success(f"{tar_size} -> {zstd_size} bytes", prefix="Compressed")
+    if options.delta and (options.chunked or options.resume):
+        display.error("Delta uploads cannot be sent in chunks")
+        return 1
+    upload, upload_session = None, None
+    if options.resume:
+        upload = chunked.ChunkedUpload(session, settings.project, parallel=options.parallel)
         try:
-            params = {"commit_hash": commit} if commit else None
-            file = {"upload": zstd_stream}
-            response = session.request("POST", f"projects/{settings.project}/deployments", params=params, files=file)
+            upload_session = resume_chunked(upload, options)
         except SessionError:
-            display.error("Could not upload deployment")
+            display.error(f"Could not resume upload {UNDERLINE}{options.resume}{NORMAL}")
             return 1
-        display.success(str(response), prefix="Uploaded")
+    files = included_files(files)
+    params = {"commit_hash": commit} if commit else {}
+    manifest = None
+    try:
+        if options.delta:
+            files, manifest = negotiate_delta(files, params, scan_cache, options.threads)
+    except SessionError:
+        display.error("Could not negotiate delta upload")
+        return 1
+    dictionary_id, dictionary = fetch_dictionary() if options.dictionary else (None, None)
+    if upload_session is not None and options.dictionary and dictionary_id != upload_session["dictionary_id"]:
+        display.error(f"Upload session was compressed with dictionary {upload_session['dictionary_id']}, "
+                      f"which is no longer the project's latest, start a new upload instead")
+        return 1
+    if dictionary_id:
+        params["dictionary_id"] = dictionary_id
+    if options.sidecars:
+        params["sidecars"] = "true"
+    level = options.level
+    if level == "auto":
+        level, _ = pipeline.choose_level(files, not options.delta, options.threads, options.bandwidth)
+        display.success(f"level {level} for {options.bandwidth} MB/s upload bandwidth", prefix="Auto")
+    stream = pipeline.CompressedStream(files, recursive=not options.delta, level=int(level),
+                                       threads=options.threads, long_distance=options.long,
+                                       dictionary=dictionary, cache=scan_cache)
+    display.message(f"Compressing and uploading...")
+    try:
+        if options.chunked or options.resume:
+            response = send_chunked(stream, commit, dictionary_id, int(level), options, upload)
+        else:
+            response = send_single(stream, params, manifest)
+    except SessionError:
+        display.error("Could not upload deployment")
+        return 1
+    throughput = stream.tar_size / max(stream.elapsed, 1e-6) / 1024 / 1024
+    display.success(f"{stream.tar_size} -> {stream.zstd_size} bytes in {stream.elapsed:.2f}s ({throughput:.2f} MB/s)",
+                    prefix="Compressed")
+    report_cache(scan_cache)
+    if options.json:
+        display.json_line(response)
+    else:
+        report_upload(response)
     if switch:
         return switch_deployment(response["deployment_id"])
     return 0
 
+def report_upload(response: dict) -> None:
+    display.success(str(response), prefix="Uploaded")
+    if response.get("checksums"):
+        checksums = response["checksums"]
+        display.success(f"{checksums['algorithm']} {checksums['upload']} for the upload, "
+                        f"{checksums['verified_files']} files checked on the server", prefix="Verified")
+    if response.get("sidecars"):
+        sidecars = response["sidecars"]
+        saved = ", ".join(f"{fmt} -{size} bytes" for fmt, size in sidecars["saved_size"].items())
+        display.success(f"{sidecars['files']} files compressed, {sidecars['reused_files']} reused ({saved}), "
+                        f"{sidecars['compress_seconds']:.2f}s CPU, {sidecars['wait_seconds']:.2f}s after extraction",
+                        prefix="Sidecars")
+    if response.get("timings"):
+        timings = response["timings"]
+        breakdown = ", ".join(f"{stage} {seconds:.3f}s" for stage, seconds in
+                              sorted(timings.items(), key=lambda x: x[1], reverse=True))
+        display.success(f"{sum(timings.values()):.3f}s on server ({breakdown})", prefix="Timings")
+
+def promote_deployment(from_project: str, commit: Optional[str], deployment_id: Optional[str], switch: bool) -> int:
+    source = f"commit={UNDERLINE}{commit}{NORMAL}" if commit else f"deployment={UNDERLINE}{deployment_id}{NORMAL}"
+    display.message(f"Promoting {source} from project {UNDERLINE}{from_project}{NORMAL}")
+    params = {"from_project": from_project, **({"commit_hash": commit} if commit else {"deployment_id": deployment_id})}
+    if switch:
+        params["switch"] = "true"
+    try:
+        response = session.request("POST", f"projects/{settings.project}/deployments/clone", params=params)
+    except SessionError:
+        display.error("Could not promote deployment")
+        return 1
+    display.success(str(response), prefix="Promoted")
+    methods = ", ".join(f"{count} {method}" for method, count in response["clone"].items() if count)
+    display.success(f"{response['files']} files, {response['extracted_size']} bytes ({methods or 'empty'})",
+                    prefix="Cloned")
+    if switch:
+        display.message(f"Switched to deployment {GREEN}{UNDERLINE}{response['deployment_id']}{NORMAL}")
+    return 0
+
 def switch_deployment(deployment_id: str) -> int:
     try:
         response = session.request("PATCH", f"projects/{settings.project}/current", params={"deployment_id": deployment_id})
@@ -104,13 +357,37 @@ def switch_deployment(deployment_id: str) -> int:
     display.message(f"Switched to deployment {GREEN}{UNDERLINE}{deployment_id}{NORMAL}")
     return 0
 
+def switch_deployments() -> int:
+    switches = [{"name": fields[0], "deployment_id": fields[1]} if len(fields) > 1 else
+                {"name": settings.project, "deployment_id": fields[0]} for fields in read_batch()]
+    responses, failed = session.batch("PATCH", "current", "switches", switches)
+    failed = [{**x, "detail": "Request failed"} for x in failed]
+    failed += [x for response in responses for x in response["failed"]]
+    switched = [x for response in responses for x in response["switched"]]
+    if failed:
+        display.table(["name", "deployment_id", "detail"], failed)
+    display.message(f"Switched {GREEN}{len(switched)}{NORMAL} projects, {len(failed)} failed")
+    return 1 if failed else 0
+
 def main(args: argparse.Namespace) -> int:
     if args.action == "list":
-        return list_deployments()
+        return list_deployments(limit=args.limit, after=args.after)
+    if args.action == "diff":
+        return diff_deployments(args.deployment_id, args.other_deployment_id, raw=args.json)
     if args.action == "upload":
-        return upload_deployment(files=args.file, commit=args.commit, switch=args.switch)
+        return upload_deployment(files=args.file, commit=args.commit, switch=args.switch, options=args)
+    if args.action == "promote":
+        return promote_deployment(args.from_project, commit=args.commit, deployment_id=args.deployment,
+                                  switch=args.switch)
+    if args.action in ["delete", "switch"] and not args.batch and not args.deployment_id:
+        display.error("A deployment ID or '--batch' is required")
+        return 1
     if args.action == "delete":
+        if args.batch:
+            return delete_deployments(confirmed=args.yes)
         return delete_deployment(deployment_id=args.deployment_id, confirmed=args.yes)
     if args.action == "switch":
+        if args.batch:
+            return switch_deployments()
         return switch_deployment(deployment_id=args.deployment_id)
     return 1
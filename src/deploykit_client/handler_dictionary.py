@@ -0,0 +1,50 @@
+import argparse
+
+from deploykit_client import display
+from deploykit_client.config import settings
+from deploykit_client.session import Session, SessionError
+from deploykit_client.display import UNDERLINE, NORMAL
+
+
+__modname__ = "dictionary"
+session = Session()
+
+
+def register_parser(parser: argparse.ArgumentParser) -> None:
+    action_parser = parser.add_subparsers(dest="action", required=True)
+
+    train_action = action_parser.add_parser("train", help="Train a dictionary from the current deployment")
+    train_action.add_argument("-d", "--deployment", metavar="<deployment-id>", help="Train from this deployment instead of 'current'")
+    train_action.add_argument("-s", "--size", metavar="<KiB>", type=int, default=110, help="Dictionary size in KiB, default: 110")
+
+    action_parser.add_parser("show", help="Show the dictionary used for uploads")
+
+def train_dictionary(deployment_id: str, size: int) -> int:
+    params = {"dict_size": size * 1024}
+    if deployment_id:
+        params["deployment_id"] = deployment_id
+    try:
+        response = session.request("POST", f"projects/{settings.project}/dictionary", params=params)
+    except SessionError:
+        display.error("Could not train dictionary")
+        return 1
+    display.success(f"Dictionary {UNDERLINE}{response['dictionary_id']}{NORMAL} trained from "
+                    f"{response['samples']} files of deployment {response['deployment_id']}", prefix="Trained")
+    return 0
+
+def show_dictionary() -> int:
+    try:
+        response = session.request("GET", f"projects/{settings.project}/dictionary")
+    except SessionError:
+        display.error("Could not get dictionary")
+        return 1
+    display.table(["dictionary_id", "size"], [{"dictionary_id": response["dictionary_id"],
+                                              "size": len(response["content"]) * 3 // 4}])
+    return 0
+
+def main(args: argparse.Namespace) -> int:
+    if args.action == "train":
+        return train_dictionary(deployment_id=args.deployment, size=args.size)
+    if args.action == "show":
+        return show_dictionary()
+    return 1
@@ -0,0 +1,46 @@
+import argparse
+from pytz import timezone
+from datetime import datetime
+from typing import Optional
+
+from deploykit_client import display
+from deploykit_client.config import settings
+from deploykit_client.session import Session, SessionError
+from deploykit_client.display import UNDERLINE, NORMAL
+
+
+__modname__ = "gc"
+session = Session()
+
+
+def register_parser(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--keep-last", metavar="<n>", type=int, help="Keep the newest n deployments, default: server setting")
+    parser.add_argument("--keep-days", metavar="<days>", type=int, help="Keep deployments newer than this, default: server setting")
+    parser.add_argument("--dry-run", action="store_true", help="Only show what would be deleted and freed")
+
+def collect(keep_last: Optional[int], keep_days: Optional[int], dry_run: bool) -> int:
+    params = {"keep_last": keep_last, "keep_days": keep_days, "dry_run": "true" if dry_run else None}
+    try:
+        response = session.request("POST", f"projects/{settings.project}/gc",
+                                   params={k: v for k, v in params.items() if v is not None})
+    except SessionError:
+        display.error("Could not collect deployments")
+        return 1
+    expired = response["expired"]
+    for deployment in expired:
+        deployment["created_at"] = datetime.fromtimestamp(
+            deployment["created_at"],
+            timezone(settings.timezone)
+        ).isoformat()
+    display.table(["deployment_id", "created_at"], expired)
+    policy = f"keep last {response['keep_last']}, keep {response['keep_days']} days"
+    if dry_run:
+        display.success(f"{len(expired)} deployments would be deleted, freeing {response['freed_size']} bytes "
+                        f"({policy})", prefix="Dry run")
+    else:
+        display.success(f"{len(expired)} deployments moved to trash, {UNDERLINE}{response['freed_size']}{NORMAL} "
+                        f"bytes will be reclaimed in background ({policy})", prefix="Collected")
+    return 0
+
+def main(args: argparse.Namespace) -> int:
+    return collect(keep_last=args.keep_last, keep_days=args.keep_days, dry_run=args.dry_run)
@@ -0,0 +1,55 @@
+import argparse
+
+from deploykit_client import display
+from deploykit_client.session import Session, SessionError, read_batch
+from deploykit_client.display import UNDERLINE, NORMAL, GREEN
+
+
+__modname__ = "release"
+# Projects are named on the command line, PROJECT is not needed
+__requires_project__ = False
+session = Session()
+
+
+def register_parser(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("deployments", metavar="<project>=<deployment-id>", nargs="*", help="Project and the deployment to switch it to")
+    parser.add_argument("--batch", action="store_true", help="Also read '<project> <deployment-id>' lines from stdin")
+
+def parse_deployments(arguments: list[str], batch: bool) -> list[dict]:
+    pairs = [argument.split("=", 1) for argument in arguments]
+    if batch:
+        pairs += read_batch()
+    deployments = []
+    for pair in pairs:
+        if len(pair) != 2 or not all(pair):
+            raise ValueError(f"'{' '.join(pair)}' is not a project and deployment ID pair")
+        deployments.append({"name": pair[0], "deployment_id": pair[1]})
+    return deployments
+
+def release(deployments: list[dict]) -> int:
+    try:
+        response = session.request("POST", "releases", json={"deployments": deployments}, retry=True)
+    except SessionError:
+        display.error("Could not release, no project was switched")
+        return 1
+    released = response["released"]
+    rows = [{"name": x["name"], "deployment_id": x["deployment_id"], "previous": x["previous_deployment_id"],
+             "offset": f"{x['offset'] * 1e6:.0f} µs"} for x in released]
+    display.table(["name", "deployment_id", "previous", "offset"], rows)
+    display.success(f"{len(released)} projects switched within {UNDERLINE}{response['skew'] * 1e6:.0f}{NORMAL} µs",
+                    prefix="Released")
+    if all(x["previous_deployment_id"] for x in released):
+        rollback = " ".join(f"{x['name']}={x['previous_deployment_id']}" for x in released)
+        display.message(f"Roll back with: {GREEN}deployctl release {rollback}{NORMAL}")
+    return 0
+
+def main(args: argparse.Namespace) -> int:
+    try:
+        deployments = parse_deployments(args.deployments, args.batch)
+    except ValueError as e:
+        display.error(str(e))
+        return 1
+    if not deployments:
+        display.error("Nothing to release, name at least one '<project>=<deployment-id>'")
+        return 1
+    return release(deployments)
@@ -1,9 +1,8 @@
-import os
 import argparse
 import boto3.session
-from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 
-from deploykit_client import display
+from deploykit_client import display, s3sync
 from deploykit_client.config import settings
 from deploykit_client.display import UNDERLINE, NORMAL, YELLOW, GREEN
 
@@ -11,37 +10,38 @@ from deploykit_client.display import UNDERLINE, NORMAL, YELLOW, GREEN
 __modname__ = "s3"
 
 
-def register_parser(subparser: argparse.ArgumentParser) -> None:
-    parser = subparser.add_parser(__modname__, help="Action for upload local assets to S3-compatible storage")
+def register_parser(parser: argparse.ArgumentParser) -> None:
     parser.add_argument("-b", "--bucket", metavar="<bucket>", help="Bucket name")
     parser.add_argument("-p", "--prefix", metavar="<prefix>", help="Prefix for the files")
     parser.add_argument("-f", "--file", action="append", required=True, metavar="<file>", help="File or directory to upload")
+    parser.add_argument("--concurrency", metavar="<n>", type=int, default=16, help="Files uploaded in parallel, default: 16")
+    parser.add_argument("--delete", action="store_true", help="Delete remote objects under the prefix that do not exist locally")
+    parser.add_argument("--dry-run", action="store_true", help="Only show what would be uploaded or deleted")
 
-def progress(filename: str, index: int, total: int) -> None:
+def progress(filename: str, transferred: bool, index: int, total: int) -> None:
     text = f"{index + 1}/{total}"
     text_length = len(f"{total}/{total}")
-    display.message(f"[{YELLOW}{text:>{text_length}}{NORMAL}] {filename}")
+    status = f"{GREEN}upload{NORMAL}" if transferred else "skip  "
+    display.message(f"[{YELLOW}{text:>{text_length}}{NORMAL}] {status} {filename}")
 
 def main(args: argparse.Namespace) -> int:
     session = boto3.session.Session(settings.s3_access_key, settings.s3_secret_key)
-    s3 = session.resource(service_name='s3', endpoint_url=settings.s3_endpoint)
-    bucket, prefix, includes = args.bucket.strip(), args.prefix.strip('/'), args.file
-    display.message(f"Uploading files to {UNDERLINE}{settings.s3_endpoint}/{bucket}/{prefix}{NORMAL}")
-
-    files = []
-    for include in includes:
-        include = include.strip('/')
-        if os.path.isdir(include):
-            for root, _, filenames in os.walk(include):
-                for filename in filenames:
-                    files.append(os.path.join(root, filename))
-        else:
-            files.append(include)
-    
-    for i, file in enumerate(files):
-        progress(file, i, len(files))
-        s3.Bucket(bucket).upload_file(file, f"{prefix}/{file}", Config=TransferConfig(
-            multipart_threshold=1024 * 25,
-            max_concurrency=8,
-            use_threads=True))
-    display.success(f"Transfered {len(files)} files", prefix="Success")
+    # One client shared by all threads, with a connection for each of them
+    client = session.client(service_name='s3', endpoint_url=settings.s3_endpoint,
+                            config=Config(max_pool_connections=max(args.concurrency, 10)))
+    bucket, prefix = args.bucket.strip(), (args.prefix or "").strip('/')
+    display.message(f"Syncing files to {UNDERLINE}{settings.s3_endpoint}/{bucket}/{prefix}{NORMAL}")
+
+    files = s3sync.local_files(args.file, prefix)
+    sync = s3sync.S3Sync(client, bucket, prefix, concurrency=args.concurrency, dry_run=args.dry_run)
+    result, deleted = sync.run(files, delete=args.delete, progress=progress)
+    for key in deleted:
+        display.message(f"{YELLOW}delete{NORMAL} {key}")
+
+    action = "Would transfer" if args.dry_run else "Transfered"
+    display.success(f"{action} {result.transferred_objects} files ({result.transferred_size} bytes) "
+                    f"in {result.elapsed:.2f}s ({result.throughput:.2f} MB/s)", prefix="Success")
+    display.success(f"{result.skipped_objects} files ({result.skipped_size} bytes) already up to date, "
+                    f"{result.deleted_objects} remote files {'would be ' if args.dry_run else ''}deleted",
+                    prefix="Skipped")
+    return 0
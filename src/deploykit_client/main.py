@@ -1,27 +1,42 @@
 import sys
 import argparse
+import importlib
 
 from deploykit_server import __version__
-from deploykit_client import display, handler_deploy, handler_commit, handler_s3
-from deploykit_client.config import settings
+from deploykit_client import display
 from deploykit_client.display import UNDERLINE, NORMAL
 
 
+# Only the module of the command being run is imported, with it come requests, zstandard, boto3...
+COMMANDS = {
+    "deploy": ("handler_deploy", "Actions related to deployments"),
+    "commit": ("handler_commit", "Actions related to commits"),
+    "dictionary": ("handler_dictionary", "Actions related to Zstandard dictionaries"),
+    "gc": ("handler_gc", "Delete old deployments according to the retention policy"),
+    "release": ("handler_release", "Switch 'current' of several projects together"),
+    "s3": ("handler_s3", "Action for upload local assets to S3-compatible storage"),
+}
+
+
 def main() -> int:
-    modules = [handler_deploy, handler_commit, handler_s3]
     parser = argparse.ArgumentParser(prog="deployctl", description="Client for DeployKit, a static website deployment tool")
     parser.add_argument("-v", "--version", action="version", version=f"%(prog)s {__version__}")
     subparser = parser.add_subparsers(dest="command", required=True)
-    for module in modules:
-        module.register_parser(subparser)
+    # The top-level parser has no options taking a value, so the first positional argument is the command
+    command = next((x for x in sys.argv[1:] if not x.startswith("-")), None)
+    module = None
+    for name, (module_name, description) in COMMANDS.items():
+        command_parser = subparser.add_parser(name, help=description)
+        if name == command:
+            module = importlib.import_module(f"deploykit_client.{module_name}")
+            module.register_parser(command_parser)
     args = parser.parse_args()
 
+    from deploykit_client.config import settings
     if settings.project.strip() == "":
-        display.error(f"Please set your project name as {UNDERLINE}PROJECT{NORMAL} environment variable")
-        return 1
-    display.success(f"{UNDERLINE}{settings.project}{NORMAL}", prefix="Project")
-
-    for module in modules:
-        if args.command == module.__modname__:
-            return module.main(args)
-    return 1
+        if getattr(module, "__requires_project__", True):
+            display.error(f"Please set your project name as {UNDERLINE}PROJECT{NORMAL} environment variable")
+            return 1
+    else:
+        display.success(f"{UNDERLINE}{settings.project}{NORMAL}", prefix="Project")
+    return module.main(args)
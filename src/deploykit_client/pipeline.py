@@ -0,0 +1,305 @@
+import io
+import os
+import grp
+import pwd
+import stat
+import time
+import queue
+import tarfile
+import threading
+import collections
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, Optional, Tuple, Union
+from zstandard import ZSTD_VERSION, FLUSH_FRAME, ZstdCompressor, ZstdCompressionDict, ZstdCompressionParameters
+
+from deploykit_client import scanner
+from deploykit_client.cache import ScanCache
+
+
+CHUNK_SIZE = 1024 * 1024
+AUTO_LEVELS = [1, 3, 6, 9, 12, 15, 19]
+AUTO_SAMPLE_SIZE = 4 * 1024 * 1024
+FRAME_MIN_SIZE = 128 * 1024
+READ_AHEAD = 4
+# PAX keyword each file's content hash is sent under, the server checks it while writing the file
+CHECKSUM_HEADER = "DEPLOYKIT.blake2b"
+
+
+class QueueWriter(io.RawIOBase):
+    def __init__(self, chunks: queue.Queue):
+        self.chunks = chunks
+        self.hasher = scanner.new_hash()
+        self.size = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        data = bytes(data)
+        self.hasher.update(data)
+        self.chunks.put(data)
+        self.size += len(data)
+        return len(data)
+
+
+class CountingWriter(io.RawIOBase):
+    def __init__(self, writer):
+        self.writer = writer
+        self.size = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self.writer.write(data)
+        self.size += len(data)
+        return len(data)
+
+
+def compression_parameters(level: int, threads: int, long_distance: bool) -> ZstdCompressionParameters:
+    if long_distance:
+        # A 128 MiB window is the largest the server decompresses without extra configuration
+        return ZstdCompressionParameters.from_level(level, threads=threads, enable_ldm=True, window_log=27)
+    return ZstdCompressionParameters.from_level(level, threads=threads)
+
+
+def tar_info(path: str, arcname: str, file_stat: os.stat_result, inodes: dict) -> Optional[tarfile.TarInfo]:
+    # The member tarfile.TarFile.gettarinfo would build, from the stat the scanner already has
+    info = tarfile.TarInfo(arcname.lstrip("/"))
+    mode = file_stat.st_mode
+    if stat.S_ISREG(mode):
+        inode = (file_stat.st_ino, file_stat.st_dev)
+        if file_stat.st_nlink > 1 and inode in inodes and arcname != inodes[inode]:
+            info.type, info.linkname = tarfile.LNKTYPE, inodes[inode]
+        else:
+            info.type, info.size = tarfile.REGTYPE, file_stat.st_size
+            if inode[0]:
+                inodes[inode] = arcname
+    elif stat.S_ISDIR(mode):
+        info.type = tarfile.DIRTYPE
+    elif stat.S_ISLNK(mode):
+        info.type, info.linkname = tarfile.SYMTYPE, os.readlink(path)
+    else:
+        return None
+    info.mode = stat.S_IMODE(mode)
+    # Whole seconds, as the header field holds them; a fraction would add a PAX record to every file
+    info.uid, info.gid, info.mtime = file_stat.st_uid, file_stat.st_gid, int(file_stat.st_mtime)
+    info.uname, info.gname = user_name(file_stat.st_uid), group_name(file_stat.st_gid)
+    return info
+
+
+@lru_cache
+def user_name(uid: int) -> str:
+    try:
+        return pwd.getpwuid(uid).pw_name
+    except KeyError:
+        return ""
+
+
+@lru_cache
+def group_name(gid: int) -> str:
+    try:
+        return grp.getgrgid(gid).gr_name
+    except KeyError:
+        return ""
+
+
+def padding(size: int) -> bytes:
+    return tarfile.NUL * (-size % tarfile.BLOCKSIZE)
+
+
+def read_exactly(f, size: int, chunk_size: int) -> Iterator[bytes]:
+    remaining = size
+    while remaining:
+        chunk = f.read(min(chunk_size, remaining))
+        if not chunk:
+            raise OSError(f"'{f.name}' changed while it was being read")
+        remaining -= len(chunk)
+        yield chunk
+
+
+class CompressedStream:
+    def __init__(self, members: list[list[str]], recursive: bool = True, level: int = 19,
+                 threads: int = -1, long_distance: bool = False, chunk_size: int = CHUNK_SIZE,
+                 dictionary: Optional[ZstdCompressionDict] = None, cache: Optional[ScanCache] = None,
+                 frame_min_size: int = FRAME_MIN_SIZE):
+        self.members = members
+        self.recursive = recursive
+        self.level = level
+        self.threads = threads
+        self.long_distance = long_distance
+        self.dictionary = dictionary
+        self.compressor = ZstdCompressor(dict_data=dictionary,
+                                         compression_params=compression_parameters(level, threads, long_distance))
+        self.chunk_size = chunk_size
+        self.cache = cache
+        self.frame_min_size = frame_min_size
+        self.tar_size = 0
+        self.zstd_size = 0
+        self.checksum = None
+        self.started_at = None
+        self.finished_at = None
+
+    def entries(self) -> Iterator[Tuple[str, tarfile.TarInfo, os.stat_result]]:
+        inodes = {}
+        for file, arcname in self.members:
+            for path, name, file_stat in scanner.walk(os.path.abspath(file), arcname.strip("/"), self.recursive):
+                info = tar_info(path, name, file_stat, inodes)
+                if info is not None:
+                    yield path, info, file_stat
+
+    def frame_key(self, digest: str, size: int) -> str:
+        dictionary_id = self.dictionary.dict_id() if self.dictionary is not None else 0
+        hasher = scanner.new_hash()
+        hasher.update(f"{digest}:{size}:{self.level}:{self.long_distance}:{dictionary_id}:{ZSTD_VERSION}".encode())
+        return hasher.hexdigest()
+
+    def compress_frame(self, path: str, size: int, digest: str, key: str) -> str:
+        # Each large file becomes a frame of its own, which later uploads reuse as long as the content is unchanged
+        temp_path = self.cache.new_frame(key)
+        compressor = ZstdCompressor(dict_data=self.dictionary,
+                                    compression_params=compression_parameters(self.level, 0, self.long_distance))
+        hasher = scanner.new_hash()
+        try:
+            with open(path, "rb") as f, open(temp_path, "wb") as output:
+                with compressor.stream_writer(output, size=size + len(padding(size)), closefd=False) as writer:
+                    for chunk in read_exactly(f, size, self.chunk_size):
+                        hasher.update(chunk)
+                        writer.write(chunk)
+                    writer.write(padding(size))
+            if hasher.hexdigest() != digest:
+                raise OSError(f"'{path}' changed while it was being read")
+            os.replace(temp_path, self.cache.frame(key))
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+            raise
+        return self.cache.frame(key)
+
+    def read(self, path: str, info: tarfile.TarInfo, file_stat: os.stat_result) -> Tuple[Union[bytes, str, None], str]:
+        # The content hash goes into the member header, so it has to be known before the content is written
+        if info.size >= self.frame_min_size:
+            if self.cache is not None:
+                return self.cached_frame(path, info.size, file_stat)
+            return None, scanner.hash_file(path, self.chunk_size)
+        with open(path, "rb") as f:
+            content = b"".join(read_exactly(f, info.size, self.chunk_size))
+        hasher = scanner.new_hash()
+        hasher.update(content)
+        return content, hasher.hexdigest()
+
+    def cached_frame(self, path: str, size: int, file_stat: os.stat_result) -> Tuple[str, str]:
+        digest = self.cache.lookup_hash(path, file_stat)
+        if digest is None:
+            digest = scanner.hash_file(path, self.chunk_size)
+            self.cache.store_hashes([(path, file_stat, digest)])
+        key = self.frame_key(digest, size)
+        return self.cache.lookup_frame(key, size) or self.compress_frame(path, size, digest, key), digest
+
+    def contents(self, executor: ThreadPoolExecutor, lookahead: int
+                 ) -> Iterator[Tuple[str, tarfile.TarInfo, Tuple[Union[bytes, str, None], Optional[str]]]]:
+        # Files are read ahead by the pool but come out in traversal order, so the archive is deterministic
+        pending = collections.deque()
+        for path, info, file_stat in self.entries():
+            future = executor.submit(self.read, path, info, file_stat) if info.isreg() else None
+            pending.append((path, info, future))
+            while len(pending) > lookahead:
+                path, info, future = pending.popleft()
+                yield path, info, future.result() if future else (None, None)
+        while pending:
+            path, info, future = pending.popleft()
+            yield path, info, future.result() if future else (None, None)
+
+    def produce(self, chunks: queue.Queue, errors: list) -> None:
+        try:
+            output, workers = QueueWriter(chunks), scanner.workers(self.threads)
+            with self.compressor.stream_writer(output, write_size=self.chunk_size, closefd=False) as zstd, \
+                    ThreadPoolExecutor(workers) as executor:
+                counter = CountingWriter(zstd)
+                for path, info, (content, digest) in self.contents(executor, workers * READ_AHEAD):
+                    if digest is None:
+                        counter.write(info.tobuf(tarfile.DEFAULT_FORMAT, tarfile.ENCODING, "surrogateescape"))
+                    else:
+                        info.pax_headers = {CHECKSUM_HEADER: digest}
+                        counter.write(info.tobuf(tarfile.PAX_FORMAT, tarfile.ENCODING, "surrogateescape"))
+                    if isinstance(content, bytes):
+                        counter.write(content + padding(len(content)))
+                    elif content is None and info.isreg():
+                        # Large files without a cache are streamed here rather than held in the read-ahead
+                        hasher = scanner.new_hash()
+                        with open(path, "rb") as f:
+                            for chunk in read_exactly(f, info.size, self.chunk_size):
+                                hasher.update(chunk)
+                                counter.write(chunk)
+                        if hasher.hexdigest() != digest:
+                            raise OSError(f"'{path}' changed while it was being read")
+                        counter.write(padding(info.size))
+                    elif isinstance(content, str):
+                        # Zstandard frames concatenate, so a cached frame is sent as is between two of ours
+                        zstd.flush(FLUSH_FRAME)
+                        with open(content, "rb") as f:
+                            while chunk := f.read(self.chunk_size):
+                                output.write(chunk)
+                        counter.size += info.size + len(padding(info.size))
+                counter.write(tarfile.NUL * tarfile.BLOCKSIZE * 2)
+                counter.write(tarfile.NUL * (-counter.size % tarfile.RECORDSIZE))
+            self.tar_size, self.zstd_size = counter.size, output.size
+            self.checksum = output.hasher.hexdigest()
+        except BaseException as e:
+            errors.append(e)
+        finally:
+            chunks.put(None)
+
+    def __iter__(self) -> Iterator[bytes]:
+        # A bounded queue keeps the pipeline back-pressured by the upload speed
+        chunks, errors = queue.Queue(maxsize=8), []
+        self.started_at = time.monotonic()
+        producer = threading.Thread(target=self.produce, args=(chunks, errors), daemon=True)
+        producer.start()
+        while (chunk := chunks.get()) is not None:
+            yield chunk
+        producer.join()
+        self.finished_at = time.monotonic()
+        if errors:
+            raise errors[0]
+
+    @property
+    def elapsed(self) -> float:
+        if self.started_at is None or self.finished_at is None:
+            return 0.0
+        return self.finished_at - self.started_at
+
+
+def sample_input(members: list[list[str]], recursive: bool, limit: int = AUTO_SAMPLE_SIZE) -> bytes:
+    sample = bytearray()
+    for file, _ in members:
+        paths = [file]
+        if recursive and os.path.isdir(file):
+            paths = (os.path.join(root, name) for root, _, names in os.walk(file) for name in sorted(names))
+        for path in paths:
+            if os.path.isfile(path) and not os.path.islink(path):
+                with open(path, "rb") as f:
+                    sample += f.read(limit - len(sample))
+            if len(sample) >= limit:
+                return bytes(sample)
+    return bytes(sample)
+
+
+def choose_level(members: list[list[str]], recursive: bool, threads: int, bandwidth: float) -> Tuple[int, list[dict]]:
+    # Compression and upload overlap, so each byte costs whichever of the two stages is slower
+    sample = sample_input(members, recursive)
+    workers = os.cpu_count() if threads < 0 else max(threads, 1)
+    if not sample:
+        return AUTO_LEVELS[0], []
+    candidates = []
+    for level in AUTO_LEVELS:
+        started_at = time.perf_counter()
+        compressed = ZstdCompressor(level=level).compress(sample)
+        elapsed = max(time.perf_counter() - started_at, 1e-6)
+        throughput = len(sample) / elapsed * workers
+        ratio = len(compressed) / len(sample)
+        cost = max(1 / throughput, ratio / (bandwidth * 1024 * 1024))
+        candidates.append({"level": level, "throughput": throughput, "ratio": ratio, "cost": cost})
+    best = min(candidates, key=lambda x: (x["cost"], -x["level"]))
+    return best["level"], candidates
@@ -0,0 +1,137 @@
+import os
+import time
+import hashlib
+import threading
+from typing import Callable, Iterator, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from boto3.s3.transfer import TransferConfig
+
+
+MULTIPART_CHUNKSIZE = 8 * 1024 * 1024
+DELETE_BATCH_SIZE = 1000
+
+
+def object_key(prefix: str, path: str) -> str:
+    path = path.replace(os.sep, "/").strip("/")
+    return f"{prefix}/{path}" if prefix else path
+
+
+def local_files(includes: list[str], prefix: str) -> dict[str, str]:
+    files = {}
+    for include in includes:
+        include = include.strip('/')
+        if os.path.isdir(include):
+            for root, _, filenames in os.walk(include):
+                for filename in filenames:
+                    path = os.path.join(root, filename)
+                    files[object_key(prefix, path)] = path
+        else:
+            files[object_key(prefix, include)] = include
+    return files
+
+
+def remote_objects(client, bucket: str, prefix: str) -> dict[str, dict]:
+    objects = {}
+    paginator = client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=f"{prefix}/" if prefix else ""):
+        for item in page.get("Contents", []):
+            objects[item["Key"]] = {"size": item["Size"], "etag": item["ETag"].strip('"')}
+    return objects
+
+
+def read_parts(path: str, chunk_size: int) -> Iterator[bytes]:
+    with open(path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            yield chunk
+
+
+def local_etag(path: str, multipart: bool, chunk_size: int = MULTIPART_CHUNKSIZE) -> str:
+    # Multipart ETags are the MD5 of the part MD5s, which only matches when the part size is the same
+    if not multipart:
+        md5 = hashlib.md5()
+        for chunk in read_parts(path, chunk_size):
+            md5.update(chunk)
+        return md5.hexdigest()
+    digests = [hashlib.md5(chunk).digest() for chunk in read_parts(path, chunk_size)]
+    return f"{hashlib.md5(b''.join(digests)).hexdigest()}-{len(digests)}"
+
+
+def is_unchanged(path: str, remote: Optional[dict]) -> bool:
+    if remote is None or os.path.getsize(path) != remote["size"]:
+        return False
+    return local_etag(path, "-" in remote["etag"]) == remote["etag"]
+
+
+class SyncResult:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.transferred_objects = 0
+        self.transferred_size = 0
+        self.skipped_objects = 0
+        self.skipped_size = 0
+        self.deleted_objects = 0
+        self.started_at = time.monotonic()
+        self.finished_at = None
+
+    def record(self, transferred: bool, size: int) -> None:
+        with self.lock:
+            if transferred:
+                self.transferred_objects += 1
+                self.transferred_size += size
+            else:
+                self.skipped_objects += 1
+                self.skipped_size += size
+
+    @property
+    def elapsed(self) -> float:
+        return (self.finished_at or time.monotonic()) - self.started_at
+
+    @property
+    def throughput(self) -> float:
+        return self.transferred_size / max(self.elapsed, 1e-6) / 1024 / 1024
+
+
+class S3Sync:
+    def __init__(self, client, bucket: str, prefix: str, concurrency: int = 16, dry_run: bool = False):
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix
+        self.concurrency = concurrency
+        self.dry_run = dry_run
+        # Each file is one task of the pool, so the transfer itself stays on the calling thread
+        self.transfer_config = TransferConfig(multipart_threshold=MULTIPART_CHUNKSIZE,
+                                              multipart_chunksize=MULTIPART_CHUNKSIZE, use_threads=False)
+
+    def sync_file(self, key: str, path: str, remote: Optional[dict], result: SyncResult) -> Tuple[str, bool]:
+        size = os.path.getsize(path)
+        if is_unchanged(path, remote):
+            result.record(False, size)
+            return key, False
+        if not self.dry_run:
+            self.client.upload_file(path, self.bucket, key, Config=self.transfer_config)
+        result.record(True, size)
+        return key, True
+
+    def delete(self, keys: list[str], result: SyncResult) -> None:
+        for i in range(0, len(keys), DELETE_BATCH_SIZE):
+            batch = keys[i:i + DELETE_BATCH_SIZE]
+            if not self.dry_run:
+                self.client.delete_objects(Bucket=self.bucket,
+                                           Delete={"Objects": [{"Key": x} for x in batch], "Quiet": True})
+            result.deleted_objects += len(batch)
+
+    def run(self, files: dict[str, str], delete: bool = False,
+            progress: Optional[Callable[[str, bool, int, int], None]] = None) -> Tuple[SyncResult, list[str]]:
+        result = SyncResult()
+        remote = remote_objects(self.client, self.bucket, self.prefix)
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            futures = [executor.submit(self.sync_file, key, path, remote.get(key), result)
+                       for key, path in files.items()]
+            for i, future in enumerate(futures):
+                key, transferred = future.result()
+                if progress is not None:
+                    progress(key, transferred, i, len(futures))
+        stale = sorted(set(remote) - set(files)) if delete else []
+        self.delete(stale, result)
+        result.finished_at = time.monotonic()
+        return result, stale
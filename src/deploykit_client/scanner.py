@@ -0,0 +1,66 @@
+import os
+import stat
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, Optional, Tuple
+
+from deploykit_client.cache import ScanCache
+
+
+def new_hash():
+    return hashlib.blake2b(digest_size=32)
+
+
+def hash_file(path: str, buffer_size: int = 1024 * 1024) -> str:
+    hasher = new_hash()
+    with open(path, "rb") as f:
+        while chunk := f.read(buffer_size):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def walk(path: str, arcname: str, recursive: bool = True) -> Iterator[Tuple[str, str, os.stat_result]]:
+    # Same traversal order as tarfile.add(..., recursive=True)
+    file_stat = os.lstat(path)
+    yield path, arcname, file_stat
+    if recursive and stat.S_ISDIR(file_stat.st_mode):
+        with os.scandir(path) as it:
+            names = sorted(entry.name for entry in it)
+        for name in names:
+            yield from walk(os.path.join(path, name), f"{arcname}/{name}" if arcname else name)
+
+
+def workers(threads: int) -> int:
+    return (os.cpu_count() or 1) if threads < 0 else max(threads, 1)
+
+
+def hash_files(files: list[Tuple[str, os.stat_result]], cache: Optional[ScanCache], threads: int = -1) -> list[str]:
+    hashes = [cache.lookup_hash(path, file_stat) if cache else None for path, file_stat in files]
+    missing = [i for i, digest in enumerate(hashes) if digest is None]
+    with ThreadPoolExecutor(workers(threads)) as executor:
+        for i, digest in zip(missing, executor.map(hash_file, [files[i][0] for i in missing])):
+            hashes[i] = digest
+    if cache is not None:
+        cache.store_hashes([(*files[i], hashes[i]) for i in missing])
+    return hashes
+
+
+def scan(files: list[Tuple[str, str]], cache: Optional[ScanCache] = None, threads: int = -1) -> list[Tuple[str, dict]]:
+    entries, regular = [], []
+    for file, arcname in files:
+        for path, name, file_stat in walk(os.path.abspath(file), arcname.strip("/")):
+            entry = {"path": name, "mode": stat.S_IMODE(file_stat.st_mode)}
+            if stat.S_ISLNK(file_stat.st_mode):
+                entry.update(type="symlink", linkname=os.readlink(path))
+            elif stat.S_ISDIR(file_stat.st_mode):
+                entry.update(type="dir")
+            elif stat.S_ISREG(file_stat.st_mode):
+                entry.update(type="file", size=file_stat.st_size)
+                regular.append((path, file_stat, entry))
+            else:
+                continue
+            entries.append((path, entry))
+    hashes = hash_files([(path, file_stat) for path, file_stat, _ in regular], cache, threads)
+    for (_, _, entry), digest in zip(regular, hashes):
+        entry["hash"] = digest
+    return entries
@@ -1,6 +1,11 @@
+import sys
 import json
+import time
+import uuid
 import requests
-from typing import Optional, Tuple
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, Iterator, Optional, TextIO, Tuple
 from platform import python_version, uname
 
 from deploykit_client import display
@@ -8,16 +13,58 @@ from deploykit_client.main import __version__
 from deploykit_client.config import settings
 
 
+IDEMPOTENT_METHODS = {"GET", "HEAD", "PUT", "DELETE", "PATCH", "OPTIONS"}
+BATCH_SIZE = 100
+# Idle keep-alive connections kept per host, parallel chunk uploads may use more than CONCURRENCY
+POOL_SIZE = 32
+
+
 class SessionError(Exception):
     def __init__(self, message: str):
         self.message = message
         super().__init__(self.message)
 
 
+def multipart_body(fields: list[Tuple[str, Optional[str], Optional[str], Iterable[bytes]]]
+                   ) -> Tuple[str, Iterator[bytes]]:
+    boundary = uuid.uuid4().hex
+
+    def body():
+        # Fields without a filename are plain form values
+        for name, filename, content_type, content in fields:
+            if filename is None:
+                yield f"--{boundary}\r\nContent-Disposition: form-data; name=\"{name}\"\r\n\r\n".encode()
+            else:
+                yield (f"--{boundary}\r\n"
+                       f"Content-Disposition: form-data; name=\"{name}\"; filename=\"{filename}\"\r\n"
+                       f"Content-Type: {content_type}\r\n\r\n").encode()
+            yield from content
+            yield b"\r\n"
+        yield f"--{boundary}--\r\n".encode()
+
+    return f"multipart/form-data; boundary={boundary}", body()
+
+
+def read_batch(stream: TextIO = sys.stdin) -> list[list[str]]:
+    # One item per line, blank lines and lines starting with '#' are skipped
+    lines = (line.split("#", 1)[0].split() for line in stream)
+    return [fields for fields in lines if fields]
+
+
+def batches(items: list, size: int = BATCH_SIZE) -> list[list]:
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def retry_delay(response: Optional[requests.Response], attempt: int) -> float:
+    if response is not None and response.headers.get("Retry-After", "").isdigit():
+        return float(response.headers["Retry-After"])
+    return settings.retry_backoff * 2 ** attempt
+
+
 class Session:
     def __init__(self):
         self.base_url = settings.api_url
-        self.session = requests.Session()
+        self.session = None
         self.headers = {
             "Authorization": f"APIKey {settings.api_key}",
             "User-Agent": f"deployctl/{__version__} "
@@ -32,16 +79,82 @@ class Session:
         except requests.exceptions.JSONDecodeError:
             return response.text, None
     
-    def request(self, method: str, path: str, params: Optional[dict] = None, files: Optional[dict] = None) -> dict:
-        response = self.session.request(
-            method=method,
-            url=f"{self.base_url}/{path}",
-            headers=self.headers,
-            params=params,
-            files=files,
-        )
+    def connect(self) -> requests.Session:
+        # Created on first use, so importing a handler does not open anything
+        if self.session is None:
+            self.session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE)
+            self.session.mount("http://", adapter)
+            self.session.mount("https://", adapter)
+        return self.session
+
+    def request(self, method: str, path: str, params: Optional[dict] = None, files: Optional[dict] = None,
+                json: Optional[dict] = None, data: Optional[Iterable[bytes]] = None,
+                headers: Optional[dict] = None, retry: Optional[bool] = None) -> dict:
+        # A streamed body cannot be sent twice, so only requests with a replayable body are retried
+        replayable = files is None and (data is None or isinstance(data, (bytes, str)))
+        retry = method in IDEMPOTENT_METHODS if retry is None else retry
+        attempts = settings.retries + 1 if retry and replayable else 1
+        for attempt in range(attempts):
+            try:
+                response = self.connect().request(
+                    method=method,
+                    url=f"{self.base_url}/{path}",
+                    headers={**self.headers, **(headers or {})},
+                    params=params,
+                    files=files,
+                    json=json,
+                    data=data,
+                    timeout=(settings.connect_timeout, settings.timeout),
+                )
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt + 1 < attempts:
+                    time.sleep(retry_delay(None, attempt))
+                    continue
+                display.error(f"Could not reach {self.base_url}", str(e))
+                raise SessionError(str(e))
+            if response.status_code >= 500 and attempt + 1 < attempts:
+                time.sleep(retry_delay(response, attempt))
+                continue
+            break
         error_detail, data = self.decode_json_or_none(response)
         if (not response.ok) or (data is None):
             display.http_error(response.status_code, error_detail)
             raise SessionError(error_detail)
         return data
+
+    def stream(self, path: str, params: Optional[dict] = None) -> Iterator[dict]:
+        # NDJSON responses are decoded line by line as they arrive instead of as one document
+        try:
+            response = self.connect().get(f"{self.base_url}/{path}", headers=self.headers, params=params,
+                                          stream=True, timeout=(settings.connect_timeout, settings.timeout))
+        except (requests.ConnectionError, requests.Timeout) as e:
+            display.error(f"Could not reach {self.base_url}", str(e))
+            raise SessionError(str(e))
+        with response:
+            if not response.ok:
+                error_detail, _ = self.decode_json_or_none(response)
+                display.http_error(response.status_code, error_detail)
+                raise SessionError(error_detail)
+            for line in response.iter_lines(chunk_size=64 * 1024):
+                if line:
+                    yield json.loads(line)
+
+    def map(self, func: Callable, items: Iterable) -> list:
+        # Runs func over items with up to CONCURRENCY requests in flight on the pooled keep-alive connections
+        with ThreadPoolExecutor(max(settings.concurrency, 1)) as executor:
+            return list(executor.map(func, items))
+
+    def batch(self, method: str, path: str, field: str, items: list) -> Tuple[list[dict], list]:
+        # Items are sent BATCH_SIZE per request, items of a request that failed are returned for the caller to report
+        def send(group: list) -> Tuple[Optional[dict], list]:
+            try:
+                return self.request(method, path, json={field: group}, retry=True), []
+            except SessionError:
+                return None, group
+        responses, failed = [], []
+        for response, group in self.map(send, batches(items)):
+            if response is not None:
+                responses.append(response)
+            failed += group
+        return responses, failed
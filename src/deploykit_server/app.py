@@ -1,16 +1,55 @@
 import os
+import json
+import time
+import base64
 import shutil
-from typing import Annotated
-from fastapi import FastAPI, Depends, Request, Path, Query, UploadFile
-from fastapi.responses import JSONResponse
+import asyncio
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor
+from contextlib import asynccontextmanager
+from typing import Annotated, Optional, TextIO, Tuple
+from fastapi import FastAPI, Body, Depends, Form, HTTPException, Request, Path, Query, UploadFile
+from pydantic import BaseModel, Field
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from functools import lru_cache
 
 from deploykit_server import schema
 from deploykit_server import archive
+from deploykit_server import manifest
+from deploykit_server import dictionary
+from deploykit_server import metrics
+from deploykit_server import retention
+from deploykit_server.auth import APIKeyMiddleware, Keyring, allows
+from deploykit_server.release import ReleaseError, release
+from deploykit_server.clone import CloneError, Cloner, resolve
+from deploykit_server.index import ProjectIndex, projects, rebuild_stale
+from deploykit_server.links import FileSemaphore, ProjectLock, atomic_symlink
+from deploykit_server.sidecar import SidecarWriter, available_formats
+from deploykit_server.staging import Staging, clean_all_orphans
+from deploykit_server.store import ObjectStore, tree_stats
 from deploykit_server.config import Settings, ProjectPath
+from deploykit_server.worker import WorkerPool, PoolSaturatedError
+from deploykit_server.upload import UploadSession, UploadManager, ChunkReader, ChunksChangedError, generate_upload_id
 
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    await get_filesystem_pool().run(rebuild_stale, get_settings().app_path)
+    await get_filesystem_pool().run(lambda: clean_all_orphans(projects(get_settings().app_path)))
+    get_reclaimer().start()
+    yield
+    # uvicorn has stopped accepting requests, extractions already running are given drain_timeout to finish
+    pending = [asyncio.wrap_future(x) for x in get_upload_manager().drain()]
+    if pending:
+        await asyncio.wait(pending, timeout=get_settings().drain_timeout)
+    get_reclaimer().stop()
+    if get_sidecar_pool.cache_info().currsize:
+        get_sidecar_pool().shutdown(cancel_futures=True)
+    get_extraction_pool().shutdown(wait=False)
+    get_filesystem_pool().shutdown(wait=False)
+
+
+app = FastAPI(lifespan=lifespan)
 
 
 @lru_cache
@@ -18,28 +57,80 @@ def get_settings():
     return Settings()
 
 
+def get_object_store(settings: Annotated[Settings, Depends(get_settings)]) -> Optional[ObjectStore]:
+    return ObjectStore(settings.app_path) if settings.object_store else None
+
+
+@lru_cache
+def get_extraction_pool():
+    settings = get_settings()
+    semaphore = None
+    if settings.max_global_extractions > 0:
+        # Worker processes only share the filesystem, so the cap is a set of lock files under APP_PATH
+        semaphore = FileSemaphore(os.path.join(settings.app_path, ".extraction-slots"),
+                                  settings.max_global_extractions)
+    return WorkerPool("extraction", settings.max_extractions, settings.extraction_queue_depth, settings.retry_after,
+                      semaphore)
+
+
+@lru_cache
+def get_upload_manager():
+    return UploadManager()
+
+
+@lru_cache
+def get_filesystem_pool():
+    settings = get_settings()
+    return WorkerPool("filesystem", settings.filesystem_workers, settings.filesystem_queue_depth, settings.retry_after)
+
+
+@lru_cache
+def get_reclaimer():
+    settings = get_settings()
+    return retention.Reclaimer(settings.app_path, settings.reclaim_rate, settings.retention_interval,
+                               settings.retention_keep_last, settings.retention_keep_days,
+                               get_object_store(settings), settings.upload_session_timeout)
+
+
+@lru_cache
+def get_keyring():
+    settings = get_settings()
+    return Keyring(settings.api_key, settings.api_keys_file, settings.api_keys_reload_interval)
+
+
+@lru_cache
+def get_sidecar_pool():
+    # Compression is CPU bound, so it runs in processes; forkserver avoids forking the threads of this worker
+    return ProcessPoolExecutor(get_settings().sidecar_workers, mp_context=multiprocessing.get_context("forkserver"))
+
+
+def new_sidecar_writer(settings: Settings, enabled: bool) -> Optional[SidecarWriter]:
+    if not enabled:
+        return None
+    return SidecarWriter(get_sidecar_pool(), available_formats(settings.sidecar_formats), settings.sidecar_min_size)
+
+
+def archive_limits(settings: Settings) -> archive.ArchiveLimits:
+    return archive.ArchiveLimits(settings.max_archive_members, settings.max_extracted_size, settings.max_path_depth)
+
+
+app.add_middleware(APIKeyMiddleware, keyring=get_keyring)
+
+
 @app.exception_handler(500)
 async def internal_exception_handler(_request: Request, _e: Exception):
     return JSONResponse(status_code=500, content={"detail": "Internal Server Error"})
 
 
-@app.middleware("http")
-async def authorize_api_key(request: Request, call_next):
-    if request.url.path == "/health":
-        return await call_next(request)
-    authorization = request.headers.get("Authorization")
-    if not authorization:
-        return JSONResponse(status_code=401,
-                            content={"detail": "Unauthorized: Missing 'Authorization' header"})
-    if not authorization.startswith("APIKey "):
-        return JSONResponse(status_code=401,
-                            content={"detail": "Unauthorized: Malformed 'Authorization' header, should start with 'APIKey '"})
-    api_key = authorization[len("APIKey "):].strip()
-    if api_key != get_settings().api_key:
-        return JSONResponse(status_code=401,
-                            content={"detail": "Unauthorized: Invalid API key"})
-    response = await call_next(request)
-    return response
+@app.exception_handler(archive.ArchiveError)
+async def archive_exception_handler(_request: Request, e: archive.ArchiveError):
+    return JSONResponse(status_code=400, content={"detail": f"Bad Request: {e.message}"})
+
+
+@app.exception_handler(PoolSaturatedError)
+async def pool_saturated_exception_handler(_request: Request, e: PoolSaturatedError):
+    return JSONResponse(status_code=503, headers={"Retry-After": str(e.retry_after)},
+                        content={"detail": f"Service Unavailable: Too many pending {e.name} tasks, retry later"})
 
 
 @app.get("/health")
@@ -47,67 +138,570 @@ async def health():
     return {"healthy": True}
 
 
+@app.get("/stats")
+async def stats():
+    return {"pools": {pool.name: pool.stats() for pool in [get_extraction_pool(), get_filesystem_pool()]},
+            "reclaimer": get_reclaimer().stats(), "api_keys": get_keyring().stats()}
+
+
+def build_deployment(project_path: ProjectPath, deployment_id: str, upload: UploadFile,
+                     upload_checksum: Optional[str], delta_manifest: Optional[UploadFile],
+                     base_deployment_id: Optional[str], dictionary_id: Optional[int], settings: Settings,
+                     store: Optional[ObjectStore], sidecars: Optional[SidecarWriter],
+                     timings: metrics.Timings) -> archive.ExtractResult:
+    buffer_size = settings.extract_buffer_size
+    zstd_dict = dictionary.load(project_path, dictionary_id)
+    with Staging(project_path, deployment_id) as staging:
+        try:
+            if delta_manifest is None:
+                result = archive.decompress(upload.file, staging.path, buffer_size, store, zstd_dict, sidecars, timings,
+                                            archive_limits(settings))
+                archive.verify_checksum(result, upload_checksum)
+            else:
+                try:
+                    entries = json.load(delta_manifest.file)["files"]
+                except (ValueError, KeyError, TypeError):
+                    raise archive.ArchiveError("Malformed manifest")
+                delta_path = project_path.delta(deployment_id)
+                try:
+                    delta = archive.decompress(upload.file, delta_path, buffer_size, store, zstd_dict, None, timings,
+                                               archive_limits(settings))
+                    archive.verify_checksum(delta, upload_checksum)
+                    with timings.stage("assemble"):
+                        sources = manifest.base_sources(project_path, base_deployment_id)
+                        result = manifest.assemble(entries, staging.path, delta, delta_path, sources, store, sidecars,
+                                                   archive_limits(settings))
+                    result.timings = timings
+                    result.checksum, result.verified_files = delta.checksum, delta.verified_files
+                finally:
+                    with timings.stage("rmtree"):
+                        shutil.rmtree(delta_path, ignore_errors=True)
+            if sidecars is not None:
+                with timings.stage("sidecars"):
+                    result.sidecars = sidecars.wait()
+        except BaseException:
+            if sidecars is not None:
+                sidecars.cancel()
+            raise
+        with timings.stage("sync"):
+            staging.publish(result.manifest(), settings.durability, settings.fsync_batch_size)
+    manifest.write_manifest(project_path.manifest(deployment_id), result.manifest())
+    manifest.write_checksums(project_path.checksums(deployment_id), result.checksums())
+    return result
+
+
+def build_chunked_deployment(project_path: ProjectPath, deployment_id: str, reader: ChunkReader,
+                             dictionary_id: Optional[int], settings: Settings,
+                             store: Optional[ObjectStore], sidecars: Optional[SidecarWriter]) -> Tuple[archive.ExtractResult, list]:
+    timings = metrics.Timings()
+    with Staging(project_path, deployment_id) as staging, metrics.uploads_in_flight.track(project=project_path.project_name):
+        try:
+            with reader:
+                result = archive.decompress(reader, staging.path, settings.extract_buffer_size, store,
+                                            dictionary.load(project_path, dictionary_id), sidecars, timings,
+                                            archive_limits(settings))
+            # The reader only ends once finalize has been received, and with it the checksum of the whole upload
+            if reader.changed():
+                raise ChunksChangedError()
+            archive.verify_checksum(result, reader.session.checksum())
+            if sidecars is not None:
+                with timings.stage("sidecars"):
+                    result.sidecars = sidecars.wait()
+        except BaseException:
+            if sidecars is not None:
+                sidecars.cancel()
+            raise
+        # A previous extraction of the same upload is replaced when it had to be restarted
+        with timings.stage("rmtree"):
+            shutil.rmtree(project_path.deployment(deployment_id), ignore_errors=True)
+        with timings.stage("sync"):
+            staging.publish(result.manifest(), settings.durability, settings.fsync_batch_size)
+    manifest.write_manifest(project_path.manifest(deployment_id), result.manifest())
+    manifest.write_checksums(project_path.checksums(deployment_id), result.checksums())
+    return result, reader.consumed
+
+
+def clone_deployment(source_path: ProjectPath, source_id: str, project_path: ProjectPath, deployment_id: str,
+                     settings: Settings) -> Tuple[archive.ExtractResult, dict]:
+    timings = metrics.Timings()
+    cloner = Cloner(settings.clone_workers)
+    try:
+        entries = list(manifest.read_manifest(source_path.manifest(source_id)))
+    except FileNotFoundError:
+        # Deployments created before manifests were recorded are cloned without one
+        entries = None
+    with Staging(project_path, deployment_id) as staging:
+        with timings.stage("clone"):
+            try:
+                cloner.clone_tree(source_path.deployment(source_id), staging.path)
+            except FileNotFoundError:
+                raise CloneError(f"Deployment {source_id} was deleted while it was being cloned", 409)
+        with timings.stage("sync"):
+            staging.publish(entries or [], settings.durability, settings.fsync_batch_size)
+    result = cloner.result()
+    result.timings = timings
+    if entries is not None:
+        manifest.write_manifest(project_path.manifest(deployment_id), entries)
+        # Pre-compressed sidecars are cloned too, but only the files of the site are counted
+        files = [entry for entry in entries if entry["type"] == "file"]
+        result.files, result.extracted_size = len(files), sum(entry["size"] for entry in files)
+    return result, cloner.counts
+
+
+def publish_deployment(project_path: ProjectPath, deployment_id: str, commit_hash: Optional[str],
+                       result: archive.ExtractResult) -> dict:
+    with result.timings.stage("symlink"), ProjectLock(project_path):
+        if commit_hash:
+            os.makedirs(project_path.commits_path, exist_ok=True)
+            atomic_symlink(f"../deployments/{deployment_id}/", project_path.commit_symlink(commit_hash))
+        ProjectIndex(project_path).add_deployment(deployment_id, int(time.time()), commit_hash)
+    project_name = project_path.project_name
+    metrics.observe(project_name, result.timings)
+    metrics.received_bytes.inc(result.upload_size, project=project_name)
+    metrics.extracted_bytes.inc(result.extracted_size, project=project_name)
+    metrics.files_written.inc(result.files - result.deduplicated_files, project=project_name)
+    metrics.deployments_created.inc(project=project_name, outcome="published")
+    return {"name": project_path.project_name, "deployment_id": deployment_id, "commit_hash": commit_hash,
+            "upload_size": result.upload_size, "extracted_size": result.extracted_size,
+            "files": result.files, "deduplicated_files": result.deduplicated_files,
+            "deduplicated_size": result.deduplicated_size, "sidecars": result.sidecars,
+            "checksums": result.checksums(), "timings": result.timings.as_dict()}
+
+
+def remove_deployment(project_path: ProjectPath, deployment_id: str) -> None:
+    with ProjectLock(project_path):
+        retention.move_to_trash(project_path, deployment_id)
+    get_reclaimer().wake()
+
+
+def remove_commit(project_path: ProjectPath, commit_hash: str) -> None:
+    commit_symlink = project_path.commit_symlink(commit_hash)
+    deployment_id = os.path.basename(os.readlink(commit_symlink).rstrip("/"))
+    try:
+        remove_deployment(project_path, deployment_id)
+    except FileNotFoundError:
+        pass
+    with ProjectLock(project_path):
+        os.unlink(commit_symlink)
+        ProjectIndex(project_path).remove_commit(commit_hash, deployment_id)
+
+
+def remove_deployments(project_path: ProjectPath, deployment_ids: list) -> Tuple[list, list]:
+    removed, missing = [], []
+    with ProjectLock(project_path):
+        for deployment_id in dict.fromkeys(deployment_ids):
+            try:
+                retention.move_to_trash(project_path, deployment_id)
+                removed.append(deployment_id)
+            except FileNotFoundError:
+                missing.append(deployment_id)
+    if removed:
+        get_reclaimer().wake()
+    return removed, missing
+
+
+def remove_commits(project_path: ProjectPath, commit_hashes: list) -> Tuple[list, list]:
+    removed, missing = [], []
+    with ProjectLock(project_path):
+        for commit_hash in dict.fromkeys(commit_hashes):
+            commit_symlink = project_path.commit_symlink(commit_hash)
+            try:
+                deployment_id = os.path.basename(os.readlink(commit_symlink).rstrip("/"))
+            except FileNotFoundError:
+                missing.append(commit_hash)
+                continue
+            try:
+                retention.move_to_trash(project_path, deployment_id)
+            except FileNotFoundError:
+                pass
+            os.unlink(commit_symlink)
+            ProjectIndex(project_path).remove_commit(commit_hash, deployment_id)
+            removed.append(commit_hash)
+    if removed:
+        get_reclaimer().wake()
+    return removed, missing
+
+
+def switch_deployment(project_path: ProjectPath, deployment_id: str) -> Optional[float]:
+    started_at = time.perf_counter()
+    with ProjectLock(project_path):
+        if not os.path.isdir(project_path.deployment(deployment_id)):
+            return None
+        atomic_symlink(f"deployments/{deployment_id}/", project_path.current_symlink)
+        ProjectIndex(project_path).set_current(deployment_id)
+    elapsed = time.perf_counter() - started_at
+    metrics.stage_seconds.observe(elapsed, project=project_path.project_name, stage="switch")
+    return elapsed
+
+
+def open_manifest(project_path: ProjectPath, deployment_id: str) -> TextIO:
+    try:
+        return open(project_path.manifest(deployment_id))
+    except FileNotFoundError:
+        if os.path.isdir(project_path.deployment(deployment_id)):
+            # Deployments created before manifests were recorded
+            raise HTTPException(status_code=404, detail=f"Deployment {deployment_id} has no manifest")
+        raise HTTPException(status_code=404, detail=f"Deployment {deployment_id} not found")
+
+
+def check_batch_size(settings: Settings, items: list) -> None:
+    if len(items) > settings.max_batch_size:
+        raise HTTPException(status_code=400, detail=f"Bad Request: At most {settings.max_batch_size} items per batch")
+
+
+class ProjectDeployment(BaseModel):
+    name: str = Field(**schema.ProjectName)
+    deployment_id: str = Field(**schema.DeploymentId)
+
+
+@app.get("/metrics")
+async def export_metrics():
+    return PlainTextResponse(metrics.registry.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/storage")
+async def storage_stats(
+    store: Annotated[Optional[ObjectStore], Depends(get_object_store)],
+):
+    if store is None:
+        return JSONResponse(status_code=404, content={"detail": "Object store is not enabled"})
+    return await get_filesystem_pool().run(store.stats)
+
+
+@app.get("/projects/{project_name}/storage")
+async def project_storage_stats(
+    project_name: Annotated[str, Path(**schema.ProjectName)],
+    settings: Annotated[Settings, Depends(get_settings)],
+):
+    project_path = ProjectPath(settings.app_path, project_name)
+    return {"name": project_name, **await get_filesystem_pool().run(tree_stats, project_path.deployments_path)}
+
+
 @app.get("/projects/{project_name}/deployments")
 async def list_deployments(
     project_name: Annotated[str, Path(**schema.ProjectName)],
     settings: Annotated[Settings, Depends(get_settings)],
+    limit: Annotated[int | None, Query(ge=1)] = None,
+    after: Annotated[str | None, Query(**schema.DeploymentId)] = None,
 ):
     project_path = ProjectPath(settings.app_path, project_name)
-    try:
-        deployments = os.listdir(project_path.deployments_path)
-        deployments = [x for x in deployments if (not x.startswith(".")) and len(x) == schema.DeploymentId['min_length']]
-        deployments = sorted(deployments, reverse=True)
-        deployments = [{
-            "deployment_id": x,
-            "created_at": int(os.path.getctime(project_path.deployment(x))),
-        } for x in deployments]
-    except FileNotFoundError:
-        deployments = []
-    finally:
-        return {"name": project_name, "deployments": deployments[:settings.max_deployments]}
+    limit = min(limit or settings.max_deployments, settings.max_deployments)
+    project_index = ProjectIndex(project_path)
+    deployments, cursor = await get_filesystem_pool().run(project_index.deployments, limit, after)
+    current = await get_filesystem_pool().run(project_index.current)
+    return {"name": project_name, "current": current, "deployments": deployments, "next": cursor}
 
 
 @app.post("/projects/{project_name}/deployments")
 async def create_deployment(
+    request: Request,
     project_name: Annotated[str, Path(**schema.ProjectName)],
     settings: Annotated[Settings, Depends(get_settings)],
+    store: Annotated[Optional[ObjectStore], Depends(get_object_store)],
     upload: UploadFile,
+    delta_manifest: Optional[UploadFile] = None,
+    upload_checksum: Annotated[str | None, Form(**schema.ContentHash)] = None,
     commit_hash: Annotated[str | None, Query(**schema.CommitHash)] = None,
+    base_deployment_id: Annotated[str | None, Query(**schema.DeploymentId)] = None,
+    dictionary_id: Annotated[int | None, Query(ge=1)] = None,
+    sidecars: bool = False,
 ):
     project_path = ProjectPath(settings.app_path, project_name)
     deployment_id = schema.generate_deployment_id()
-    deployment_path = project_path.deployment(deployment_id)
-    zstd_size, tar_size = archive.decompress(upload, deployment_path)
+    # The multipart body has been received and spooled before the handler runs
+    timings = metrics.Timings()
+    timings.add("receive", time.perf_counter() - request.state.started_at)
+    try:
+        with metrics.uploads_in_flight.track(project=project_name):
+            result = await get_extraction_pool().run(
+                build_deployment, project_path, deployment_id, upload, upload_checksum, delta_manifest,
+                base_deployment_id, dictionary_id, settings, store, new_sidecar_writer(settings, sidecars), timings)
+    except archive.ArchiveError:
+        metrics.deployments_created.inc(project=project_name, outcome="rejected")
+        raise
+    return await get_filesystem_pool().run(publish_deployment, project_path, deployment_id, commit_hash, result)
 
-    if commit_hash:
-        commit_symlink = project_path.commit_symlink(commit_hash)
-        if os.path.exists(commit_symlink):
-            os.unlink(commit_symlink)
-        os.makedirs(project_path.commits_path, exist_ok=True)
-        os.symlink(f"../deployments/{deployment_id}/", commit_symlink, target_is_directory=True)
-    return {"name": project_name, "deployment_id": deployment_id, "commit_hash": commit_hash,
-            "upload_size": zstd_size, "extracted_size": tar_size}
+
+@app.post("/projects/{project_name}/deployments/clone")
+async def create_clone(
+    request: Request,
+    project_name: Annotated[str, Path(**schema.ProjectName)],
+    settings: Annotated[Settings, Depends(get_settings)],
+    from_project: Annotated[str, Query(**schema.ProjectName)],
+    deployment_id: Annotated[str | None, Query(**schema.DeploymentId)] = None,
+    commit_hash: Annotated[str | None, Query(**schema.CommitHash)] = None,
+    switch: bool = False,
+):
+    if not allows(request.state.api_key_scopes, from_project):
+        return JSONResponse(status_code=403,
+                            content={"detail": f"Forbidden: API key is not allowed to access {from_project}"})
+    source_path = ProjectPath(settings.app_path, from_project)
+    project_path = ProjectPath(settings.app_path, project_name)
+    new_deployment_id = schema.generate_deployment_id()
+    try:
+        source_id = await get_filesystem_pool().run(resolve, source_path, deployment_id, commit_hash)
+        result, methods = await get_extraction_pool().run(
+            clone_deployment, source_path, source_id, project_path, new_deployment_id, settings)
+    except CloneError as e:
+        return JSONResponse(status_code=e.status_code, content={"detail": e.message})
+    # The clone keeps the commit it was looked up by, so the commit can be promoted again from this project
+    response = await get_filesystem_pool().run(publish_deployment, project_path, new_deployment_id, commit_hash, result)
+    response.update({"from_project": from_project, "from_deployment_id": source_id, "clone": methods})
+    if switch and (elapsed := await get_filesystem_pool().run(switch_deployment, project_path, new_deployment_id)):
+        response["timings"]["switch"] = round(elapsed, 6)
+    return response
+
+
+@app.get("/projects/{project_name}/deployments/{deployment_id}/manifest")
+async def get_manifest(
+    project_name: Annotated[str, Path(**schema.ProjectName)],
+    settings: Annotated[Settings, Depends(get_settings)],
+    deployment_id: Annotated[str, Path(**schema.DeploymentId)],
+):
+    project_path = ProjectPath(settings.app_path, project_name)
+    f = await get_filesystem_pool().run(open_manifest, project_path, deployment_id)
+    # The stored manifest is already NDJSON, it is sent as is
+    return StreamingResponse(manifest.read_chunks(f), media_type="application/x-ndjson")
+
+
+@app.get("/projects/{project_name}/deployments/{deployment_id}/diff/{other_deployment_id}")
+async def diff_deployments(
+    project_name: Annotated[str, Path(**schema.ProjectName)],
+    settings: Annotated[Settings, Depends(get_settings)],
+    deployment_id: Annotated[str, Path(**schema.DeploymentId)],
+    other_deployment_id: Annotated[str, Path(**schema.DeploymentId)],
+):
+    project_path = ProjectPath(settings.app_path, project_name)
+    before = await get_filesystem_pool().run(open_manifest, project_path, deployment_id)
+    try:
+        after = await get_filesystem_pool().run(open_manifest, project_path, other_deployment_id)
+    except HTTPException:
+        before.close()
+        raise
+    # Only the manifests are compared, file contents are never read; the last line holds the counts
+    entries = manifest.diff_manifests(manifest.read_lines(before), manifest.read_lines(after))
+    return StreamingResponse(manifest.ndjson(entries), media_type="application/x-ndjson")
+
+
+@app.post("/projects/{project_name}/deployments/negotiate")
+async def negotiate_deployment(
+    project_name: Annotated[str, Path(**schema.ProjectName)],
+    settings: Annotated[Settings, Depends(get_settings)],
+    store: Annotated[Optional[ObjectStore], Depends(get_object_store)],
+    files: Annotated[list[dict], Body(embed=True)],
+):
+    project_path = ProjectPath(settings.app_path, project_name)
+
+    def negotiate():
+        base_deployment_id = manifest.find_base(project_path)
+        known = manifest.base_sources(project_path, base_deployment_id)
+        return {"name": project_name, "base_deployment_id": base_deployment_id,
+                "missing": manifest.missing_hashes(files, known, store)}
+
+    return await get_filesystem_pool().run(negotiate)
+
+
+def get_upload_session(
+    project_name: Annotated[str, Path(**schema.ProjectName)],
+    upload_id: Annotated[str, Path(**schema.UploadId)],
+    settings: Annotated[Settings, Depends(get_settings)],
+) -> UploadSession:
+    session = UploadSession(ProjectPath(settings.app_path, project_name), upload_id)
+    if not os.path.exists(session.session_file):
+        raise HTTPException(status_code=404, detail="Upload session not found")
+    if session.expired(settings.upload_session_timeout):
+        raise HTTPException(status_code=410, detail="Upload session expired")
+    return session
+
+
+def run_chunked_upload(project_path: ProjectPath, session: UploadSession, settings: Settings,
+                       store: Optional[ObjectStore]) -> dict:
+    # Runs on the session's own thread, from its first chunk until the deployment is published
+    manager = get_upload_manager()
+    metadata = session.metadata()
+    deadline = session.deadline(settings.upload_session_timeout)
+    for attempt in range(2):
+        reader = ChunkReader(session, get_extraction_pool().slot, deadline, manager.condition(session.upload_id),
+                             manager.draining)
+        try:
+            result, _ = build_chunked_deployment(
+                project_path, metadata["deployment_id"], reader, metadata.get("dictionary_id"), settings, store,
+                new_sidecar_writer(settings, metadata.get("sidecars", False)))
+            response = publish_deployment(project_path, metadata["deployment_id"], metadata["commit_hash"], result)
+        except ChunksChangedError:
+            # Every chunk is on disk once finalize has been received, the second pass reads the final ones
+            if attempt:
+                raise
+            continue
+        finally:
+            reader.release()
+        # Kept in the session, so finalize gets it from whichever worker it reaches and a repeated one gets it again
+        session.write_result(response)
+        return response
+
+
+def start_chunked_upload(project_path: ProjectPath, session: UploadSession, settings: Settings,
+                         store: Optional[ObjectStore]) -> Optional[Future]:
+    return get_upload_manager().start(session, lambda: run_chunked_upload(project_path, session, settings, store))
+
+
+@app.post("/projects/{project_name}/uploads")
+async def create_upload(
+    project_name: Annotated[str, Path(**schema.ProjectName)],
+    settings: Annotated[Settings, Depends(get_settings)],
+    store: Annotated[Optional[ObjectStore], Depends(get_object_store)],
+    commit_hash: Annotated[str | None, Query(**schema.CommitHash)] = None,
+    chunk_size: Annotated[int | None, Query(gt=0)] = None,
+    dictionary_id: Annotated[int | None, Query(ge=1)] = None,
+    sidecars: bool = False,
+    level: Annotated[int | None, Query(ge=1, le=22)] = None,
+    long_distance: bool = False,
+):
+    project_path = ProjectPath(settings.app_path, project_name)
+    session = UploadSession(project_path, generate_upload_id())
+    chunk_size = min(chunk_size or settings.upload_chunk_size, settings.max_upload_chunk_size)
+    metadata = await get_filesystem_pool().run(
+        session.create, schema.generate_deployment_id(), commit_hash, chunk_size, dictionary_id, sidecars, level,
+        long_distance)
+    return {"name": project_name, **metadata, "expires_at": metadata["created_at"] + settings.upload_session_timeout}
+
+
+@app.get("/projects/{project_name}/uploads/{upload_id}")
+async def get_upload(
+    project_name: Annotated[str, Path(**schema.ProjectName)],
+    session: Annotated[UploadSession, Depends(get_upload_session)],
+):
+    def describe():
+        return {"name": project_name, **session.metadata(), "finalized": session.total() is not None,
+                "chunks": session.chunks()}
+
+    return await get_filesystem_pool().run(describe)
+
+
+@app.put("/projects/{project_name}/uploads/{upload_id}/chunks/{index}")
+async def put_upload_chunk(
+    request: Request,
+    project_name: Annotated[str, Path(**schema.ProjectName)],
+    settings: Annotated[Settings, Depends(get_settings)],
+    store: Annotated[Optional[ObjectStore], Depends(get_object_store)],
+    session: Annotated[UploadSession, Depends(get_upload_session)],
+    index: Annotated[int, Path(ge=0)],
+    checksum: Annotated[str, Query(**schema.ContentHash)],
+):
+    content_length = int(request.headers.get("Content-Length") or 0)
+    if content_length > settings.max_upload_chunk_size:
+        return JSONResponse(status_code=413, content={"detail": "Chunk is too large"})
+    # Without a Content-Length the size is only known while reading, so the body is never buffered past the limit
+    data = bytearray()
+    async for piece in request.stream():
+        data += piece
+        if len(data) > settings.max_upload_chunk_size:
+            return JSONResponse(status_code=413, content={"detail": "Chunk is too large"})
+    chunk = await get_filesystem_pool().run(session.write_chunk, index, bytes(data), checksum)
+    if index == 0:
+        # Extraction starts with the first chunk and follows the chunks as they arrive
+        await get_filesystem_pool().run(start_chunked_upload, ProjectPath(settings.app_path, project_name), session,
+                                        settings, store)
+    get_upload_manager().notify(session.upload_id)
+    return chunk
+
+
+@app.post("/projects/{project_name}/uploads/{upload_id}/finalize")
+async def finalize_upload(
+    project_name: Annotated[str, Path(**schema.ProjectName)],
+    settings: Annotated[Settings, Depends(get_settings)],
+    store: Annotated[Optional[ObjectStore], Depends(get_object_store)],
+    session: Annotated[UploadSession, Depends(get_upload_session)],
+    chunks: Annotated[int, Query(ge=1)],
+    checksum: Annotated[str | None, Query(**schema.ContentHash)] = None,
+):
+    project_path = ProjectPath(settings.app_path, project_name)
+    manager = get_upload_manager()
+    received = await get_filesystem_pool().run(session.chunks)
+    missing = sorted(set(range(chunks)) - {x["index"] for x in received})
+    if missing:
+        return JSONResponse(status_code=409, content={"detail": "Missing chunks", "missing": missing})
+    await get_filesystem_pool().run(session.finalize, chunks, checksum)
+    manager.notify(session.upload_id)
+
+    while (response := await get_filesystem_pool().run(session.result)) is None:
+        future = await get_filesystem_pool().run(start_chunked_upload, project_path, session, settings, store)
+        if future is not None:
+            # Only the chunks not yet extracted are left, unless the extraction is started here from the first one
+            await asyncio.wrap_future(future)
+        elif not os.path.exists(session.session_file):
+            raise HTTPException(status_code=404, detail="Upload session not found")
+        else:
+            # Another worker is extracting the session, it leaves the result in the session when done
+            await asyncio.sleep(0.5)
+    await get_filesystem_pool().run(session.remove)
+    return response
+
+
+@app.delete("/projects/{project_name}/uploads/{upload_id}")
+async def delete_upload(
+    project_name: Annotated[str, Path(**schema.ProjectName)],
+    session: Annotated[UploadSession, Depends(get_upload_session)],
+):
+    # An extraction still waiting for chunks notices the session is gone and stops
+    await get_filesystem_pool().run(session.remove)
+    get_upload_manager().notify(session.upload_id)
+    return {"name": project_name, "upload_id": session.upload_id}
+
+
+@app.post("/projects/{project_name}/dictionary")
+async def train_dictionary(
+    project_name: Annotated[str, Path(**schema.ProjectName)],
+    settings: Annotated[Settings, Depends(get_settings)],
+    dict_size: Annotated[int, Query(ge=1024, le=1024 * 1024)] = 112640,
+    deployment_id: Annotated[str | None, Query(**schema.DeploymentId)] = None,
+):
+    project_path = ProjectPath(settings.app_path, project_name)
+    if deployment_id is None:
+        try:
+            deployment_id = os.path.basename(os.readlink(project_path.current_symlink).rstrip("/"))
+        except FileNotFoundError:
+            return JSONResponse(status_code=404, content={"detail": "Project has no current deployment"})
+    if not os.path.isdir(project_path.deployment(deployment_id)):
+        return JSONResponse(status_code=404, content={"detail": "Deployment not found"})
+    dictionary_id, samples = await get_extraction_pool().run(
+        dictionary.train, project_path, deployment_id, dict_size, settings.dictionary_max_sample_size)
+    return {"name": project_name, "dictionary_id": dictionary_id, "deployment_id": deployment_id,
+            "dict_size": dict_size, "samples": samples}
+
+
+@app.get("/projects/{project_name}/dictionary")
+async def get_dictionary(
+    project_name: Annotated[str, Path(**schema.ProjectName)],
+    settings: Annotated[Settings, Depends(get_settings)],
+):
+    project_path = ProjectPath(settings.app_path, project_name)
+
+    def read_latest():
+        dictionary_id = dictionary.latest(project_path)
+        if dictionary_id is None:
+            return None
+        with open(project_path.dictionary(dictionary_id), "rb") as f:
+            return {"name": project_name, "dictionary_id": dictionary_id,
+                    "content": base64.b64encode(f.read()).decode()}
+
+    result = await get_filesystem_pool().run(read_latest)
+    if result is None:
+        return JSONResponse(status_code=404, content={"detail": "Dictionary not found"})
+    return result
 
 
 @app.get("/projects/{project_name}/commits")
 async def list_commits(
     project_name: Annotated[str, Path(**schema.ProjectName)],
     settings: Annotated[Settings, Depends(get_settings)],
+    limit: Annotated[int | None, Query(ge=1)] = None,
+    after: Annotated[str | None, Query(pattern="^[0-9]+$")] = None,
 ):
     project_path = ProjectPath(settings.app_path, project_name)
-    try:
-        commits = os.listdir(project_path.commits_path)
-        commits = [x for x in commits if (not x.startswith(".")) and len(x) == schema.CommitHash['min_length']]
-        commits = sorted(commits, key=lambda x: os.path.getmtime(project_path.commit_symlink(x)), reverse=True)
-        commits = [{
-            "commit_hash": x,
-            "deployment_id": os.path.basename(os.readlink(project_path.commit_symlink(x))),
-            "created_at": int(os.path.getctime(project_path.commit_symlink(x))),
-        } for x in commits]
-    except FileNotFoundError:
-        commits = []
-    finally:
-        return {"name": project_name, "commits": commits[:settings.max_deployments]}   
+    limit = min(limit or settings.max_deployments, settings.max_deployments)
+    commits, cursor = await get_filesystem_pool().run(ProjectIndex(project_path).commits, limit, after)
+    return {"name": project_name, "commits": commits, "next": cursor}
 
 
 @app.patch("/projects/{project_name}/current")
@@ -117,15 +711,82 @@ async def switch_current(
     deployment_id: Annotated[str, Query(**schema.DeploymentId)],
 ):
     project_path = ProjectPath(settings.app_path, project_name)
-    deployment_path = project_path.deployment(deployment_id)
-    if not os.path.exists(deployment_path):
+    elapsed = await get_filesystem_pool().run(switch_deployment, project_path, deployment_id)
+    if elapsed is None:
         return JSONResponse(status_code=404, content={"detail": "Deployment not found"})
+    return {"name": project_name, "deployment_id": deployment_id, "timings": {"switch": round(elapsed, 6)}}
+
+
+@app.patch("/current")
+async def switch_many(
+    request: Request,
+    settings: Annotated[Settings, Depends(get_settings)],
+    switches: Annotated[list[ProjectDeployment], Body(embed=True)],
+):
+    check_batch_size(settings, switches)
+    scopes = request.state.api_key_scopes
+
+    def switch_all():
+        # Projects are switched one after another, a failed project does not stop the others
+        switched, failed = [], []
+        for switch in switches:
+            item = {"name": switch.name, "deployment_id": switch.deployment_id}
+            if not allows(scopes, switch.name):
+                failed.append({**item, "detail": "API key is not allowed to access this project"})
+            elif (elapsed := switch_deployment(ProjectPath(settings.app_path, switch.name), switch.deployment_id)) is None:
+                failed.append({**item, "detail": "Deployment not found"})
+            else:
+                switched.append({**item, "timings": {"switch": round(elapsed, 6)}})
+        return {"switched": switched, "failed": failed}
+
+    return await get_filesystem_pool().run(switch_all)
+
+
+@app.post("/releases")
+async def create_release(
+    request: Request,
+    settings: Annotated[Settings, Depends(get_settings)],
+    deployments: Annotated[list[ProjectDeployment], Body(embed=True, min_length=1)],
+):
+    check_batch_size(settings, deployments)
+    denied = [x.name for x in deployments if not allows(request.state.api_key_scopes, x.name)]
+    if denied:
+        return JSONResponse(status_code=403,
+                            content={"detail": f"Forbidden: API key is not allowed to access {', '.join(denied)}"})
     try:
-        os.unlink(project_path.current_symlink)
-    except FileNotFoundError:
-        pass
-    os.symlink(f"deployments/{deployment_id}/", project_path.current_symlink, target_is_directory=True)
-    return {"name": project_name, "deployment_id": deployment_id}
+        result = await get_filesystem_pool().run(
+            release, settings.app_path, [(x.name, x.deployment_id) for x in deployments])
+    except ReleaseError as e:
+        content = {"detail": e.message}
+        if e.rollback_failed:
+            content["rollback_failed"] = e.rollback_failed
+        return JSONResponse(status_code=e.status_code, content=content)
+    metrics.release_skew_seconds.observe(result["skew"])
+    return result
+
+
+@app.post("/projects/{project_name}/deployments/delete")
+async def delete_deployments(
+    project_name: Annotated[str, Path(**schema.ProjectName)],
+    settings: Annotated[Settings, Depends(get_settings)],
+    deployment_ids: Annotated[list[Annotated[str, Field(**schema.DeploymentId)]], Body(embed=True)],
+):
+    check_batch_size(settings, deployment_ids)
+    project_path = ProjectPath(settings.app_path, project_name)
+    removed, missing = await get_filesystem_pool().run(remove_deployments, project_path, deployment_ids)
+    return {"name": project_name, "deleted": removed, "not_found": missing}
+
+
+@app.post("/projects/{project_name}/commits/delete")
+async def delete_commits(
+    project_name: Annotated[str, Path(**schema.ProjectName)],
+    settings: Annotated[Settings, Depends(get_settings)],
+    commit_hashes: Annotated[list[Annotated[str, Field(**schema.CommitHash)]], Body(embed=True)],
+):
+    check_batch_size(settings, commit_hashes)
+    project_path = ProjectPath(settings.app_path, project_name)
+    removed, missing = await get_filesystem_pool().run(remove_commits, project_path, commit_hashes)
+    return {"name": project_name, "deleted": removed, "not_found": missing}
 
 
 @app.delete("/projects/{project_name}/deployments/{deployment_id}")
@@ -135,9 +796,8 @@ async def delete_deployment(
     deployment_id: Annotated[str, Path(**schema.DeploymentId)],
 ):
     project_path = ProjectPath(settings.app_path, project_name)
-    deployment_path = project_path.deployment(deployment_id)
     try:
-        shutil.rmtree(deployment_path, ignore_errors=True)
+        await get_filesystem_pool().run(remove_deployment, project_path, deployment_id)
         return {"name": project_name, "deployment_id": deployment_id}
     except FileNotFoundError:
         return JSONResponse(status_code=404, content={"detail": "Deployment not found"})
@@ -150,12 +810,26 @@ async def delete_commit(
     commit_hash: Annotated[str, Path(**schema.CommitHash)],
 ):
     project_path = ProjectPath(settings.app_path, project_name)
-    commit_symlink = project_path.commit_symlink(commit_hash)
-    deployment_path = os.readlink(commit_symlink)
     try:
-        if os.path.exists(deployment_path):
-            shutil.rmtree(deployment_path, ignore_errors=True)
-        os.unlink(commit_symlink)
+        await get_filesystem_pool().run(remove_commit, project_path, commit_hash)
         return {"name": project_name, "commit_hash": commit_hash}
     except FileNotFoundError:
         return JSONResponse(status_code=404, content={"detail": "Commit not found"})
+
+
+@app.post("/projects/{project_name}/gc")
+async def collect_deployments(
+    project_name: Annotated[str, Path(**schema.ProjectName)],
+    settings: Annotated[Settings, Depends(get_settings)],
+    keep_last: Annotated[int | None, Query(ge=0)] = None,
+    keep_days: Annotated[int | None, Query(ge=0)] = None,
+    dry_run: bool = False,
+):
+    project_path = ProjectPath(settings.app_path, project_name)
+    keep_last = settings.retention_keep_last if keep_last is None else keep_last
+    keep_days = settings.retention_keep_days if keep_days is None else keep_days
+    result = await get_filesystem_pool().run(
+        retention.apply, project_path, keep_last, keep_days, settings.object_store, dry_run)
+    if not dry_run:
+        get_reclaimer().wake()
+    return result
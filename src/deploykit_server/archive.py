@@ -1,55 +1,287 @@
 import io
 import os
 import tarfile
-from typing import Optional, Sequence, Tuple
-from fastapi import UploadFile
-from zstandard import ZstdDecompressor
+import posixpath
+from typing import BinaryIO, Iterable, Iterator, Optional, Tuple
+from zstandard import ZstdCompressionDict, ZstdDecompressor, ZstdError
 
+from deploykit_server.metrics import Timings
+from deploykit_server.sidecar import SidecarWriter
+from deploykit_server.store import ObjectStore, new_hash
 
-def is_path_safe(path: str, linkname: Optional[str] = None) -> bool:
-    if (linkname is not None) and (not is_path_safe(linkname)):
-        return False
-    if os.path.isabs(path):
+
+# PAX keyword the client stores each file's content hash under
+CHECKSUM_HEADER = "DEPLOYKIT.blake2b"
+
+
+class ArchiveError(Exception):
+    def __init__(self, message: str):
+        self.message = message
+        super().__init__(self.message)
+
+
+class ArchiveLimits:
+    # Zero disables a limit
+    def __init__(self, members: int = 0, size: int = 0, depth: int = 0):
+        self.members = members
+        self.size = size
+        self.depth = depth
+
+
+def normalize_path(path: str) -> Optional[str]:
+    # Names written by tar are usually normal already, only the others are split and rebuilt
+    if (path and path != "." and ".." not in path and "//" not in path and "/./" not in path
+            and not path.startswith(("/", "./")) and not path.endswith(("/", "/."))):
+        return path
+    if not path or path.startswith("/"):
+        return None
+    components = [x for x in path.split("/") if x and x != "."]
+    # Member names never need "..", so any name containing it is refused rather than resolved
+    if not components or ".." in components:
+        return None
+    return "/".join(components)
+
+
+class MemberValidator:
+    # Members are checked one by one as the archive streams past, nothing has to be collected up front
+    def __init__(self, limits: Optional[ArchiveLimits] = None):
+        self.limits = limits or ArchiveLimits()
+        self.members = 0
+        self.size = 0
+        self.symlinks = set()
+        # Every directory above a symlink, none of them may be replaced by a file or declared again
+        self.symlink_parents = set()
+        self.directories = {""}
+
+    def check_limits(self, member: tarfile.TarInfo, path: Optional[str]) -> None:
+        if self.limits.members and self.members > self.limits.members:
+            raise ArchiveError(f"Archive has more than {self.limits.members} members")
+        if self.limits.depth and path and path.count("/") + 1 > self.limits.depth:
+            raise ArchiveError(f"'{member.name}' is deeper than {self.limits.depth} directories")
+        if self.limits.size and self.size > self.limits.size:
+            raise ArchiveError(f"Archive extracts to more than {self.limits.size} bytes")
+
+    def under_symlink(self, path: str) -> bool:
+        # Nothing may be created beneath a symlink from the archive, so a path resolves on disk as it reads;
+        # parents are walked up only until a directory already known to be free of symlinks
+        parent, checked = path.rpartition("/")[0], []
+        while True:
+            # A path that has been a symlink once never counts as a directory again
+            if parent in self.symlinks:
+                return True
+            if parent in self.directories:
+                break
+            checked.append(parent)
+            parent = parent.rpartition("/")[0]
+        self.directories.update(checked)
         return False
-    for char in ["/", "..", os.sep]:
-        if path.startswith(char):
-            return False
-    return True
 
+    def symlink_target(self, path: str, linkname: str) -> Optional[str]:
+        # Relative to the link's directory, "../" may only lead and may not climb out of the archive root
+        if not linkname or linkname.startswith("/"):
+            return None
+        parts = [x for x in linkname.split("/") if x and x != "."]
+        climb = 0
+        while climb < len(parts) and parts[climb] == "..":
+            climb += 1
+        if ".." in parts[climb:] or climb > path.count("/"):
+            return None
+        return "/".join(parts) or "."
 
-def safe_filter(members: Sequence[tarfile.TarInfo], destnation: str) -> Sequence[tarfile.TarInfo]:
-    result = []
-    for member in members:
-        if member.ischr() or member.isblk() or member.isfifo() or member.isdev():
-            continue
-        if not is_path_safe(member.name, getattr(member, "linkname", None)):
-            continue
-        if member.issym() or member.islnk():
-            link_abspath = os.path.abspath(os.path.join(destnation, member.linkname))
-            dest_abspath = os.path.abspath(destnation)
-            if not link_abspath.startswith(dest_abspath):
-                continue
+    def validate(self, member: tarfile.TarInfo) -> Optional[tarfile.TarInfo]:
+        self.members += 1
+        if member.isfile():
+            self.size += member.size
+        path = normalize_path(member.name)
+        self.check_limits(member, path)
+        if not (member.isfile() or member.isdir() or member.issym() or member.islnk()):
+            return None
+        if path is None or self.under_symlink(path):
+            return None
+        if member.issym():
+            if path in self.directories:
+                return None
+            linkname = self.symlink_target(path, member.linkname)
+            if linkname is None:
+                return None
+            member.linkname = linkname
+            self.symlinks.add(path)
+            parent = path.rpartition("/")[0]
+            while parent and parent not in self.symlink_parents:
+                self.symlink_parents.add(parent)
+                parent = parent.rpartition("/")[0]
+        elif path in self.symlinks or path in self.symlink_parents:
+            # Re-declaring a symlink as a directory would let later members be written through it
+            return None
+        elif member.islnk():
+            # Hard link names are relative to the archive root, and os.link would follow a symlink
+            linkname = normalize_path(member.linkname)
+            if linkname is None or linkname in self.symlinks or self.under_symlink(linkname):
+                return None
+            member.linkname = linkname
+        elif member.isdir():
+            self.directories.add(path)
 
+        member.name = path
         if member.isdir() or member.issym():
             member.mode = 0o755
         else:
             member.mode = 0o644
         member.gid = member.uid = member.uname = member.gname = None
-        result.append(member)
-    return result
+        return member
+
+
+def safe_filter(members: Iterable[tarfile.TarInfo], limits: Optional[ArchiveLimits] = None) -> Iterator[tarfile.TarInfo]:
+    validator = MemberValidator(limits)
+    for member in members:
+        member = validator.validate(member)
+        if member is not None:
+            yield member
+
 
+class CountingReader(io.RawIOBase):
+    def __init__(self, source: BinaryIO, timings: Optional[Timings] = None, stage: str = "receive", limit: int = 0,
+                 hasher=None):
+        self.source = source
+        self.timings = timings or Timings()
+        self.stage = stage
+        self.limit = limit
+        self.hasher = hasher
+        self.size = 0
 
-def decompress(upload: UploadFile, destnation: str) -> Tuple[int, int]:
-    zstd_stream = upload.file
-    zstd_size = upload.size
-    with io.BytesIO() as tar_stream:
-        decompressor = ZstdDecompressor()
-        decompressor.copy_stream(zstd_stream, tar_stream)
-        tar_size = tar_stream.tell()
-        tar_stream.seek(0)
-        with tarfile.open(fileobj=tar_stream) as tar_file:
-            members = tar_file.getmembers()
-            members = safe_filter(members, destnation)
-            for member in members:
-                tar_file.extract(member, destnation)
-    return zstd_size, tar_size
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        with self.timings.stage(self.stage):
+            data = self.source.read(len(buffer))
+        buffer[:len(data)] = data
+        self.size += len(data)
+        if self.hasher is not None:
+            self.hasher.update(data)
+        if self.limit and self.size > self.limit:
+            raise ArchiveError(f"Archive extracts to more than {self.limit} bytes")
+        return len(data)
+
+
+class ExtractResult:
+    def __init__(self, upload_size: int = 0):
+        self.upload_size = upload_size
+        self.extracted_size = 0
+        self.files = 0
+        self.deduplicated_files = 0
+        self.deduplicated_size = 0
+        self.sidecars = None
+        self.timings = Timings()
+        self.entries = {}
+        self.checksum = None
+        self.verified_files = 0
+
+    def manifest(self) -> list:
+        return [self.entries[path] for path in sorted(self.entries)]
+
+    def checksums(self) -> dict:
+        return {"algorithm": "blake2b-256", "upload": self.checksum, "upload_size": self.upload_size,
+                "verified_files": self.verified_files}
+
+
+def verify_checksum(result: ExtractResult, expected: Optional[str]) -> None:
+    # Only known once the whole upload has been read, and checked before the deployment is published
+    if expected is not None and expected != result.checksum:
+        raise ArchiveError("Upload does not match its checksum, it was truncated or corrupted in transit")
+
+
+def member_path(member: tarfile.TarInfo) -> str:
+    return posixpath.normpath(member.name)
+
+
+def write_file(source: BinaryIO, target: str, buffer_size: int, mtime: Optional[float] = None) -> Tuple[str, int]:
+    if os.path.lexists(target):
+        os.unlink(target)
+    hasher, size = new_hash(), 0
+    with open(target, "wb") as f:
+        while chunk := source.read(buffer_size):
+            hasher.update(chunk)
+            f.write(chunk)
+            size += len(chunk)
+    os.chmod(target, 0o644)
+    if mtime is not None:
+        os.utime(target, (mtime, mtime))
+    return hasher.hexdigest(), size
+
+
+def extract_member(tar_file: tarfile.TarFile, member: tarfile.TarInfo, destnation: str,
+                   buffer_size: int, store: Optional[ObjectStore], result: ExtractResult,
+                   sidecars: Optional[SidecarWriter] = None) -> None:
+    path = member_path(member)
+    if not member.isfile():
+        tar_file.extract(member, destnation)
+        if member.isdir():
+            result.entries[path] = {"path": path, "type": "dir", "mode": member.mode}
+        elif member.issym():
+            result.entries[path] = {"path": path, "type": "symlink", "mode": member.mode, "linkname": member.linkname}
+        elif member.islnk() and posixpath.normpath(member.linkname) in result.entries:
+            result.entries[path] = dict(result.entries[posixpath.normpath(member.linkname)], path=path)
+            result.files += 1
+        return
+
+    target = os.path.join(destnation, path)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    if store is None:
+        digest, size = write_file(tar_file.extractfile(member), target, buffer_size, member.mtime)
+    else:
+        digest, size, deduplicated = store.add(tar_file.extractfile(member), target, buffer_size, member.mtime)
+        if deduplicated:
+            result.deduplicated_files += 1
+            result.deduplicated_size += size
+    # The client hashes each file while reading it, so corruption anywhere between its disk and ours is caught
+    expected = member.pax_headers.get(CHECKSUM_HEADER)
+    if expected is not None:
+        if expected != digest:
+            raise ArchiveError(f"Content of '{path}' does not match its checksum")
+        result.verified_files += 1
+    result.entries[path] = {"path": path, "type": "file", "mode": member.mode, "size": size, "hash": digest}
+    result.files += 1
+    if sidecars is not None:
+        sidecars.submit(target, size)
+
+
+def decompress(source: BinaryIO, destnation: str, buffer_size: int = 1024 * 1024,
+               store: Optional[ObjectStore] = None, dictionary: Optional[ZstdCompressionDict] = None,
+               sidecars: Optional[SidecarWriter] = None, timings: Optional[Timings] = None,
+               limits: Optional[ArchiveLimits] = None) -> ExtractResult:
+    result = ExtractResult()
+    validator = MemberValidator(limits)
+    timings = result.timings = timings or result.timings
+    reader = CountingReader(source, timings, "receive", hasher=new_hash())
+    decompressor = ZstdDecompressor(dict_data=dictionary)
+    try:
+        # Clients send large files as separate frames, so the archive spans every frame in the upload
+        with decompressor.stream_reader(reader, read_size=buffer_size, read_across_frames=True) as zstd_stream:
+            # Headers and padding count too, so a bomb made of headers alone is stopped as well
+            tar_stream = CountingReader(zstd_stream, timings, "decompress", validator.limits.size)
+            # "r|" reads the archive strictly forward, so only one member is in flight at a time
+            with tarfile.open(fileobj=tar_stream, mode="r|", bufsize=buffer_size, copybufsize=buffer_size) as tar_file:
+                while True:
+                    with timings.stage("tar_parse"):
+                        member = tar_file.next()
+                    if member is None:
+                        break
+                    with timings.stage("safe_filter"):
+                        member = validator.validate(member)
+                    if member is not None:
+                        with timings.stage("write"):
+                            extract_member(tar_file, member, destnation, buffer_size, store, result, sidecars)
+                    # TarFile keeps every member it has read, dropping them keeps memory flat on huge archives
+                    tar_file.members.clear()
+            while tar_stream.read(buffer_size):
+                pass
+            result.extracted_size = tar_stream.size
+        # Whatever the decompressor left unread is hashed too, so the checksum covers the whole upload
+        while reader.read(buffer_size):
+            pass
+    except (tarfile.TarError, ZstdError) as e:
+        raise ArchiveError(f"Corrupted archive: {e}")
+    result.upload_size = reader.size
+    result.checksum = reader.hasher.hexdigest()
+    return result
@@ -0,0 +1,156 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+from typing import Callable, Optional
+
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+
+ALL_PROJECTS = "*"
+PUBLIC_PATHS = {"/health"}
+# Endpoints that act on several projects named in the body check each of them themselves
+MULTI_PROJECT_PATHS = {"/current", "/releases"}
+logger = logging.getLogger("uvicorn.error")
+
+
+def hash_key(api_key: str) -> bytes:
+    return hashlib.sha256(api_key.encode()).digest()
+
+
+def parse_keys(content: str) -> dict:
+    # One key per line: the hex SHA-256 of the key, then a comma separated list of projects or "*"
+    keys = {}
+    for number, line in enumerate(content.splitlines(), 1):
+        line = line.split("#", 1)[0].strip()
+        if not line:
+            continue
+        parts = line.split()
+        if len(parts) != 2:
+            raise ValueError(f"line {number}: expected '<sha256> <projects>'")
+        try:
+            digest = bytes.fromhex(parts[0])
+        except ValueError:
+            digest = b""
+        if len(digest) != hashlib.sha256().digest_size:
+            raise ValueError(f"line {number}: '{parts[0]}' is not a hex SHA-256 digest")
+        keys[digest] = frozenset(x for x in parts[1].split(",") if x)
+    return keys
+
+
+def project_of(path: str) -> Optional[str]:
+    parts = path.split("/", 3)
+    if len(parts) >= 3 and parts[1] == "projects" and parts[2]:
+        return parts[2]
+    return None
+
+
+class Keyring:
+    def __init__(self, api_key: str, keys_file: str, reload_interval: float):
+        self.api_key = api_key
+        self.keys_file = keys_file
+        self.reload_interval = reload_interval
+        self.lock = threading.Lock()
+        self.keys = {}
+        self.signature = None
+        self.checked_at = 0.0
+        self.load()
+
+    def file_signature(self) -> Optional[tuple]:
+        try:
+            file_stat = os.stat(self.keys_file)
+        except FileNotFoundError:
+            return None
+        return file_stat.st_ino, file_stat.st_mtime_ns, file_stat.st_size
+
+    def load(self) -> None:
+        keys = {}
+        if self.api_key:
+            digest = hash_key(self.api_key)
+            keys[digest] = frozenset([ALL_PROJECTS])
+        signature = None
+        if self.keys_file:
+            signature = self.file_signature()
+            if signature is not None:
+                with open(self.keys_file) as f:
+                    keys.update(parse_keys(f.read()))
+        # The table is replaced as a whole, requests in flight keep using the one they looked up
+        self.keys, self.signature = keys, signature
+
+    def refresh(self) -> None:
+        now = time.monotonic()
+        if not self.keys_file or now - self.checked_at < self.reload_interval:
+            return
+        with self.lock:
+            if now - self.checked_at < self.reload_interval:
+                return
+            self.checked_at = now
+            if self.file_signature() == self.signature:
+                return
+            try:
+                self.load()
+                logger.info(f"Reloaded {len(self.keys)} API keys from {self.keys_file}")
+            except (OSError, ValueError) as e:
+                logger.error(f"Could not reload API keys from {self.keys_file}, keeping the previous keys: {e}")
+
+    def scopes(self, api_key: str) -> Optional[frozenset]:
+        self.refresh()
+        # Keys are looked up by their SHA-256 digest, never compared as strings. The lookup time depends on the
+        # digest of the presented key, which shares no prefix with a stored key however close the two keys are,
+        # so timing cannot be used to guess a key character by character
+        return self.keys.get(hash_key(api_key))
+
+    def stats(self) -> dict:
+        return {"keys": len(self.keys), "keys_file": self.keys_file or None}
+
+
+def allows(scopes: frozenset, project_name: Optional[str]) -> bool:
+    return ALL_PROJECTS in scopes or (project_name is not None and project_name in scopes)
+
+
+class APIKeyMiddleware:
+    # Plain ASGI, the request body is passed through to the endpoint untouched
+    def __init__(self, app: ASGIApp, keyring: Callable[[], Keyring]):
+        self.app = app
+        self.keyring = keyring
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        state = scope.setdefault("state", {})
+        state["started_at"] = time.perf_counter()
+        if scope["path"] in PUBLIC_PATHS:
+            await self.app(scope, receive, send)
+            return
+        authorization = None
+        for name, value in scope["headers"]:
+            if name == b"authorization":
+                authorization = value.decode("latin-1")
+                break
+        if not authorization:
+            await reject(send, 401, "Unauthorized: Missing 'Authorization' header")
+            return
+        if not authorization.startswith("APIKey "):
+            await reject(send, 401, "Unauthorized: Malformed 'Authorization' header, should start with 'APIKey '")
+            return
+        scopes = self.keyring().scopes(authorization[len("APIKey "):].strip())
+        if scopes is None:
+            await reject(send, 401, "Unauthorized: Invalid API key")
+            return
+        project_name = project_of(scope["path"])
+        if not allows(scopes, project_name) and scope["path"] not in MULTI_PROJECT_PATHS:
+            target = f"project '{project_name}'" if project_name else "this endpoint"
+            await reject(send, 403, f"Forbidden: API key is not allowed to access {target}")
+            return
+        state["api_key_scopes"] = scopes
+        await self.app(scope, receive, send)
+
+
+async def reject(send: Send, status_code: int, detail: str) -> None:
+    body = json.dumps({"detail": detail}).encode()
+    await send({"type": "http.response.start", "status": status_code,
+                "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())]})
+    await send({"type": "http.response.body", "body": body})
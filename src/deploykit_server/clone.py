@@ -0,0 +1,113 @@
+import os
+import errno
+import fcntl
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+from deploykit_server.archive import ExtractResult
+from deploykit_server.config import ProjectPath
+from deploykit_server.links import ProjectLock
+
+
+# _IOW(0x94, 9, int) from linux/fs.h
+FICLONE = 0x40049409
+
+
+class CloneError(Exception):
+    def __init__(self, message: str, status_code: int = 400):
+        self.message = message
+        self.status_code = status_code
+        super().__init__(self.message)
+
+
+def resolve(project_path: ProjectPath, deployment_id: Optional[str], commit_hash: Optional[str]) -> str:
+    if (deployment_id is None) == (commit_hash is None):
+        raise CloneError("Either a deployment ID or a commit hash is required")
+    with ProjectLock(project_path):
+        if commit_hash is not None:
+            try:
+                deployment_id = os.path.basename(os.readlink(project_path.commit_symlink(commit_hash)).rstrip("/"))
+            except FileNotFoundError:
+                raise CloneError(f"Commit {commit_hash} not found in {project_path.project_name}", 404)
+        if not os.path.isdir(project_path.deployment(deployment_id)):
+            raise CloneError(f"Deployment {deployment_id} not found in {project_path.project_name}", 404)
+    return deployment_id
+
+
+def hardlink(source: str, target: str) -> None:
+    os.link(source, target)
+
+
+def reflink(source: str, target: str) -> None:
+    with open(source, "rb") as src, open(target, "wb") as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        except BaseException:
+            os.unlink(target)
+            raise
+    os.chmod(target, 0o644)
+
+
+def copy(source: str, target: str) -> None:
+    shutil.copyfile(source, target)
+    os.chmod(target, 0o644)
+
+
+class Cloner:
+    # Deployments are never modified in place, so files can share their data with the source deployment:
+    # hardlinks share the inode, reflinks share the blocks, only the last fallback copies bytes
+    METHODS = [("hardlink", hardlink), ("reflink", reflink), ("copy", copy)]
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        self.method = 0
+        self.lock = threading.Lock()
+        self.counts = {name: 0 for name, _ in Cloner.METHODS}
+        self.sizes = {name: 0 for name, _ in Cloner.METHODS}
+
+    def clone_file(self, source: str, target: str) -> None:
+        # The first method the filesystem refuses is skipped for every following file
+        method = self.method
+        while True:
+            name, func = Cloner.METHODS[method]
+            try:
+                func(source, target)
+                break
+            except FileNotFoundError:
+                raise
+            except OSError as e:
+                if method == len(Cloner.METHODS) - 1 or e.errno in (errno.ENOSPC, errno.EDQUOT):
+                    raise
+                method += 1
+                with self.lock:
+                    self.method = max(self.method, method)
+        size = os.lstat(target).st_size
+        with self.lock:
+            self.counts[name] += 1
+            self.sizes[name] += size
+
+    def clone_tree(self, source: str, destnation: str) -> None:
+        with ThreadPoolExecutor(self.workers, thread_name_prefix="deploykit-clone") as executor:
+            futures = []
+            for root, directories, filenames in os.walk(source):
+                target_root = os.path.join(destnation, os.path.relpath(root, source))
+                for name in directories + filenames:
+                    path, target = os.path.join(root, name), os.path.join(target_root, name)
+                    if os.path.islink(path):
+                        os.symlink(os.readlink(path), target)
+                    elif name in directories:
+                        os.mkdir(target, 0o755)
+                    else:
+                        futures.append(executor.submit(self.clone_file, path, target))
+            for future in futures:
+                future.result()
+
+    def result(self) -> ExtractResult:
+        result = ExtractResult()
+        result.files = sum(self.counts.values())
+        result.extracted_size = sum(self.sizes.values())
+        result.deduplicated_files = self.counts["hardlink"] + self.counts["reflink"]
+        result.deduplicated_size = self.sizes["hardlink"] + self.sizes["reflink"]
+        return result
@@ -1,11 +1,41 @@
 import os
+from typing import Literal
 from pydantic_settings import BaseSettings
 
 
 class Settings(BaseSettings):
     api_key: str = ""
+    api_keys_file: str = ""
+    api_keys_reload_interval: int = 5
     app_path: str = ""
     max_deployments: int = 500
+    max_batch_size: int = 1000
+    extract_buffer_size: int = 1024 * 1024
+    max_archive_members: int = 1000000
+    max_extracted_size: int = 16 * 1024 * 1024 * 1024
+    max_path_depth: int = 64
+    max_extractions: int = 2
+    max_global_extractions: int = 0
+    extraction_queue_depth: int = 8
+    clone_workers: int = 8
+    filesystem_workers: int = 4
+    filesystem_queue_depth: int = 64
+    retry_after: int = 10
+    drain_timeout: int = 300
+    object_store: bool = False
+    upload_chunk_size: int = 8 * 1024 * 1024
+    max_upload_chunk_size: int = 64 * 1024 * 1024
+    upload_session_timeout: int = 3600
+    dictionary_max_sample_size: int = 128 * 1024
+    sidecar_formats: str = "gz,br,zst"
+    sidecar_min_size: int = 1024
+    sidecar_workers: int = 2
+    retention_keep_last: int = 0
+    retention_keep_days: int = 0
+    retention_interval: int = 3600
+    reclaim_rate: int = 500
+    durability: Literal["fsync", "syncfs", "none"] = "fsync"
+    fsync_batch_size: int = 256
 
 
 class ProjectPath:
@@ -25,14 +55,63 @@ class ProjectPath:
         # {root}/{project_name}/commits/
         self.commits_path = os.path.join(self.project_path, "commits")
 
+        # {root}/{project_name}/manifests/
+        self.manifests_path = os.path.join(self.project_path, "manifests")
+
+        # {root}/{project_name}/uploads/
+        self.uploads_path = os.path.join(self.project_path, "uploads")
+
+        # {root}/{project_name}/trash/
+        self.trash_path = os.path.join(self.project_path, "trash")
+
+        # {root}/{project_name}/.lock
+        self.lock_file = os.path.join(self.project_path, ".lock")
+
+        # {root}/{project_name}/index.sqlite3
+        self.index_file = os.path.join(self.project_path, "index.sqlite3")
+
+        # {root}/{project_name}/dictionaries/
+        self.dictionaries_path = os.path.join(self.project_path, "dictionaries")
+
+        # {root}/{project_name}/dictionaries/latest -> ?
+        self.latest_dictionary = os.path.join(self.dictionaries_path, "latest")
+
     def deployment(self, deployment_id: str):
         # {root}/{project_name}/deployments/{deployment_id}/
         return os.path.join(self.deployments_path, deployment_id)
     
+    def staging(self, deployment_id: str):
+        # {root}/{project_name}/deployments/.staging-{deployment_id}/
+        return os.path.join(self.deployments_path, f".staging-{deployment_id}")
+
+    def delta(self, deployment_id: str):
+        # {root}/{project_name}/deployments/.delta-{deployment_id}/
+        return os.path.join(self.deployments_path, f".delta-{deployment_id}")
+
     def commit_symlink(self, commit_id: str):
         # {root}/{project_name}/commits/{commit_id}
         return os.path.join(self.commits_path, commit_id)
 
+    def upload(self, upload_id: str):
+        # {root}/{project_name}/uploads/{upload_id}/
+        return os.path.join(self.uploads_path, upload_id)
+
+    def dictionary(self, dictionary_id: int):
+        # {root}/{project_name}/dictionaries/{dictionary_id}.zdict
+        return os.path.join(self.dictionaries_path, f"{dictionary_id}.zdict")
+
+    def trash(self, name: str):
+        # {root}/{project_name}/trash/{name}/
+        return os.path.join(self.trash_path, name)
+
+    def manifest(self, deployment_id: str):
+        # {root}/{project_name}/manifests/{deployment_id}.ndjson
+        return os.path.join(self.manifests_path, f"{deployment_id}.ndjson")
+
+    def checksums(self, deployment_id: str):
+        # {root}/{project_name}/manifests/{deployment_id}.checksums.json
+        return os.path.join(self.manifests_path, f"{deployment_id}.checksums.json")
+
 
-if not os.environ.get("API_KEY") or os.environ.get("API_KEY").strip() == "":
+if os.environ.get("API_KEY", "").strip() == "" and os.environ.get("API_KEYS_FILE", "").strip() == "":
     raise ValueError("API_KEY is not set or empty")
@@ -0,0 +1,59 @@
+import os
+import uuid
+from typing import Optional, Tuple
+from zstandard import ZstdCompressionDict, ZstdError, train_dictionary
+
+from deploykit_server.archive import ArchiveError
+from deploykit_server.config import ProjectPath
+from deploykit_server.links import atomic_symlink
+from deploykit_server.sidecar import is_sidecar
+
+
+def collect_samples(deployment_path: str, max_sample_size: int, max_total_size: int) -> list[bytes]:
+    samples, total_size = [], 0
+    for root, dirnames, filenames in os.walk(deployment_path):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            path = os.path.join(root, filename)
+            if os.path.islink(path) or is_sidecar(path) or not 0 < os.path.getsize(path) <= max_sample_size:
+                continue
+            with open(path, "rb") as f:
+                samples.append(f.read())
+            total_size += len(samples[-1])
+            if total_size >= max_total_size:
+                return samples
+    return samples
+
+
+def train(project_path: ProjectPath, deployment_id: str, dict_size: int, max_sample_size: int) -> Tuple[int, int]:
+    samples = collect_samples(project_path.deployment(deployment_id), max_sample_size, dict_size * 100)
+    try:
+        dictionary = train_dictionary(dict_size, samples)
+    except ZstdError as e:
+        raise ArchiveError(f"Could not train dictionary from {len(samples)} samples: {e}")
+    dictionary_id = dictionary.dict_id()
+    os.makedirs(project_path.dictionaries_path, exist_ok=True)
+    temp_path = os.path.join(project_path.dictionaries_path, f".{uuid.uuid4().hex}")
+    with open(temp_path, "wb") as f:
+        f.write(dictionary.as_bytes())
+    os.replace(temp_path, project_path.dictionary(dictionary_id))
+
+    atomic_symlink(f"{dictionary_id}.zdict", project_path.latest_dictionary)
+    return dictionary_id, len(samples)
+
+
+def latest(project_path: ProjectPath) -> Optional[int]:
+    try:
+        return int(os.readlink(project_path.latest_dictionary).partition(".")[0])
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def load(project_path: ProjectPath, dictionary_id: Optional[int]) -> Optional[ZstdCompressionDict]:
+    if dictionary_id is None:
+        return None
+    try:
+        with open(project_path.dictionary(dictionary_id), "rb") as f:
+            return ZstdCompressionDict(f.read())
+    except FileNotFoundError:
+        raise ArchiveError(f"Dictionary {dictionary_id} not found")
@@ -0,0 +1,203 @@
+import os
+import re
+import sqlite3
+from contextlib import closing
+from typing import Iterator, Optional, Tuple
+
+from deploykit_server import schema
+from deploykit_server.config import ProjectPath
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS deployments (
+    deployment_id TEXT PRIMARY KEY,
+    created_at    INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS commits (
+    seq           INTEGER PRIMARY KEY AUTOINCREMENT,
+    commit_hash   TEXT UNIQUE NOT NULL,
+    deployment_id TEXT NOT NULL,
+    created_at    INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key   TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+
+def scan_deployments(project_path: ProjectPath) -> list:
+    deployments = os.listdir(project_path.deployments_path)
+    deployments = [x for x in deployments if (not x.startswith(".")) and len(x) == schema.DeploymentId['min_length']]
+    deployments = sorted(deployments, reverse=True)
+    return [{
+        "deployment_id": x,
+        "created_at": int(os.path.getctime(project_path.deployment(x))),
+    } for x in deployments]
+
+
+def scan_commits(project_path: ProjectPath) -> list:
+    commits = os.listdir(project_path.commits_path)
+    commits = [x for x in commits if (not x.startswith(".")) and len(x) == schema.CommitHash['min_length']]
+    commits = sorted(commits, key=lambda x: os.path.getmtime(project_path.commit_symlink(x)), reverse=True)
+    return [{
+        "commit_hash": x,
+        "deployment_id": os.path.basename(os.readlink(project_path.commit_symlink(x)).rstrip("/")),
+        "created_at": int(os.path.getctime(project_path.commit_symlink(x))),
+    } for x in commits]
+
+
+def directory_mtime(path: str) -> str:
+    try:
+        return str(os.stat(path).st_mtime_ns)
+    except FileNotFoundError:
+        return "0"
+
+
+class ProjectIndex:
+    def __init__(self, project_path: ProjectPath):
+        self.project_path = project_path
+
+    def connect(self) -> sqlite3.Connection:
+        os.makedirs(self.project_path.project_path, exist_ok=True)
+        connection = sqlite3.connect(self.project_path.index_file, timeout=30, isolation_level=None)
+        connection.executescript(SCHEMA)
+        return connection
+
+    def exists(self) -> bool:
+        return os.path.exists(self.project_path.index_file)
+
+    def is_stale(self) -> bool:
+        if not self.exists():
+            return True
+        with closing(self.connect()) as connection:
+            meta = dict(connection.execute("SELECT key, value FROM meta").fetchall())
+        return (meta.get("deployments_mtime") != directory_mtime(self.project_path.deployments_path) or
+                meta.get("commits_mtime") != directory_mtime(self.project_path.commits_path))
+
+    def touch(self, connection: sqlite3.Connection) -> None:
+        # Remember the directory state this index reflects, so out-of-band changes are detected at startup
+        connection.executemany("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", [
+            ("deployments_mtime", directory_mtime(self.project_path.deployments_path)),
+            ("commits_mtime", directory_mtime(self.project_path.commits_path)),
+        ])
+
+    def rebuild(self) -> None:
+        try:
+            deployments = scan_deployments(self.project_path)
+        except FileNotFoundError:
+            deployments = []
+        try:
+            commits = scan_commits(self.project_path)
+        except FileNotFoundError:
+            commits = []
+        with closing(self.connect()) as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            connection.execute("DELETE FROM deployments")
+            connection.execute("DELETE FROM commits")
+            connection.executemany("INSERT INTO deployments (deployment_id, created_at) VALUES (?, ?)",
+                                   [(x["deployment_id"], x["created_at"]) for x in deployments])
+            connection.executemany("INSERT INTO commits (commit_hash, deployment_id, created_at) VALUES (?, ?, ?)",
+                                   [(x["commit_hash"], x["deployment_id"], x["created_at"]) for x in reversed(commits)])
+            try:
+                current = os.path.basename(os.readlink(self.project_path.current_symlink).rstrip("/"))
+                connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('current', ?)", (current,))
+            except FileNotFoundError:
+                connection.execute("DELETE FROM meta WHERE key = 'current'")
+            self.touch(connection)
+            connection.execute("COMMIT")
+
+    def ensure(self) -> None:
+        if not self.exists():
+            self.rebuild()
+
+    def add_deployment(self, deployment_id: str, created_at: int, commit_hash: Optional[str] = None) -> None:
+        self.ensure()
+        with closing(self.connect()) as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            connection.execute("INSERT OR REPLACE INTO deployments (deployment_id, created_at) VALUES (?, ?)",
+                               (deployment_id, created_at))
+            if commit_hash:
+                connection.execute("DELETE FROM commits WHERE commit_hash = ?", (commit_hash,))
+                connection.execute("INSERT INTO commits (commit_hash, deployment_id, created_at) VALUES (?, ?, ?)",
+                                   (commit_hash, deployment_id, created_at))
+            self.touch(connection)
+            connection.execute("COMMIT")
+
+    def remove_deployment(self, deployment_id: str) -> None:
+        self.ensure()
+        with closing(self.connect()) as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            connection.execute("DELETE FROM deployments WHERE deployment_id = ?", (deployment_id,))
+            self.touch(connection)
+            connection.execute("COMMIT")
+
+    def remove_commit(self, commit_hash: str, deployment_id: Optional[str] = None) -> None:
+        self.ensure()
+        with closing(self.connect()) as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            connection.execute("DELETE FROM commits WHERE commit_hash = ?", (commit_hash,))
+            if deployment_id:
+                connection.execute("DELETE FROM deployments WHERE deployment_id = ?", (deployment_id,))
+            self.touch(connection)
+            connection.execute("COMMIT")
+
+    def set_current(self, deployment_id: str) -> None:
+        self.ensure()
+        with closing(self.connect()) as connection:
+            connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('current', ?)", (deployment_id,))
+
+    def current(self) -> Optional[str]:
+        self.ensure()
+        with closing(self.connect()) as connection:
+            row = connection.execute("SELECT value FROM meta WHERE key = 'current'").fetchone()
+        return row[0] if row else None
+
+    def all_deployments(self) -> list:
+        self.ensure()
+        with closing(self.connect()) as connection:
+            rows = connection.execute(
+                "SELECT deployment_id, created_at FROM deployments ORDER BY deployment_id DESC").fetchall()
+        return [{"deployment_id": x, "created_at": y} for x, y in rows]
+
+    def deployments(self, limit: int, after: Optional[str] = None) -> Tuple[list, Optional[str]]:
+        self.ensure()
+        with closing(self.connect()) as connection:
+            rows = connection.execute(
+                "SELECT deployment_id, created_at FROM deployments WHERE deployment_id < ? "
+                "ORDER BY deployment_id DESC LIMIT ?", (after or "~", limit)).fetchall()
+        deployments = [{"deployment_id": x, "created_at": y} for x, y in rows]
+        return deployments, (rows[-1][0] if len(rows) == limit else None)
+
+    def commits(self, limit: int, after: Optional[str] = None) -> Tuple[list, Optional[str]]:
+        self.ensure()
+        after_seq = int(after) if after and after.isdigit() else 2 ** 63 - 1
+        with closing(self.connect()) as connection:
+            rows = connection.execute(
+                "SELECT seq, commit_hash, deployment_id, created_at FROM commits WHERE seq < ? "
+                "ORDER BY seq DESC LIMIT ?", (after_seq, limit)).fetchall()
+        commits = [{"commit_hash": x, "deployment_id": y, "created_at": z} for _, x, y, z in rows]
+        return commits, (str(rows[-1][0]) if len(rows) == limit else None)
+
+
+def projects(app_path: str) -> Iterator[ProjectPath]:
+    try:
+        names = os.listdir(app_path)
+    except FileNotFoundError:
+        return
+    for project_name in sorted(names):
+        if not re.match(schema.ProjectName['pattern'], project_name):
+            continue
+        project_path = ProjectPath(app_path, project_name)
+        if os.path.isdir(project_path.project_path):
+            yield project_path
+
+
+def rebuild_stale(app_path: str) -> list:
+    rebuilt = []
+    for project_path in projects(app_path):
+        project_index = ProjectIndex(project_path)
+        if project_index.is_stale():
+            project_index.rebuild()
+            rebuilt.append(project_path.project_name)
+    return rebuilt
@@ -0,0 +1,145 @@
+import os
+import time
+import uuid
+import errno
+import fcntl
+import random
+import threading
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+from deploykit_server.config import ProjectPath
+
+
+def atomic_symlink(target: str, path: str) -> None:
+    # rename(2) swaps the link in one step, readers see either the old or the new target but never nothing
+    temp_path = os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.{uuid.uuid4().hex}")
+    os.symlink(target, temp_path)
+    try:
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+
+class FileLock:
+    # fcntl record locks are honoured across workers and across hosts sharing APP_PATH over NFS, but they belong
+    # to the process and are dropped when any of its descriptors of the file closes, so threads of one worker
+    # take an in-process lock first and only the holder ever opens the file
+    registry = {}
+    registry_lock = threading.Lock()
+
+    def __init__(self, path: str):
+        self.path = path
+        self.file = None
+        self.held = None
+
+    def thread_lock(self, delta: int) -> threading.Lock:
+        with FileLock.registry_lock:
+            entry = FileLock.registry.setdefault(self.path, [threading.Lock(), 0])
+            entry[1] += delta
+            if entry[1] == 0:
+                del FileLock.registry[self.path]
+            return entry[0]
+
+    def acquire(self, blocking: bool = True) -> bool:
+        thread_lock = self.thread_lock(1)
+        if not thread_lock.acquire(blocking):
+            self.thread_lock(-1)
+            return False
+        try:
+            self.file = open(self.path, "a")
+            fcntl.lockf(self.file, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BaseException as e:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+            thread_lock.release()
+            self.thread_lock(-1)
+            if isinstance(e, OSError) and e.errno in (errno.EACCES, errno.EAGAIN) and not blocking:
+                return False
+            raise
+        self.held = thread_lock
+        return True
+
+    def release(self) -> None:
+        fcntl.lockf(self.file, fcntl.LOCK_UN)
+        self.file.close()
+        self.file = None
+        self.held.release()
+        self.held = None
+        self.thread_lock(-1)
+
+    def __enter__(self) -> "FileLock":
+        self.acquire()
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.release()
+
+
+class ProjectLock(FileLock):
+    def __init__(self, project_path: ProjectPath):
+        super().__init__(project_path.lock_file)
+        self.project_path = project_path
+
+    def __enter__(self) -> "ProjectLock":
+        os.makedirs(self.project_path.project_path, exist_ok=True)
+        self.acquire()
+        return self
+
+
+class FileSemaphore:
+    # One lock file per slot, so at most `slots` holders run at once across every worker sharing the directory
+    def __init__(self, path: str, slots: int, poll_interval: float = 0.05):
+        self.path = path
+        self.slots = slots
+        self.poll_interval = poll_interval
+        self.lock = threading.Lock()
+        self.held = 0
+        self.waiting = 0
+        self.acquired = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+
+    def try_acquire(self) -> Optional[FileLock]:
+        # Slots are tried from a random start, so waiting workers do not all contend for slot 0
+        start = random.randrange(self.slots)
+        for i in range(self.slots):
+            slot = FileLock(os.path.join(self.path, f"{(start + i) % self.slots}.lock"))
+            if slot.acquire(blocking=False):
+                return slot
+        return None
+
+    @contextmanager
+    def slot(self) -> Iterator[None]:
+        os.makedirs(self.path, exist_ok=True)
+        started_at, delay = time.monotonic(), self.poll_interval
+        with self.lock:
+            self.waiting += 1
+        try:
+            # A slot freed by another worker cannot wake this one, so free slots are polled with a growing interval
+            while (slot := self.try_acquire()) is None:
+                time.sleep(delay)
+                delay = min(delay * 2, self.poll_interval * 10)
+        finally:
+            with self.lock:
+                self.waiting -= 1
+        waited = time.monotonic() - started_at
+        with self.lock:
+            self.held += 1
+            self.acquired += 1
+            self.wait_seconds_total += waited
+            self.wait_seconds_max = max(self.wait_seconds_max, waited)
+        try:
+            yield
+        finally:
+            slot.release()
+            with self.lock:
+                self.held -= 1
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"slots": self.slots, "held": self.held, "waiting": self.waiting, "acquired": self.acquired,
+                    "wait_seconds_avg": self.wait_seconds_total / self.acquired if self.acquired else 0.0,
+                    "wait_seconds_max": self.wait_seconds_max}
@@ -0,0 +1,205 @@
+import os
+import re
+import json
+import shutil
+import tarfile
+from typing import Iterable, Iterator, Optional, TextIO
+
+from deploykit_server import schema
+from deploykit_server.archive import ArchiveError, ArchiveLimits, ExtractResult, MemberValidator, member_path
+from deploykit_server.config import ProjectPath
+from deploykit_server.sidecar import SidecarWriter
+from deploykit_server.store import ObjectStore
+
+
+MEMBER_TYPES = {"file": tarfile.REGTYPE, "dir": tarfile.DIRTYPE, "symlink": tarfile.SYMTYPE}
+
+
+def write_manifest(path: str, entries: Iterable[dict]) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w") as f:
+        for entry in entries:
+            f.write(json.dumps(entry, separators=(",", ":")) + "\n")
+    os.replace(temp_path, path)
+
+
+def write_checksums(path: str, checksums: dict) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w") as f:
+        json.dump(checksums, f)
+    os.replace(temp_path, path)
+
+
+def read_manifest(path: str) -> Iterator[dict]:
+    yield from read_lines(open(path))
+
+
+def read_lines(f: TextIO) -> Iterator[dict]:
+    with f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def read_chunks(f: TextIO, size: int = 1024 * 1024) -> Iterator[str]:
+    with f:
+        while chunk := f.read(size):
+            yield chunk
+
+
+def diff_manifests(before: Iterator[dict], after: Iterator[dict]) -> Iterator[dict]:
+    # Manifests are sorted by path, so both are walked once side by side and neither is loaded as a whole
+    counts = {"added": 0, "removed": 0, "modified": 0, "unchanged": 0}
+    old, new = next(before, None), next(after, None)
+    while old is not None or new is not None:
+        if new is None or (old is not None and old["path"] < new["path"]):
+            counts["removed"] += 1
+            yield {"change": "removed", **old}
+            old = next(before, None)
+        elif old is None or new["path"] < old["path"]:
+            counts["added"] += 1
+            yield {"change": "added", **new}
+            new = next(after, None)
+        else:
+            if old == new:
+                counts["unchanged"] += 1
+            else:
+                counts["modified"] += 1
+                yield {"change": "modified", "path": new["path"],
+                       "before": {k: v for k, v in old.items() if k != "path"},
+                       "after": {k: v for k, v in new.items() if k != "path"}}
+            old, new = next(before, None), next(after, None)
+    yield {"summary": counts}
+
+
+def ndjson(entries: Iterable[dict], lines: int = 1000) -> Iterator[bytes]:
+    # Lines are sent in groups, so a large diff is not one thread hop per line
+    buffer = []
+    for entry in entries:
+        buffer.append(json.dumps(entry, separators=(",", ":")))
+        if len(buffer) >= lines:
+            yield ("\n".join(buffer) + "\n").encode()
+            buffer = []
+    if buffer:
+        yield ("\n".join(buffer) + "\n").encode()
+
+
+def find_base(project_path: ProjectPath) -> Optional[str]:
+    try:
+        current = os.path.basename(os.readlink(project_path.current_symlink).rstrip("/"))
+        if os.path.exists(project_path.manifest(current)):
+            return current
+    except FileNotFoundError:
+        pass
+    try:
+        manifests = sorted(os.listdir(project_path.manifests_path), reverse=True)
+    except FileNotFoundError:
+        return None
+    for filename in manifests:
+        deployment_id, _, extension = filename.partition(".")
+        if extension == "ndjson" and os.path.isdir(project_path.deployment(deployment_id)):
+            return deployment_id
+    return None
+
+
+def base_sources(project_path: ProjectPath, deployment_id: Optional[str]) -> dict:
+    if deployment_id is None:
+        return {}
+    deployment_path = project_path.deployment(deployment_id)
+    try:
+        return {entry["hash"]: os.path.join(deployment_path, entry["path"])
+                for entry in read_manifest(project_path.manifest(deployment_id)) if entry["type"] == "file"}
+    except FileNotFoundError:
+        return {}
+
+
+def validate_entry(entry: dict, validator: MemberValidator) -> Optional[tarfile.TarInfo]:
+    try:
+        member = tarfile.TarInfo(entry["path"])
+        member.type = MEMBER_TYPES[entry["type"]]
+        member.linkname = entry.get("linkname", "")
+        member.size = int(entry.get("size", 0))
+    except (KeyError, TypeError, ValueError):
+        raise ArchiveError(f"Malformed manifest entry: {entry!r}")
+    if member.isfile() and not re.match(schema.ContentHash['pattern'], str(entry.get("hash"))):
+        raise ArchiveError(f"Malformed content hash for '{member.name}'")
+    return validator.validate(member)
+
+
+def missing_hashes(entries: Iterable[dict], known: dict, store: Optional[ObjectStore]) -> list:
+    missing = []
+    for digest in sorted({entry.get("hash") for entry in entries if entry.get("type") == "file"}):
+        if digest in known:
+            continue
+        if store is not None and re.match(schema.ContentHash['pattern'], str(digest)) and store.exists(digest):
+            continue
+        missing.append(digest)
+    return missing
+
+
+def link_or_copy(source: str, target: str) -> None:
+    if os.path.lexists(target):
+        os.unlink(target)
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copyfile(source, target)
+        os.chmod(target, 0o644)
+
+
+def assemble(entries: Iterable[dict], destnation: str, delta: ExtractResult, delta_path: str,
+             sources: dict, store: Optional[ObjectStore], sidecars: Optional[SidecarWriter] = None,
+             limits: Optional[ArchiveLimits] = None) -> ExtractResult:
+    # The delta archive holds one member per missing content hash, named after the hash
+    uploaded = {}
+    for entry in delta.entries.values():
+        if entry["type"] == "file":
+            if entry["path"] != entry["hash"]:
+                raise ArchiveError(f"Content of '{entry['path']}' does not match its name")
+            uploaded[entry["hash"]] = os.path.join(delta_path, entry["path"])
+
+    result = ExtractResult(delta.upload_size)
+    result.extracted_size = delta.extracted_size
+    validator = MemberValidator(limits)
+    for entry in entries:
+        member = validate_entry(entry, validator)
+        if member is None:
+            continue
+        path = member_path(member)
+        target = os.path.join(destnation, path)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        if member.isdir():
+            os.makedirs(target, exist_ok=True)
+            result.entries[path] = {"path": path, "type": "dir", "mode": member.mode}
+            continue
+        if member.issym():
+            if os.path.lexists(target):
+                os.unlink(target)
+            os.symlink(member.linkname, target)
+            result.entries[path] = {"path": path, "type": "symlink", "mode": member.mode, "linkname": member.linkname}
+            continue
+
+        digest = entry["hash"]
+        if digest in uploaded:
+            source = uploaded[digest]
+        elif digest in sources:
+            source = sources[digest]
+        elif store is not None and store.exists(digest):
+            source = store.object(digest)
+        else:
+            raise ArchiveError(f"Missing content {digest} for '{path}'")
+        try:
+            link_or_copy(source, target)
+        except FileNotFoundError:
+            raise ArchiveError(f"Content {digest} for '{path}' disappeared during assembly")
+        size = os.path.getsize(target)
+        if digest not in uploaded:
+            result.deduplicated_files += 1
+            result.deduplicated_size += size
+        result.entries[path] = {"path": path, "type": "file", "mode": member.mode, "size": size, "hash": digest}
+        result.files += 1
+        if sidecars is not None:
+            sidecars.submit(target, size, None if digest in uploaded else source)
+    return result
@@ -0,0 +1,171 @@
+import abc
+import math
+import time
+import threading
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(abc.ABC):
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labels: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def key(self, labels: dict) -> tuple:
+        return tuple(str(labels[x]) for x in self.labels)
+
+    @abc.abstractmethod
+    def samples(self) -> Iterator[str]:
+        ...
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}", *self.samples()]
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self) -> Iterator[str]:
+        with self.lock:
+            values = dict(self.values)
+        for key, value in sorted(values.items()):
+            yield f"{self.name}{format_labels(self.labels, key)} {format_value(value)}"
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, amount: float = 1, **labels) -> None:
+        self.inc(-amount, **labels)
+
+    @contextmanager
+    def track(self, **labels):
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value: float, **labels) -> None:
+        key = self.key(labels)
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * len(self.buckets), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self.values[key] = (counts, total + value)
+
+    def samples(self) -> Iterator[str]:
+        with self.lock:
+            values = {key: (list(counts), total) for key, (counts, total) in self.values.items()}
+        for key, (counts, total) in sorted(values.items()):
+            for bound, count in zip(self.buckets, counts):
+                labels = format_labels(self.labels, key, f'le="{format_value(float(bound))}"')
+                yield f"{self.name}_bucket{labels} {count}"
+            yield f"{self.name}_sum{format_labels(self.labels, key)} {format_value(total)}"
+            yield f"{self.name}_count{format_labels(self.labels, key)} {counts[-1]}"
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        return "\n".join(metric.render() for metric in self.metrics) + "\n"
+
+
+class Timings:
+    # Stages nest (a tar read decompresses, which receives), each stage only counts its own time
+    def __init__(self):
+        self.seconds = {}
+        self.stack = []
+
+    @contextmanager
+    def stage(self, name: str):
+        started_at = time.perf_counter()
+        self.stack.append(0.0)
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started_at
+            children = self.stack.pop()
+            self.add(name, elapsed - children)
+            if self.stack:
+                self.stack[-1] += elapsed
+
+    def add(self, name: str, seconds: float) -> None:
+        self.seconds[name] = self.seconds.get(name, 0.0) + seconds
+
+    def merge(self, other: Optional["Timings"]) -> None:
+        if other is not None:
+            for name, seconds in other.seconds.items():
+                self.add(name, seconds)
+
+    def as_dict(self) -> dict:
+        return {name: round(seconds, 6) for name, seconds in self.seconds.items()}
+
+
+registry = Registry()
+stage_seconds = registry.register(Histogram(
+    "deploykit_stage_seconds", "Time spent in each stage of the deploy pipeline", ("project", "stage")))
+received_bytes = registry.register(Counter(
+    "deploykit_received_bytes_total", "Compressed bytes received in uploads", ("project",)))
+extracted_bytes = registry.register(Counter(
+    "deploykit_extracted_bytes_total", "Uncompressed tar bytes extracted from uploads", ("project",)))
+files_written = registry.register(Counter(
+    "deploykit_files_written_total", "Files written into deployments", ("project",)))
+deployments_created = registry.register(Counter(
+    "deploykit_deployments_total", "Deployments built, by outcome", ("project", "outcome")))
+release_skew_seconds = registry.register(Histogram(
+    "deploykit_release_skew_seconds", "Time between switching the first and the last project of a release", (),
+    (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1)))
+uploads_in_flight = registry.register(Gauge(
+    "deploykit_uploads_in_flight", "Uploads currently being extracted", ("project",)))
+
+
+def observe(project: str, timings: Timings) -> None:
+    for stage, seconds in timings.seconds.items():
+        stage_seconds.observe(seconds, project=project, stage=stage)
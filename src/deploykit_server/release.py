@@ -0,0 +1,98 @@
+import os
+import uuid
+import time
+from contextlib import ExitStack
+
+from deploykit_server.config import ProjectPath
+from deploykit_server.index import ProjectIndex
+from deploykit_server.links import ProjectLock, atomic_symlink
+from deploykit_server.retention import link_target
+
+
+class ReleaseError(Exception):
+    def __init__(self, message: str, status_code: int = 400, rollback_failed: list = None):
+        self.message = message
+        self.status_code = status_code
+        self.rollback_failed = rollback_failed
+        super().__init__(self.message)
+
+
+def restore(project_path: ProjectPath, previous: str) -> None:
+    if previous is None:
+        os.unlink(project_path.current_symlink)
+    else:
+        atomic_symlink(f"deployments/{previous}/", project_path.current_symlink)
+
+
+def rollback(flipped: list, previous: dict) -> list:
+    # Every project is restored even if one fails, the caller reports which ones are left on the new version
+    failed = []
+    for project_path in reversed(flipped):
+        try:
+            restore(project_path, previous[project_path.project_name])
+        except OSError:
+            failed.append(project_path.project_name)
+    return failed
+
+
+def missing_deployments(projects: list) -> list:
+    return [f"{project_path.project_name}/{deployment_id}" for project_path, deployment_id in projects
+            if not os.path.isdir(project_path.deployment(deployment_id))]
+
+
+def release(app_path: str, deployments: list) -> dict:
+    names = [name for name, _ in deployments]
+    if len(set(names)) != len(names):
+        raise ReleaseError("Each project can only appear once in a release")
+    started_at = time.perf_counter()
+    timings = {}
+    # Locks are taken in name order, so two overlapping releases cannot deadlock
+    projects = [(ProjectPath(app_path, name), deployment_id) for name, deployment_id in sorted(deployments)]
+    # Checked before locking too, as taking a project lock creates the project directory
+    if missing := missing_deployments(projects):
+        raise ReleaseError(f"Deployments not found: {', '.join(missing)}", 404)
+    with ExitStack() as stack:
+        for project_path, _ in projects:
+            stack.enter_context(ProjectLock(project_path))
+        if missing := missing_deployments(projects):
+            raise ReleaseError(f"Deployments not found: {', '.join(missing)}", 404)
+        timings["validate"] = time.perf_counter() - started_at
+
+        # Everything that can be done ahead is done before the first flip, the flips themselves are single renames
+        previous, temp_paths = {}, {}
+        try:
+            for project_path, deployment_id in projects:
+                previous[project_path.project_name] = link_target(project_path.current_symlink)
+                temp_path = os.path.join(project_path.project_path, f".current.{uuid.uuid4().hex}")
+                os.symlink(f"deployments/{deployment_id}/", temp_path)
+                temp_paths[project_path.project_name] = temp_path
+            timings["prepare"] = time.perf_counter() - started_at - timings["validate"]
+
+            flipped, offsets = [], []
+            flip_started_at = time.perf_counter()
+            try:
+                for project_path, _ in projects:
+                    os.replace(temp_paths[project_path.project_name], project_path.current_symlink)
+                    offsets.append(time.perf_counter() - flip_started_at)
+                    flipped.append(project_path)
+                    del temp_paths[project_path.project_name]
+            except OSError as e:
+                if failed := rollback(flipped, previous):
+                    raise ReleaseError(f"Could not switch {project_path.project_name}: {e}, "
+                                       f"rollback failed for: {', '.join(failed)}", 500, failed)
+                raise ReleaseError(f"Could not switch {project_path.project_name}, release rolled back: {e}", 500)
+        finally:
+            for temp_path in temp_paths.values():
+                if os.path.lexists(temp_path):
+                    os.unlink(temp_path)
+        timings["flip"] = offsets[-1]
+
+        for project_path, deployment_id in projects:
+            ProjectIndex(project_path).set_current(deployment_id)
+    timings["total"] = time.perf_counter() - started_at
+    released = [{"name": project_path.project_name, "deployment_id": deployment_id,
+                 "previous_deployment_id": previous[project_path.project_name], "offset": round(offset, 9)}
+                for (project_path, deployment_id), offset in zip(projects, offsets)]
+    # Bounds how long one project may serve the new version while another still serves the old one
+    return {"released": released, "skew": round(offsets[-1], 9),
+            "timings": {name: round(seconds, 6) for name, seconds in timings.items()}}
@@ -0,0 +1,246 @@
+import os
+import time
+import uuid
+import logging
+import threading
+from typing import Optional
+
+from deploykit_server import metrics
+from deploykit_server.config import ProjectPath
+from deploykit_server.index import ProjectIndex, projects
+from deploykit_server.links import FileLock, ProjectLock
+from deploykit_server.store import ObjectStore
+from deploykit_server.upload import expired_sessions
+
+
+logger = logging.getLogger("uvicorn.error")
+
+
+def link_target(symlink: str) -> Optional[str]:
+    try:
+        return os.path.basename(os.readlink(symlink).rstrip("/"))
+    except (FileNotFoundError, OSError):
+        return None
+
+
+def protected_deployments(project_path: ProjectPath) -> set:
+    protected = {link_target(project_path.current_symlink)}
+    try:
+        commits = os.listdir(project_path.commits_path)
+    except FileNotFoundError:
+        commits = []
+    for commit_hash in commits:
+        protected.add(link_target(project_path.commit_symlink(commit_hash)))
+    protected.discard(None)
+    return protected
+
+
+def expired_deployments(project_path: ProjectPath, keep_last: int, keep_days: int,
+                        now: Optional[float] = None) -> list:
+    # Zero disables a rule, and with both rules disabled nothing expires
+    if keep_last <= 0 and keep_days <= 0:
+        return []
+    now = time.time() if now is None else now
+    protected = protected_deployments(project_path)
+    expired = []
+    for i, deployment in enumerate(ProjectIndex(project_path).all_deployments()):
+        if deployment["deployment_id"] in protected:
+            continue
+        if keep_last > 0 and i < keep_last:
+            continue
+        if keep_days > 0 and deployment["created_at"] >= now - keep_days * 86400:
+            continue
+        expired.append(deployment)
+    return expired
+
+
+def freed_size(paths: list, object_store: bool) -> int:
+    # A file is freed once every link to it is gone, the object store holds one more link until collected
+    links, sizes = {}, {}
+    for path in paths:
+        for root, _, filenames in os.walk(path):
+            for filename in filenames:
+                file_stat = os.lstat(os.path.join(root, filename))
+                inode = (file_stat.st_dev, file_stat.st_ino)
+                links[inode] = links.get(inode, 0) + 1
+                sizes[inode] = (file_stat.st_size, file_stat.st_nlink)
+    freed = 0
+    for inode, count in links.items():
+        size, nlink = sizes[inode]
+        if count >= nlink or (object_store and count >= nlink - 1):
+            freed += size
+    return freed
+
+
+def move_to_trash(project_path: ProjectPath, deployment_id: str) -> str:
+    # A rename is instant, the tree itself is deleted later by the reclaimer
+    os.makedirs(project_path.trash_path, exist_ok=True)
+    trash_path = project_path.trash(f"{deployment_id}-{uuid.uuid4().hex[:8]}")
+    os.rename(project_path.deployment(deployment_id), trash_path)
+    ProjectIndex(project_path).remove_deployment(deployment_id)
+    for path in [project_path.manifest(deployment_id), project_path.checksums(deployment_id)]:
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+    return trash_path
+
+
+def apply(project_path: ProjectPath, keep_last: int, keep_days: int, object_store: bool, dry_run: bool) -> dict:
+    expired = expired_deployments(project_path, keep_last, keep_days)
+    paths = [project_path.deployment(x["deployment_id"]) for x in expired]
+    result = {"name": project_path.project_name, "dry_run": dry_run, "keep_last": keep_last, "keep_days": keep_days,
+              "expired": expired, "freed_size": freed_size(paths, object_store)}
+    if not dry_run:
+        with ProjectLock(project_path):
+            # A deployment may have become current since the plan was made
+            protected = protected_deployments(project_path)
+            for deployment in expired:
+                if deployment["deployment_id"] in protected:
+                    continue
+                try:
+                    move_to_trash(project_path, deployment["deployment_id"])
+                except FileNotFoundError:
+                    pass
+    return result
+
+
+def expire_uploads(project_path: ProjectPath, timeout: int) -> int:
+    # Abandoned chunked uploads go to the trash like deleted deployments and are reclaimed with them
+    expired = 0
+    for session in expired_sessions(project_path, timeout):
+        lock = session.lock()
+        try:
+            if not lock.acquire(blocking=False):
+                continue
+        except FileNotFoundError:
+            continue
+        try:
+            os.makedirs(project_path.trash_path, exist_ok=True)
+            os.rename(session.path, project_path.trash(f"upload-{session.upload_id}"))
+            expired += 1
+        except FileNotFoundError:
+            pass
+        finally:
+            lock.release()
+    return expired
+
+
+class Reclaimer:
+    def __init__(self, app_path: str, rate: int, interval: int, keep_last: int, keep_days: int,
+                 store: Optional[ObjectStore], upload_timeout: int = 0):
+        self.app_path = app_path
+        self.rate = rate
+        self.interval = interval
+        self.keep_last = keep_last
+        self.keep_days = keep_days
+        self.store = store
+        self.upload_timeout = upload_timeout
+        self.wakeup = threading.Event()
+        self.stopping = threading.Event()
+        self.thread = None
+        self.operations = 0
+        self.reclaimed_files = 0
+        self.reclaimed_size = 0
+        self.expired_deployments = 0
+        self.expired_uploads = 0
+        self.runs = 0
+
+    def start(self) -> None:
+        self.thread = threading.Thread(target=self.loop, name="reclaimer", daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.stopping.set()
+        self.wakeup.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def wake(self) -> None:
+        self.wakeup.set()
+
+    def loop(self) -> None:
+        self.wakeup.set()
+        while not self.stopping.is_set():
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            if self.stopping.is_set():
+                break
+            try:
+                self.run()
+            except Exception:
+                logger.exception("Reclaiming deployments failed")
+
+    def run(self) -> None:
+        os.makedirs(self.app_path, exist_ok=True)
+        lock = FileLock(os.path.join(self.app_path, ".reclaim.lock"))
+        # With several server workers only one of them reclaims at a time
+        if not lock.acquire(blocking=False):
+            return
+        try:
+            self.runs += 1
+            for project_path in projects(self.app_path):
+                if self.keep_last > 0 or self.keep_days > 0:
+                    result = apply(project_path, self.keep_last, self.keep_days, self.store is not None, False)
+                    self.expired_deployments += len(result["expired"])
+                if self.upload_timeout > 0:
+                    self.expired_uploads += expire_uploads(project_path, self.upload_timeout)
+                for name in self.pending(project_path):
+                    started_at = time.perf_counter()
+                    self.reclaim(project_path.trash(name))
+                    metrics.stage_seconds.observe(time.perf_counter() - started_at,
+                                                  project=project_path.project_name, stage="rmtree")
+            if self.store is not None:
+                _, freed = self.store.collect_garbage()
+                self.reclaimed_size += freed
+        finally:
+            lock.release()
+
+    def pending(self, project_path: ProjectPath) -> list:
+        try:
+            return sorted(os.listdir(project_path.trash_path))
+        except FileNotFoundError:
+            return []
+
+    def throttle(self, started_at: float) -> None:
+        # Unlinks are metadata writes, spacing them out keeps the disk responsive for the live sites
+        self.operations += 1
+        if self.rate > 0:
+            delay = self.operations / self.rate - (time.monotonic() - started_at)
+            if delay > 0:
+                time.sleep(delay)
+
+    def reclaim(self, path: str) -> None:
+        started_at, self.operations = time.monotonic(), 0
+        for root, dirnames, filenames in os.walk(path, topdown=False):
+            for filename in filenames:
+                if self.stopping.is_set():
+                    return
+                target = os.path.join(root, filename)
+                try:
+                    file_stat = os.lstat(target)
+                    os.unlink(target)
+                except FileNotFoundError:
+                    continue
+                self.reclaimed_files += 1
+                if file_stat.st_nlink == 1:
+                    self.reclaimed_size += file_stat.st_size
+                self.throttle(started_at)
+            for dirname in dirnames:
+                target = os.path.join(root, dirname)
+                try:
+                    if os.path.islink(target):
+                        os.unlink(target)
+                    else:
+                        os.rmdir(target)
+                except FileNotFoundError:
+                    pass
+        try:
+            os.rmdir(path)
+        except FileNotFoundError:
+            pass
+
+    def stats(self) -> dict:
+        return {"runs": self.runs, "expired_deployments": self.expired_deployments,
+                "expired_uploads": self.expired_uploads,
+                "reclaimed_files": self.reclaimed_files, "reclaimed_size": self.reclaimed_size}
@@ -13,6 +13,18 @@ CommitHash = {
     'pattern': "^[a-f0-9]{40}$",
 }
 
+ContentHash = {
+    'min_length': 64,
+    'max_length': 64,
+    'pattern': "^[a-f0-9]{64}$",
+}
+
+UploadId = {
+    'min_length': 32,
+    'max_length': 32,
+    'pattern': "^[0-9a-f]{32}$",
+}
+
 DeploymentId = {
     'min_length': 33,
     'max_length': 33,
@@ -0,0 +1,157 @@
+import os
+import gzip
+import time
+import uuid
+from concurrent.futures import Executor, Future
+from typing import Optional
+from zstandard import ZstdCompressor
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+SIDECAR_EXTENSIONS = {"gz": ".gz", "br": ".br", "zst": ".zst"}
+COMPRESSIBLE_EXTENSIONS = {
+    ".html", ".htm", ".css", ".js", ".mjs", ".cjs", ".json", ".map", ".xml", ".txt", ".md", ".csv",
+    ".svg", ".ico", ".wasm", ".webmanifest", ".rss", ".atom", ".ttf", ".otf", ".eot", ".yaml", ".yml",
+}
+
+
+def available_formats(formats: str) -> list[str]:
+    # Brotli is an optional dependency, its sidecars are skipped when it is not installed
+    requested = [x.strip() for x in formats.split(",") if x.strip()]
+    return [x for x in requested if x in SIDECAR_EXTENSIONS and (x != "br" or brotli is not None)]
+
+
+def is_compressible(path: str, size: int, min_size: int) -> bool:
+    return size >= min_size and os.path.splitext(path)[1].lower() in COMPRESSIBLE_EXTENSIONS
+
+
+def is_sidecar(path: str) -> bool:
+    return path.endswith(tuple(SIDECAR_EXTENSIONS.values()))
+
+
+class BrotliWriter:
+    def __init__(self, f):
+        self.f = f
+        self.compressor = brotli.Compressor(quality=11)
+
+    def write(self, data: bytes) -> None:
+        self.f.write(self.compressor.process(data))
+
+    def close(self) -> None:
+        self.f.write(self.compressor.finish())
+
+
+def open_writer(fmt: str, f):
+    if fmt == "gz":
+        return gzip.GzipFile(filename="", mode="wb", fileobj=f, compresslevel=9, mtime=0)
+    if fmt == "br":
+        return BrotliWriter(f)
+    return ZstdCompressor(level=19).stream_writer(f, closefd=False)
+
+
+def write_sidecars(path: str, formats: list[str], buffer_size: int = 1024 * 1024) -> dict:
+    # Runs in a worker process, so every format is produced from a single read of the file
+    started_at = time.process_time()
+    directory, filename = os.path.split(path)
+    stat = os.stat(path)
+    temp_files = {fmt: os.path.join(directory, f".{filename}.{uuid.uuid4().hex}") for fmt in formats}
+    files = {fmt: open(temp_path, "wb") for fmt, temp_path in temp_files.items()}
+    try:
+        writers = {fmt: open_writer(fmt, f) for fmt, f in files.items()}
+        with open(path, "rb") as source:
+            while chunk := source.read(buffer_size):
+                for writer in writers.values():
+                    writer.write(chunk)
+        for writer in writers.values():
+            writer.close()
+        sizes = {fmt: f.tell() for fmt, f in files.items()}
+    finally:
+        for f in files.values():
+            f.close()
+
+    # The sidecars are left under temporary names, they are only put in place once the whole archive is extracted
+    saved, kept = {}, {}
+    for fmt, temp_path in temp_files.items():
+        if sizes[fmt] >= stat.st_size:
+            os.unlink(temp_path)
+            continue
+        os.chmod(temp_path, 0o644)
+        os.utime(temp_path, (stat.st_mtime, stat.st_mtime))
+        saved[fmt], kept[fmt] = stat.st_size - sizes[fmt], temp_path
+    return {"path": path, "size": stat.st_size, "formats": formats, "saved": saved, "temp_files": kept,
+            "seconds": time.process_time() - started_at}
+
+
+def publish(source: str, target: str) -> bool:
+    # A sidecar never replaces a file of the deployment, an 'app.js.gz' shipped in the archive is kept as it is
+    try:
+        os.link(source, target)
+    except (FileExistsError, FileNotFoundError):
+        return False
+    return True
+
+
+class SidecarWriter:
+    def __init__(self, executor: Executor, formats: list[str], min_size: int):
+        self.executor = executor
+        self.formats = formats
+        self.min_size = min_size
+        self.futures: list[Future] = []
+        self.reused: list[tuple] = []
+        self.reused_files = 0
+
+    def reuse(self, path: str, source: str) -> list[str]:
+        # Content shared with a previous deployment keeps the sidecars generated for it, linked by wait()
+        missing = []
+        for fmt in self.formats:
+            extension = SIDECAR_EXTENSIONS[fmt]
+            if os.path.exists(source + extension):
+                self.reused.append((fmt, source + extension, path + extension))
+            else:
+                missing.append(fmt)
+        return missing
+
+    def submit(self, path: str, size: int, source: Optional[str] = None) -> None:
+        if not self.formats or not is_compressible(path, size, self.min_size):
+            return
+        formats = self.formats if source is None else self.reuse(path, source)
+        if not formats:
+            self.reused_files += 1
+            return
+        self.futures.append(self.executor.submit(write_sidecars, path, formats))
+
+    def cancel(self) -> None:
+        for future in self.futures:
+            future.cancel()
+        for future in self.futures:
+            if not future.cancelled():
+                future.exception()
+
+    def wait(self) -> dict:
+        started_at = time.monotonic()
+        result = {"formats": self.formats, "files": 0, "reused_files": self.reused_files, "original_size": 0,
+                  "saved_size": {fmt: 0 for fmt in self.formats}, "skipped": {fmt: 0 for fmt in self.formats},
+                  "compress_seconds": 0.0}
+        for future in self.futures:
+            stats = future.result()
+            result["files"] += 1
+            result["original_size"] += stats["size"]
+            result["compress_seconds"] += stats["seconds"]
+            for fmt in stats["formats"]:
+                temp_path = stats["temp_files"].get(fmt)
+                if temp_path is not None and publish(temp_path, stats["path"] + SIDECAR_EXTENSIONS[fmt]):
+                    result["saved_size"][fmt] += stats["saved"][fmt]
+                else:
+                    result["skipped"][fmt] += 1
+                if temp_path is not None:
+                    os.unlink(temp_path)
+        for fmt, source, target in self.reused:
+            if not publish(source, target):
+                result["skipped"][fmt] += 1
+        # Compression overlaps the extraction, only the tail left afterwards delays the deployment
+        result["wait_seconds"] = time.monotonic() - started_at
+        return result
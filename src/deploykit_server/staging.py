@@ -0,0 +1,156 @@
+import os
+import ctypes
+import shutil
+from typing import Iterable
+
+from deploykit_server.archive import ArchiveError
+from deploykit_server.config import ProjectPath
+from deploykit_server.links import FileLock
+
+
+STAGING_PREFIX = ".staging-"
+DELTA_PREFIX = ".delta-"
+
+
+def fsync_path(path: str) -> None:
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def fsync_batch(paths: list) -> None:
+    # Open the whole batch first so writeback of every file is already underway before waiting on each
+    fds = []
+    try:
+        for path in paths:
+            fds.append(os.open(path, os.O_RDONLY))
+        for fd in fds:
+            os.fsync(fd)
+    finally:
+        for fd in fds:
+            os.close(fd)
+
+
+def syncfs(path: str) -> None:
+    libc = ctypes.CDLL(None, use_errno=True)
+    if not hasattr(libc, "syncfs"):
+        os.sync()
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        if libc.syncfs(fd) != 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error), path)
+    finally:
+        os.close(fd)
+
+
+def sync_tree(path: str, mode: str, batch_size: int) -> None:
+    if mode == "none":
+        return
+    if mode == "syncfs":
+        syncfs(path)
+        return
+    batch = []
+    for root, _, filenames in os.walk(path, topdown=False):
+        for filename in filenames:
+            target = os.path.join(root, filename)
+            if not os.path.islink(target):
+                batch.append(target)
+        batch.append(root)
+        if len(batch) >= batch_size:
+            fsync_batch(batch)
+            batch = []
+    fsync_batch(batch)
+
+
+def verify(path: str, entries: Iterable[dict]) -> None:
+    for entry in entries:
+        target = os.path.join(path, entry["path"])
+        if entry["type"] == "file":
+            try:
+                size = os.lstat(target).st_size
+            except FileNotFoundError:
+                raise ArchiveError(f"'{entry['path']}' is missing after extraction")
+            if size != entry["size"]:
+                raise ArchiveError(f"'{entry['path']}' has {size} bytes after extraction, expected {entry['size']}")
+        elif not os.path.lexists(target):
+            raise ArchiveError(f"'{entry['path']}' is missing after extraction")
+
+
+class Staging:
+    # Deployments are built in a hidden directory next to their final path and appear with a single rename
+    def __init__(self, project_path: ProjectPath, deployment_id: str):
+        self.project_path = project_path
+        self.deployment_id = deployment_id
+        self.path = project_path.staging(deployment_id)
+        self.lock_file = f"{self.path}.lock"
+        self.lock = None
+
+    def __enter__(self) -> "Staging":
+        os.makedirs(self.project_path.deployments_path, exist_ok=True)
+        # The lock tells the startup cleanup of other server workers that this build is still running
+        while True:
+            self.lock = FileLock(self.lock_file)
+            self.lock.acquire()
+            try:
+                if os.stat(self.lock_file).st_ino == os.fstat(self.lock.file.fileno()).st_ino:
+                    break
+            except FileNotFoundError:
+                pass
+            # The cleanup removed the lock file between open and lock
+            self.lock.release()
+        shutil.rmtree(self.path, ignore_errors=True)
+        os.makedirs(self.path)
+        return self
+
+    def __exit__(self, *_) -> None:
+        shutil.rmtree(self.path, ignore_errors=True)
+        try:
+            os.unlink(self.lock_file)
+        except FileNotFoundError:
+            pass
+        self.lock.release()
+        self.lock = None
+
+    def publish(self, entries: Iterable[dict], durability: str, batch_size: int) -> str:
+        verify(self.path, entries)
+        sync_tree(self.path, durability, batch_size)
+        deployment_path = self.project_path.deployment(self.deployment_id)
+        os.rename(self.path, deployment_path)
+        if durability != "none":
+            fsync_path(self.project_path.deployments_path)
+        return deployment_path
+
+
+def clean_orphans(project_path: ProjectPath) -> list:
+    # Staging and delta directories whose build lock can be taken belong to a crashed or killed build
+    try:
+        names = os.listdir(project_path.deployments_path)
+    except FileNotFoundError:
+        return []
+    deployment_ids = {name[len(prefix):].partition(".")[0] for name in names
+                      for prefix in [STAGING_PREFIX, DELTA_PREFIX] if name.startswith(prefix)}
+    removed = []
+    for deployment_id in sorted(deployment_ids):
+        staging_path = project_path.staging(deployment_id)
+        lock = FileLock(f"{staging_path}.lock")
+        if not lock.acquire(blocking=False):
+            continue
+        try:
+            os.makedirs(project_path.trash_path, exist_ok=True)
+            for path in [staging_path, project_path.delta(deployment_id)]:
+                if os.path.isdir(path):
+                    os.rename(path, project_path.trash(os.path.basename(path).lstrip(".")))
+            os.unlink(f"{staging_path}.lock")
+        finally:
+            lock.release()
+        removed.append(deployment_id)
+    return removed
+
+
+def clean_all_orphans(projects: Iterable[ProjectPath]) -> dict:
+    return {project_path.project_name: removed for project_path in projects
+            if (removed := clean_orphans(project_path))}
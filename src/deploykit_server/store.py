@@ -0,0 +1,130 @@
+import os
+import stat
+import time
+import uuid
+import hashlib
+from typing import BinaryIO, Iterator, Optional, Tuple
+
+
+def new_hash():
+    return hashlib.blake2b(digest_size=32)
+
+
+class ObjectStore:
+    def __init__(self, app_path: str):
+        self.app_path = os.path.abspath(app_path)
+
+        # {root}/.objects/
+        self.objects_path = os.path.join(self.app_path, ".objects")
+
+        # {root}/.objects/tmp/
+        self.temp_path = os.path.join(self.objects_path, "tmp")
+
+    def object(self, digest: str) -> str:
+        # {root}/.objects/{digest[:2]}/{digest}
+        return os.path.join(self.objects_path, digest[:2], digest)
+
+    def exists(self, digest: str) -> bool:
+        return os.path.exists(self.object(digest))
+
+    def add(self, source: BinaryIO, target: str, buffer_size: int, mtime: Optional[float] = None) -> Tuple[str, int, bool]:
+        os.makedirs(self.temp_path, exist_ok=True)
+        temp_file = os.path.join(self.temp_path, uuid.uuid4().hex)
+        hasher, size = new_hash(), 0
+        with open(temp_file, "wb") as f:
+            while chunk := source.read(buffer_size):
+                hasher.update(chunk)
+                f.write(chunk)
+                size += len(chunk)
+        digest = hasher.hexdigest()
+        object_path = self.object(digest)
+        if os.path.lexists(target):
+            os.unlink(target)
+        try:
+            # Linking doubles as the existence check, so a concurrent garbage collection
+            # can never leave us pointing at an object that was just removed
+            os.link(object_path, target)
+            os.unlink(temp_file)
+            return digest, size, True
+        except FileNotFoundError:
+            pass
+        os.chmod(temp_file, 0o644)
+        if mtime is not None:
+            os.utime(temp_file, (mtime, mtime))
+        os.makedirs(os.path.dirname(object_path), exist_ok=True)
+        # The target is linked first, so the object never appears in the store with a single link
+        # that a concurrent garbage collection would take for unreferenced
+        os.link(temp_file, target)
+        os.replace(temp_file, object_path)
+        return digest, size, False
+
+    def link(self, digest: str, target: str) -> None:
+        if os.path.lexists(target):
+            os.unlink(target)
+        os.link(self.object(digest), target)
+
+    def objects(self) -> Iterator[os.DirEntry]:
+        try:
+            fanouts = list(os.scandir(self.objects_path))
+        except FileNotFoundError:
+            return
+        for fanout in fanouts:
+            if fanout.name == "tmp" or not fanout.is_dir(follow_symlinks=False):
+                continue
+            for entry in os.scandir(fanout.path):
+                if entry.is_file(follow_symlinks=False):
+                    yield entry
+
+    def collect_garbage(self, temp_max_age: int = 86400) -> Tuple[int, int]:
+        # An object whose only remaining link is the store itself is unreferenced
+        removed, freed = 0, 0
+        for entry in self.objects():
+            entry_stat = entry.stat(follow_symlinks=False)
+            if entry_stat.st_nlink == 1:
+                try:
+                    os.unlink(entry.path)
+                except FileNotFoundError:
+                    continue
+                removed += 1
+                freed += entry_stat.st_size
+        try:
+            for entry in os.scandir(self.temp_path):
+                if entry.stat(follow_symlinks=False).st_mtime < time.time() - temp_max_age:
+                    os.unlink(entry.path)
+        except FileNotFoundError:
+            pass
+        return removed, freed
+
+    def stats(self) -> dict:
+        objects, physical_size, logical_size = 0, 0, 0
+        for entry in self.objects():
+            entry_stat = entry.stat(follow_symlinks=False)
+            objects += 1
+            physical_size += entry_stat.st_size
+            logical_size += entry_stat.st_size * max(entry_stat.st_nlink - 1, 0)
+        return {
+            "objects": objects,
+            "physical_size": physical_size,
+            "logical_size": logical_size,
+            "dedup_ratio": logical_size / physical_size if physical_size else 1.0,
+        }
+
+
+def tree_stats(path: str) -> dict:
+    files, physical_size, logical_size, inodes = 0, 0, 0, set()
+    for root, _, filenames in os.walk(path):
+        for filename in filenames:
+            file_stat = os.lstat(os.path.join(root, filename))
+            if not stat.S_ISREG(file_stat.st_mode):
+                continue
+            files += 1
+            logical_size += file_stat.st_size
+            if (file_stat.st_dev, file_stat.st_ino) not in inodes:
+                inodes.add((file_stat.st_dev, file_stat.st_ino))
+                physical_size += file_stat.st_size
+    return {
+        "files": files,
+        "physical_size": physical_size,
+        "logical_size": logical_size,
+        "dedup_ratio": logical_size / physical_size if physical_size else 1.0,
+    }
@@ -0,0 +1,285 @@
+import io
+import os
+import json
+import time
+import uuid
+import shutil
+import threading
+from contextlib import ExitStack
+from concurrent.futures import Future
+from typing import Callable, ContextManager, Iterator, Optional
+
+from deploykit_server.archive import ArchiveError
+from deploykit_server.config import ProjectPath
+from deploykit_server.links import FileLock
+from deploykit_server.store import new_hash
+
+
+def generate_upload_id() -> str:
+    return uuid.uuid4().hex
+
+
+class UploadSession:
+    def __init__(self, project_path: ProjectPath, upload_id: str):
+        self.upload_id = upload_id
+
+        # {root}/{project_name}/uploads/{upload_id}/
+        self.path = project_path.upload(upload_id)
+
+        # {root}/{project_name}/uploads/{upload_id}/chunks/{index:08d}-{checksum}
+        self.chunks_path = os.path.join(self.path, "chunks")
+
+        # {root}/{project_name}/uploads/{upload_id}/session.json
+        self.session_file = os.path.join(self.path, "session.json")
+
+        # {root}/{project_name}/uploads/{upload_id}/finalize.json
+        self.finalize_file = os.path.join(self.path, "finalize.json")
+
+        # {root}/{project_name}/uploads/{upload_id}/result.json
+        self.result_file = os.path.join(self.path, "result.json")
+
+        # {root}/{project_name}/uploads/{upload_id}/.lock
+        self.lock_file = os.path.join(self.path, ".lock")
+
+    def create(self, deployment_id: str, commit_hash: Optional[str], chunk_size: int,
+               dictionary_id: Optional[int] = None, sidecars: bool = False, level: Optional[int] = None,
+               long_distance: bool = False) -> dict:
+        os.makedirs(self.chunks_path)
+        # The compression settings are only recorded for the client, a resumed upload has to compress the same way
+        # for its chunks to match the ones already received
+        metadata = {"upload_id": self.upload_id, "deployment_id": deployment_id, "commit_hash": commit_hash,
+                    "chunk_size": chunk_size, "dictionary_id": dictionary_id, "sidecars": sidecars,
+                    "level": level, "long_distance": long_distance, "created_at": int(time.time())}
+        with open(self.session_file, "w") as f:
+            json.dump(metadata, f)
+        return metadata
+
+    def metadata(self) -> dict:
+        with open(self.session_file) as f:
+            return json.load(f)
+
+    def deadline(self, timeout: int) -> float:
+        # The deadline is counted from creation, sending chunks slowly does not extend it
+        try:
+            created_at = self.metadata()["created_at"]
+        except (OSError, ValueError, KeyError):
+            created_at = os.stat(self.path).st_mtime
+        return created_at + timeout
+
+    def expired(self, timeout: int) -> bool:
+        return time.time() > self.deadline(timeout)
+
+    def lock(self) -> FileLock:
+        # Held by the extraction of the session, so it runs once across workers and expiry never removes
+        # the chunks from under it
+        return FileLock(self.lock_file)
+
+    def write_chunk(self, index: int, data: bytes, checksum: str) -> dict:
+        hasher = new_hash()
+        hasher.update(data)
+        if hasher.hexdigest() != checksum:
+            raise ArchiveError(f"Checksum mismatch for chunk {index}")
+        for previous in self.chunk_files(index):
+            os.unlink(previous)
+        temp_file = os.path.join(self.chunks_path, f".{uuid.uuid4().hex}")
+        with open(temp_file, "wb") as f:
+            f.write(data)
+        os.replace(temp_file, os.path.join(self.chunks_path, f"{index:08d}-{checksum}"))
+        return {"index": index, "checksum": checksum, "size": len(data)}
+
+    def chunk_files(self, index: int) -> list:
+        prefix = f"{index:08d}-"
+        return [os.path.join(self.chunks_path, x) for x in os.listdir(self.chunks_path) if x.startswith(prefix)]
+
+    def chunks(self) -> list:
+        chunks = []
+        for filename in os.listdir(self.chunks_path):
+            if filename.startswith("."):
+                continue
+            index, _, checksum = filename.partition("-")
+            size = os.path.getsize(os.path.join(self.chunks_path, filename))
+            chunks.append({"index": int(index), "checksum": checksum, "size": size})
+        return sorted(chunks, key=lambda x: x["index"])
+
+    def finalize(self, count: int, checksum: Optional[str] = None) -> None:
+        with open(self.finalize_file, "w") as f:
+            json.dump({"chunks": count, "checksum": checksum}, f)
+
+    def total(self) -> Optional[int]:
+        try:
+            with open(self.finalize_file) as f:
+                return json.load(f)["chunks"]
+        except FileNotFoundError:
+            return None
+
+    def checksum(self) -> Optional[str]:
+        try:
+            with open(self.finalize_file) as f:
+                return json.load(f).get("checksum")
+        except FileNotFoundError:
+            return None
+
+    def write_result(self, result: dict) -> None:
+        temp_file = f"{self.result_file}.tmp"
+        with open(temp_file, "w") as f:
+            json.dump(result, f)
+        os.replace(temp_file, self.result_file)
+
+    def result(self) -> Optional[dict]:
+        try:
+            with open(self.result_file) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def remove(self) -> None:
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+class ChunksChangedError(ArchiveError):
+    def __init__(self):
+        super().__init__("Chunks were sent again while they were being extracted")
+
+
+class ChunkReader(io.RawIOBase):
+    # Concatenates the chunks in index order as they arrive. The extraction slot is only held while there is a
+    # chunk to read, an upload waiting on the network holds nothing
+    def __init__(self, session: UploadSession, slot: Callable[[], ContextManager], deadline: float,
+                 condition: threading.Condition, draining: threading.Event):
+        self.session = session
+        self.slot = slot
+        self.deadline = deadline
+        self.condition = condition
+        self.draining = draining
+        self.held = None
+        self.index = 0
+        self.current = None
+        self.consumed = []
+
+    def readable(self) -> bool:
+        return True
+
+    def acquire(self) -> None:
+        if self.held is None:
+            self.held = ExitStack()
+            self.held.enter_context(self.slot())
+
+    def release(self) -> None:
+        if self.held is not None:
+            self.held.close()
+            self.held = None
+
+    def next_chunk(self) -> Optional[io.BufferedReader]:
+        while True:
+            try:
+                files = self.session.chunk_files(self.index)
+            except FileNotFoundError:
+                raise ArchiveError("Upload session was removed")
+            total = self.session.total()
+            if files and (total is None or self.index < total):
+                self.acquire()
+                self.consumed.append(os.path.basename(files[0]).partition("-")[2])
+                self.index += 1
+                return open(files[0], "rb")
+            if total is not None:
+                if self.index >= total:
+                    return None
+                raise ArchiveError(f"Upload session is finalized but chunk {self.index} is missing")
+            if self.draining.is_set():
+                # The chunks stay on disk, finalize extracts them on whichever worker receives it
+                raise ArchiveError("Server is shutting down")
+            if time.time() > self.deadline:
+                raise ArchiveError("Upload session expired")
+            self.release()
+            with self.condition:
+                # Chunks written by other workers are noticed by polling
+                self.condition.wait(timeout=0.5)
+
+    def changed(self) -> bool:
+        received = {x["index"]: x["checksum"] for x in self.session.chunks()}
+        return self.consumed != [received.get(i) for i in range(len(self.consumed))]
+
+    def readinto(self, buffer) -> int:
+        while True:
+            if self.current is None:
+                self.current = self.next_chunk()
+                if self.current is None:
+                    return 0
+            size = self.current.readinto(buffer)
+            if size:
+                return size
+            self.current.close()
+            self.current = None
+
+    def close(self) -> None:
+        if self.current is not None:
+            self.current.close()
+        super().close()
+
+
+class UploadManager:
+    # Each session is extracted on a thread of its own from its first chunk, in whichever worker holds its lock
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.conditions = {}
+        self.futures = {}
+        self.draining = threading.Event()
+
+    def condition(self, upload_id: str) -> threading.Condition:
+        with self.lock:
+            return self.conditions.setdefault(upload_id, threading.Condition())
+
+    def notify(self, upload_id: str) -> None:
+        # Only an extraction of this worker can be waiting, those of other workers poll
+        with self.lock:
+            condition = self.conditions.get(upload_id)
+        if condition is not None:
+            with condition:
+                condition.notify_all()
+
+    def start(self, session: UploadSession, func: Callable[[], dict]) -> Optional[Future]:
+        # Returns None when another worker is extracting the session
+        with self.lock:
+            if session.upload_id in self.futures:
+                return self.futures[session.upload_id]
+            lock = session.lock()
+            try:
+                if not lock.acquire(blocking=False):
+                    return None
+            except FileNotFoundError:
+                return None
+            future = self.futures[session.upload_id] = Future()
+
+        def run():
+            try:
+                future.set_result(func())
+            except BaseException as e:
+                future.set_exception(e)
+            finally:
+                lock.release()
+                with self.lock:
+                    self.futures.pop(session.upload_id, None)
+                    self.conditions.pop(session.upload_id, None)
+
+        threading.Thread(target=run, name=f"deploykit-upload-{session.upload_id[:8]}", daemon=True).start()
+        return future
+
+    def drain(self) -> list:
+        # Extractions still waiting for chunks give up, those with every chunk received run to the end
+        self.draining.set()
+        with self.lock:
+            upload_ids, futures = list(self.conditions), list(self.futures.values())
+        for upload_id in upload_ids:
+            self.notify(upload_id)
+        return futures
+
+
+def expired_sessions(project_path: ProjectPath, timeout: int) -> Iterator[UploadSession]:
+    try:
+        upload_ids = os.listdir(project_path.uploads_path)
+    except FileNotFoundError:
+        return
+    for upload_id in sorted(upload_ids):
+        session = UploadSession(project_path, upload_id)
+        if os.path.isdir(session.path) and session.expired(timeout):
+            yield session
@@ -0,0 +1,93 @@
+import time
+import asyncio
+import threading
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Iterator, Optional
+
+from deploykit_server.links import FileSemaphore
+
+
+class PoolSaturatedError(Exception):
+    def __init__(self, name: str, retry_after: int):
+        self.name = name
+        self.retry_after = retry_after
+        super().__init__(f"Worker pool '{name}' is saturated")
+
+
+class WorkerPool:
+    def __init__(self, name: str, max_workers: int, queue_depth: int, retry_after: int,
+                 semaphore: Optional[FileSemaphore] = None):
+        self.name = name
+        self.max_workers = max_workers
+        self.queue_depth = queue_depth
+        self.retry_after = retry_after
+        # Shared by every worker process, on top of the per-process max_workers
+        self.semaphore = semaphore
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f"deploykit-{name}")
+        # Taken by pool tasks and by streaming extractions that run on their own thread, so both count towards
+        # max_workers
+        self.slots = threading.BoundedSemaphore(max_workers)
+        self.lock = threading.Lock()
+
+        # Only touched from the event loop
+        self.pending = 0
+        self.rejected = 0
+
+        # Touched from worker threads, guarded by self.lock
+        self.running = 0
+        self.completed = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+
+    async def run(self, func: Callable[..., Any], *args: Any) -> Any:
+        if self.pending >= self.max_workers + self.queue_depth:
+            self.rejected += 1
+            raise PoolSaturatedError(self.name, self.retry_after)
+        submitted_at = time.monotonic()
+
+        def task():
+            with self.slot(submitted_at):
+                return func(*args)
+
+        self.pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, task)
+        finally:
+            self.pending -= 1
+
+    @contextmanager
+    def slot(self, submitted_at: Optional[float] = None) -> Iterator[None]:
+        submitted_at = submitted_at or time.monotonic()
+        with self.slots:
+            waited = time.monotonic() - submitted_at
+            with self.lock:
+                self.running += 1
+                self.wait_seconds_total += waited
+                self.wait_seconds_max = max(self.wait_seconds_max, waited)
+            try:
+                with self.semaphore.slot() if self.semaphore is not None else nullcontext():
+                    yield
+            finally:
+                with self.lock:
+                    self.running -= 1
+                    self.completed += 1
+
+    def stats(self) -> dict:
+        with self.lock:
+            running, completed = self.running, self.completed
+            wait_total, wait_max = self.wait_seconds_total, self.wait_seconds_max
+        return {
+            "max_workers": self.max_workers,
+            "queue_depth": self.queue_depth,
+            "running": running,
+            "queued": max(self.pending - running, 0),
+            "completed": completed,
+            "rejected": self.rejected,
+            "wait_seconds_avg": wait_total / completed if completed else 0.0,
+            "wait_seconds_max": wait_max,
+            "global": self.semaphore.stats() if self.semaphore is not None else None,
+        }
+
+    def shutdown(self, wait: bool = True) -> None:
+        self.executor.shutdown(wait=wait)
@@ -0,0 +1,29 @@
+import os
+
+import pytest
+
+# deploykit_server.config refuses to load without an API key
+os.environ.setdefault("API_KEY", "test-api-key")
+
+
+@pytest.fixture
+def app_path(tmp_path, monkeypatch):
+    path = tmp_path / "app"
+    path.mkdir()
+    monkeypatch.setenv("APP_PATH", str(path))
+    return path
+
+
+@pytest.fixture
+def client(app_path):
+    from fastapi.testclient import TestClient
+    from deploykit_server import app
+
+    # Settings, pools and the upload manager are cached per worker, every test starts from a fresh APP_PATH
+    factories = [app.get_settings, app.get_extraction_pool, app.get_filesystem_pool, app.get_upload_manager,
+                 app.get_reclaimer, app.get_keyring]
+    for factory in factories:
+        factory.cache_clear()
+    yield TestClient(app.app, headers={"Authorization": f"APIKey {os.environ['API_KEY']}"})
+    for factory in factories:
+        factory.cache_clear()
@@ -0,0 +1,27 @@
+import io
+import tarfile
+from typing import Optional
+
+import zstandard
+
+
+def member(name: str, type: bytes = tarfile.REGTYPE, linkname: str = "", data: bytes = b"",
+           pax_headers: Optional[dict] = None) -> tuple:
+    info = tarfile.TarInfo(name)
+    info.type, info.linkname = type, linkname
+    info.size = len(data) if type == tarfile.REGTYPE else 0
+    if pax_headers:
+        info.pax_headers = pax_headers
+    return info, data
+
+
+def tar_bytes(members: list) -> bytes:
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w", format=tarfile.PAX_FORMAT) as tar:
+        for info, data in members:
+            tar.addfile(info, io.BytesIO(data) if info.isreg() else None)
+    return buffer.getvalue()
+
+
+def zstd_bytes(members: list) -> bytes:
+    return zstandard.ZstdCompressor().compress(tar_bytes(members))
@@ -0,0 +1,159 @@
+import io
+import os
+import tarfile
+
+import pytest
+
+from deploykit_server import archive, manifest
+from deploykit_server.store import new_hash
+
+from helpers import member, zstd_bytes
+
+
+REDECLARED_SYMLINK = [
+    member("a", tarfile.DIRTYPE),
+    member("a/s", tarfile.SYMTYPE, ".."),
+    member("a/s", tarfile.DIRTYPE),
+    member("a/s/t", tarfile.SYMTYPE, ".."),
+    member("t/evil", data=b"evil"),
+]
+
+
+def digest(data: bytes) -> str:
+    hasher = new_hash()
+    hasher.update(data)
+    return hasher.hexdigest()
+
+
+def written_outside(root) -> list:
+    # Everything below root except the staging directory, the sources of assemble and the sentinel
+    paths = []
+    for directory, _, filenames in os.walk(root):
+        for filename in filenames:
+            path = os.path.relpath(os.path.join(directory, filename), root)
+            if not path.startswith(("stage", "source-")) and path != "sentinel":
+                paths.append(path)
+    assert (root / "sentinel").read_bytes() == b"sentinel"
+    return paths
+
+
+@pytest.fixture
+def stage(tmp_path):
+    (tmp_path / "sentinel").write_bytes(b"sentinel")
+    (tmp_path / "stage").mkdir()
+    return tmp_path / "stage"
+
+
+def extract(stage, members: list) -> archive.ExtractResult:
+    return archive.decompress(io.BytesIO(zstd_bytes(members)), str(stage))
+
+
+def assemble(stage, members: list) -> archive.ExtractResult:
+    # The same members as a delta manifest, with every file's content already on the server
+    sources, entries = {}, []
+    for info, data in members:
+        entry = {"path": info.name, "type": {tarfile.DIRTYPE: "dir", tarfile.SYMTYPE: "symlink"}.get(info.type, "file")}
+        if info.issym():
+            entry["linkname"] = info.linkname
+        if entry["type"] == "file":
+            source = stage.parent / f"source-{len(sources)}"
+            source.write_bytes(data)
+            entry["hash"], entry["size"] = digest(data), len(data)
+            sources[entry["hash"]] = str(source)
+        entries.append(entry)
+    delta_path = stage.parent / "delta"
+    delta_path.mkdir()
+    return manifest.assemble(entries, str(stage), archive.ExtractResult(), str(delta_path), sources, None)
+
+
+@pytest.mark.parametrize("build", [extract, assemble])
+def test_symlink_redeclared_as_directory_stays_inside(stage, build):
+    result = build(stage, REDECLARED_SYMLINK)
+    assert written_outside(stage.parent) == []
+    assert (stage / "t" / "evil").read_bytes() == b"evil"
+    assert result.entries["a/s"]["type"] == "symlink"
+    assert "a/s/t" not in result.entries
+
+
+@pytest.mark.parametrize("build", [extract, assemble])
+def test_nested_redeclared_symlinks_stay_inside(stage, build):
+    members = [member("a", tarfile.DIRTYPE), member("a/b", tarfile.DIRTYPE)]
+    members += [member("a/b/s", tarfile.SYMTYPE, "../.."), member("a/b/s", tarfile.DIRTYPE),
+                member("a/b/s/t", tarfile.SYMTYPE, "../.."), member("a/b/s/t", tarfile.DIRTYPE),
+                member("a/b/s/t/x", tarfile.SYMTYPE, "../.."), member("x/evil", data=b"evil")]
+    build(stage, members)
+    assert written_outside(stage.parent) == []
+
+
+@pytest.mark.parametrize("build", [extract, assemble])
+@pytest.mark.parametrize("name", ["a/../../x", "../x", "/x", "/tmp/x", "a/../x", "..", "."])
+def test_traversal_and_absolute_names_are_skipped(stage, build, name):
+    result = build(stage, [member(name, data=b"evil"), member("ok", data=b"ok")])
+    assert list(result.entries) == ["ok"]
+    assert written_outside(stage.parent) == []
+
+
+@pytest.mark.parametrize("linkname", ["/etc/passwd", "../sentinel", "a/../../sentinel", "s/sentinel", "s"])
+def test_hardlinks_cannot_escape(stage, linkname):
+    members = [member("s", tarfile.SYMTYPE, "."), member("h", tarfile.LNKTYPE, linkname)]
+    result = extract(stage, members)
+    assert "h" not in result.entries
+    assert not os.path.lexists(stage / "h")
+
+
+@pytest.mark.parametrize("build", [extract, assemble])
+def test_symlinks_cannot_point_outside(stage, build):
+    members = [member("a", tarfile.DIRTYPE), member("a/up", tarfile.SYMTYPE, "../.."),
+               member("abs", tarfile.SYMTYPE, "/etc"), member("a/in", tarfile.SYMTYPE, "../abs")]
+    result = build(stage, members)
+    assert sorted(result.entries) == ["a", "a/in"]
+
+
+@pytest.mark.parametrize("build", [extract, assemble])
+def test_files_below_symlinks_are_skipped(stage, build):
+    members = [member("d", tarfile.DIRTYPE), member("link", tarfile.SYMTYPE, "d"), member("link/f", data=b"x"),
+               member("link", data=b"replaced")]
+    result = build(stage, members)
+    assert "link/f" not in result.entries
+    assert os.path.islink(stage / "link")
+    assert not os.path.exists(stage / "d" / "f")
+
+
+def test_limits_reject_oversized_archives(stage):
+    with pytest.raises(archive.ArchiveError, match="more than 2 members"):
+        archive.decompress(io.BytesIO(zstd_bytes([member(f"f{i}", data=b"x") for i in range(3)])), str(stage),
+                           limits=archive.ArchiveLimits(members=2))
+    with pytest.raises(archive.ArchiveError, match="deeper than 2"):
+        archive.decompress(io.BytesIO(zstd_bytes([member("a/b/c", data=b"x")])), str(stage),
+                           limits=archive.ArchiveLimits(depth=2))
+    with pytest.raises(archive.ArchiveError, match="more than 1000 bytes"):
+        archive.decompress(io.BytesIO(zstd_bytes([member("big", data=b"x" * 4096)])), str(stage),
+                           limits=archive.ArchiveLimits(size=1000))
+
+
+def test_file_checksum_mismatch_is_rejected(stage):
+    good = member("a.txt", data=b"hello", pax_headers={archive.CHECKSUM_HEADER: digest(b"hello")})
+    result = extract(stage, [good])
+    assert result.verified_files == 1
+    assert result.entries["a.txt"]["hash"] == digest(b"hello")
+
+    bad = member("b.txt", data=b"hello", pax_headers={archive.CHECKSUM_HEADER: digest(b"other")})
+    with pytest.raises(archive.ArchiveError, match="does not match its checksum"):
+        extract(stage, [bad])
+
+
+def test_upload_checksum(stage):
+    data = zstd_bytes([member("a.txt", data=b"hello")])
+    result = archive.decompress(io.BytesIO(data), str(stage))
+    assert result.checksum == digest(data)
+    assert result.upload_size == len(data)
+    archive.verify_checksum(result, digest(data))
+    archive.verify_checksum(result, None)
+    with pytest.raises(archive.ArchiveError, match="does not match its checksum"):
+        archive.verify_checksum(result, "0" * 64)
+
+
+def test_truncated_upload_is_rejected(stage):
+    data = zstd_bytes([member("a.txt", data=os.urandom(4096))])
+    with pytest.raises(archive.ArchiveError, match="Corrupted archive"):
+        archive.decompress(io.BytesIO(data[:-16]), str(stage))
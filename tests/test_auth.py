@@ -0,0 +1,14 @@
+import hashlib
+
+from deploykit_server.auth import ALL_PROJECTS, Keyring, allows
+
+
+def test_keyring_scopes(tmp_path):
+    keys_file = tmp_path / "keys"
+    keys_file.write_text(f"{hashlib.sha256(b'site-key').hexdigest()} blog,docs  # deploys two sites\n")
+    keyring = Keyring("admin-key", str(keys_file), 0)
+    assert keyring.scopes("admin-key") == frozenset([ALL_PROJECTS])
+    assert keyring.scopes("site-key") == frozenset(["blog", "docs"])
+    assert keyring.scopes("site-kez") is None
+    assert allows(keyring.scopes("site-key"), "blog")
+    assert not allows(keyring.scopes("site-key"), "shop")
@@ -0,0 +1,23 @@
+from deploykit_client import chunked
+
+from test_archive import digest
+
+
+class RecordingSession:
+    def __init__(self):
+        self.requests = []
+
+    def request(self, method: str, path: str, **kwargs) -> dict:
+        self.requests.append((method, path))
+        return {}
+
+
+def test_upload_counts_sent_and_skipped_chunks():
+    session = RecordingSession()
+    upload = chunked.ChunkedUpload(session, "demo", parallel=4)
+    upload.upload_id, upload.chunk_size = "0" * 32, 4
+    data = bytes(range(256)) * 4
+    upload.received = {i: digest(data[i * 4:i * 4 + 4]) for i in range(0, 256, 2)}
+    assert upload.upload([data[:500], data[500:]]) == 256
+    assert (upload.sent_chunks, upload.skipped_chunks) == (128, 128)
+    assert len(session.requests) == 128
@@ -0,0 +1,69 @@
+import os
+import json
+import tarfile
+
+from deploykit_server import manifest
+from deploykit_server.config import ProjectPath
+
+from helpers import member, zstd_bytes
+from test_archive import digest
+
+
+def file_entry(path: str, data: bytes) -> dict:
+    return {"path": path, "type": "file", "hash": digest(data), "size": len(data)}
+
+
+def deploy(client, members: list, delta_manifest: dict = None, checksum: str = None, **params):
+    data = zstd_bytes(members)
+    files = {"upload": ("upload.tar.zst", data, "application/zstd")}
+    if delta_manifest is not None:
+        files["delta_manifest"] = ("manifest.json", json.dumps(delta_manifest), "application/json")
+    return client.post("/projects/demo/deployments", params=params, files=files,
+                       data={"upload_checksum": checksum or digest(data)})
+
+
+def test_delta_upload_reuses_the_base_deployment(client, app_path):
+    response = deploy(client, [member("assets", tarfile.DIRTYPE), member("assets/app.js", data=b"app"),
+                               member("index.html", data=b"index")])
+    assert response.status_code == 200, response.text
+    base_id = response.json()["deployment_id"]
+
+    files = [{"path": "assets", "type": "dir"}, file_entry("assets/app.js", b"app"),
+             file_entry("index.html", b"new index"), file_entry("copy.js", b"app")]
+    response = client.post("/projects/demo/deployments/negotiate", json={"files": files})
+    assert response.json()["base_deployment_id"] == base_id
+    assert response.json()["missing"] == [digest(b"new index")]
+
+    # Only the missing content is uploaded, as a member named after its hash
+    response = deploy(client, [member(digest(b"new index"), data=b"new index")], {"files": files},
+                      base_deployment_id=base_id)
+    assert response.status_code == 200, response.text
+    assert response.json()["deduplicated_files"] == 2
+    project_path = ProjectPath(str(app_path), "demo")
+    base, deployment = project_path.deployment(base_id), project_path.deployment(response.json()["deployment_id"])
+    with open(os.path.join(deployment, "index.html"), "rb") as f:
+        assert f.read() == b"new index"
+    assert os.stat(os.path.join(deployment, "copy.js")).st_ino == os.stat(os.path.join(base, "assets/app.js")).st_ino
+    assert [x["path"] for x in manifest.read_manifest(project_path.manifest(response.json()["deployment_id"]))] == \
+        ["assets", "assets/app.js", "copy.js", "index.html"]
+    assert not os.path.exists(project_path.delta(response.json()["deployment_id"]))
+
+
+def test_delta_upload_rejects_missing_or_misnamed_content(client, app_path):
+    files = [file_entry("index.html", b"index")]
+    response = deploy(client, [], {"files": files})
+    assert response.status_code == 400
+    assert "Missing content" in response.json()["detail"]
+    response = deploy(client, [member("index.html", data=b"index")], {"files": files})
+    assert response.status_code == 400
+    assert "does not match its name" in response.json()["detail"]
+    response = deploy(client, [member(digest(b"index"), data=b"index")], {"files": [{"path": "x", "type": "fifo"}]})
+    assert response.status_code == 400
+    assert os.listdir(ProjectPath(str(app_path), "demo").deployments_path) == []
+
+
+def test_upload_checksum_mismatch_is_rejected(client, app_path):
+    response = deploy(client, [member("index.html", data=b"index")], checksum="0" * 64)
+    assert response.status_code == 400
+    assert "does not match its checksum" in response.json()["detail"]
+    assert os.listdir(ProjectPath(str(app_path), "demo").deployments_path) == []
@@ -0,0 +1,18 @@
+import json
+
+from deploykit_server import manifest
+
+
+def test_diff_manifests():
+    before = [{"path": "a", "type": "file", "hash": "1"}, {"path": "b", "type": "file", "hash": "2"},
+              {"path": "c", "type": "dir"}]
+    after = [{"path": "b", "type": "file", "hash": "3"}, {"path": "c", "type": "dir"},
+             {"path": "d", "type": "symlink", "linkname": "c"}]
+    changes = list(manifest.diff_manifests(iter(before), iter(after)))
+    assert [(x.get("change"), x.get("path")) for x in changes[:-1]] == \
+        [("removed", "a"), ("modified", "b"), ("added", "d")]
+    assert changes[1]["before"]["hash"] == "2" and changes[1]["after"]["hash"] == "3"
+    assert changes[-1] == {"summary": {"added": 1, "removed": 1, "modified": 1, "unchanged": 1}}
+
+    lines = b"".join(manifest.ndjson(changes, lines=2)).decode().splitlines()
+    assert [json.loads(x) for x in lines] == changes
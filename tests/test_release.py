@@ -0,0 +1,48 @@
+import os
+
+import pytest
+
+from deploykit_server import release as release_module
+from deploykit_server.config import ProjectPath
+from deploykit_server.release import ReleaseError, release
+
+DEPLOYMENT_ID = "20260101-000000-abcd-0123456789ab"
+
+
+def make_deployment(app_path, name: str, deployment_id: str) -> ProjectPath:
+    project_path = ProjectPath(str(app_path), name)
+    os.makedirs(project_path.deployment(deployment_id))
+    return project_path
+
+
+def test_release_of_unknown_project_creates_nothing(client, app_path):
+    make_deployment(app_path, "blog", DEPLOYMENT_ID)
+    response = client.post("/releases", json={"deployments": [{"name": "blog", "deployment_id": DEPLOYMENT_ID},
+                                                              {"name": "ghost", "deployment_id": DEPLOYMENT_ID}]})
+    assert response.status_code == 404, response.text
+    assert not os.path.exists(app_path / "ghost")
+    assert not os.path.lexists(ProjectPath(str(app_path), "blog").current_symlink)
+
+
+def test_rollback_continues_past_failed_projects(app_path, monkeypatch):
+    projects = [make_deployment(app_path, name, "new") for name in ("a", "b", "c")]
+    replace, restore = os.replace, release_module.restore
+
+    def failing_replace(source, target):
+        if target == projects[2].current_symlink:
+            raise OSError("disk full")
+        replace(source, target)
+
+    def failing_restore(project_path, previous):
+        if project_path.project_name == "b":
+            raise OSError("read-only")
+        restore(project_path, previous)
+
+    monkeypatch.setattr(os, "replace", failing_replace)
+    monkeypatch.setattr(release_module, "restore", failing_restore)
+    with pytest.raises(ReleaseError) as e:
+        release(str(app_path), [("a", "new"), ("b", "new"), ("c", "new")])
+    assert e.value.rollback_failed == ["b"]
+    # "a" was restored although "b", rolled back before it, failed
+    assert not os.path.lexists(projects[0].current_symlink)
+    assert os.path.lexists(projects[1].current_symlink)
@@ -0,0 +1,67 @@
+import os
+
+import boto3
+import pytest
+from moto import mock_aws
+
+from deploykit_client.s3sync import MULTIPART_CHUNKSIZE, S3Sync, local_etag, local_files, remote_objects
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    for name in ["AWS_ACCESS_KEY_ID", "AWS_SECRET_ACCESS_KEY"]:
+        monkeypatch.setenv(name, "testing")
+    with mock_aws():
+        client = boto3.client("s3", region_name="us-east-1")
+        client.create_bucket(Bucket="site")
+        yield client
+
+
+@pytest.fixture
+def site(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("public/assets")
+    for path, data in [("public/index.html", b"index"), ("public/assets/app.js", b"app"),
+                       ("public/big.bin", os.urandom(MULTIPART_CHUNKSIZE + 1024))]:
+        with open(path, "wb") as f:
+            f.write(data)
+    return tmp_path
+
+
+def sync(s3, delete: bool = False):
+    return S3Sync(s3, "site", "www", concurrency=4).run(local_files(["public"], "www"), delete)
+
+
+def test_unchanged_objects_are_skipped(s3, site):
+    result, _ = sync(s3)
+    assert result.transferred_objects == 3
+    remote = remote_objects(s3, "site", "www")
+    # The big file went up in parts, its ETag is only comparable when computed the same way
+    assert remote["www/public/big.bin"]["etag"].endswith("-2")
+    assert local_etag("public/big.bin", True) == remote["www/public/big.bin"]["etag"]
+    assert local_etag("public/index.html", False) == remote["www/public/index.html"]["etag"]
+
+    result, _ = sync(s3)
+    assert (result.transferred_objects, result.skipped_objects) == (0, 3)
+
+
+def test_changed_and_stale_objects(s3, site):
+    sync(s3)
+    with open("public/index.html", "wb") as f:
+        f.write(b"INDEX")
+    os.unlink("public/assets/app.js")
+
+    result, stale = sync(s3)
+    assert (result.transferred_objects, result.skipped_objects, result.deleted_objects) == (1, 1, 0)
+    assert stale == []
+    result, stale = sync(s3, delete=True)
+    assert (result.transferred_objects, result.deleted_objects) == (0, 1)
+    assert stale == ["www/public/assets/app.js"]
+    assert sorted(remote_objects(s3, "site", "www")) == ["www/public/big.bin", "www/public/index.html"]
+    assert s3.get_object(Bucket="site", Key="www/public/index.html")["Body"].read() == b"INDEX"
+
+
+def test_dry_run_changes_nothing(s3, site):
+    result, _ = S3Sync(s3, "site", "www", dry_run=True).run(local_files(["public"], "www"))
+    assert result.transferred_objects == 3
+    assert remote_objects(s3, "site", "www") == {}
@@ -0,0 +1,61 @@
+import io
+import gzip
+import tarfile
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from deploykit_server import archive
+from deploykit_server.sidecar import SidecarWriter
+
+from helpers import member, zstd_bytes
+
+
+SCRIPT = b"console.log('deploykit');\n" * 200
+
+
+@pytest.fixture
+def executor():
+    with ThreadPoolExecutor(2) as executor:
+        yield executor
+
+
+@pytest.mark.parametrize("order", [1, -1])
+def test_sidecars_never_replace_archive_files(tmp_path, executor, order):
+    members = [member("assets", tarfile.DIRTYPE), member("assets/big.js", data=SCRIPT),
+               member("assets/big.js.gz", data=b"shipped by the site")]
+    members = members[:1] + members[1:][::order]
+    sidecars = SidecarWriter(executor, ["gz", "zst"], 256)
+    archive.decompress(io.BytesIO(zstd_bytes(members)), str(tmp_path), sidecars=sidecars)
+    result = sidecars.wait()
+
+    assert (tmp_path / "assets" / "big.js.gz").read_bytes() == b"shipped by the site"
+    assert (tmp_path / "assets" / "big.js.zst").exists()
+    assert result["skipped"] == {"gz": 1, "zst": 0}
+    assert result["saved_size"]["gz"] == 0
+    assert sorted(x.name for x in (tmp_path / "assets").iterdir()) == ["big.js", "big.js.gz", "big.js.zst"]
+
+
+def test_sidecars_are_generated(tmp_path, executor):
+    sidecars = SidecarWriter(executor, ["gz"], 256)
+    archive.decompress(io.BytesIO(zstd_bytes([member("app.js", data=SCRIPT)])), str(tmp_path), sidecars=sidecars)
+    result = sidecars.wait()
+    assert gzip.decompress((tmp_path / "app.js.gz").read_bytes()) == SCRIPT
+    assert result["files"] == 1 and result["saved_size"]["gz"] > 0
+
+
+def test_reused_sidecars_never_replace_archive_files(tmp_path, executor):
+    source = tmp_path / "base"
+    source.mkdir()
+    (source / "app.js").write_bytes(SCRIPT)
+    (source / "app.js.gz").write_bytes(gzip.compress(SCRIPT))
+    target = tmp_path / "target"
+    target.mkdir()
+    (target / "app.js").write_bytes(SCRIPT)
+    (target / "app.js.gz").write_bytes(b"shipped by the site")
+
+    sidecars = SidecarWriter(executor, ["gz"], 256)
+    sidecars.submit(str(target / "app.js"), len(SCRIPT), str(source / "app.js"))
+    result = sidecars.wait()
+    assert (target / "app.js.gz").read_bytes() == b"shipped by the site"
+    assert result["skipped"]["gz"] == 1
@@ -0,0 +1,35 @@
+import io
+import os
+
+from deploykit_server import store as store_module
+from deploykit_server.store import ObjectStore
+
+from test_archive import digest
+
+
+def test_add_deduplicates(tmp_path):
+    store = ObjectStore(str(tmp_path))
+    first, second = tmp_path / "first", tmp_path / "second"
+    assert store.add(io.BytesIO(b"hello"), str(first), 4) == (digest(b"hello"), 5, False)
+    assert store.add(io.BytesIO(b"hello"), str(second), 4) == (digest(b"hello"), 5, True)
+    assert os.stat(first).st_ino == os.stat(second).st_ino == os.stat(store.object(digest(b"hello"))).st_ino
+    assert os.listdir(store.temp_path) == []
+
+
+def test_garbage_collection_keeps_objects_being_added(tmp_path, monkeypatch):
+    store = ObjectStore(str(tmp_path))
+    replace = os.replace
+
+    def replace_then_collect(source, destination):
+        # A collection running right after the object is published must not see it as unreferenced
+        replace(source, destination)
+        assert store.collect_garbage() == (0, 0)
+
+    monkeypatch.setattr(store_module.os, "replace", replace_then_collect)
+    store.add(io.BytesIO(b"hello"), str(tmp_path / "target"), 4)
+    assert store.exists(digest(b"hello"))
+    assert (tmp_path / "target").read_bytes() == b"hello"
+
+    os.unlink(tmp_path / "target")
+    assert store.collect_garbage() == (1, 5)
+    assert not store.exists(digest(b"hello"))
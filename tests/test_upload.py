@@ -0,0 +1,180 @@
+import os
+import time
+import json
+import threading
+
+import pytest
+
+from deploykit_server import app, retention
+from deploykit_server.archive import ArchiveError
+from deploykit_server.config import ProjectPath
+from deploykit_server.upload import UploadSession, ChunkReader, expired_sessions
+from deploykit_server.worker import WorkerPool
+
+from helpers import member, zstd_bytes
+from test_archive import digest
+
+
+def new_session(app_path, upload_id: str = "0" * 32, age: int = 0) -> UploadSession:
+    session = UploadSession(ProjectPath(str(app_path), "demo"), upload_id)
+    session.create("20240101000000-abcdef", None, 4)
+    if age:
+        metadata = dict(session.metadata(), created_at=int(time.time()) - age)
+        with open(session.session_file, "w") as f:
+            json.dump(metadata, f)
+    return session
+
+
+def split(data: bytes, size: int) -> list:
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+def test_session_expires_from_creation(app_path):
+    fresh, stale = new_session(app_path, "1" * 32), new_session(app_path, "2" * 32, age=120)
+    fresh.write_chunk(0, b"data", digest(b"data"))
+    assert not fresh.expired(60)
+    assert stale.expired(60)
+    assert [x.upload_id for x in expired_sessions(ProjectPath(str(app_path), "demo"), 60)] == [stale.upload_id]
+
+
+def test_expired_sessions_are_reaped(app_path):
+    project_path = ProjectPath(str(app_path), "demo")
+    fresh, stale, busy = [new_session(app_path, str(i) * 32, age) for i, age in [(1, 0), (2, 120), (3, 120)]]
+    lock = busy.lock()
+    assert lock.acquire(blocking=False)
+    try:
+        assert retention.expire_uploads(project_path, 60) == 1
+    finally:
+        lock.release()
+    assert os.path.isdir(fresh.path) and os.path.isdir(busy.path)
+    assert not os.path.exists(stale.path)
+    assert os.listdir(project_path.trash_path) == [f"upload-{stale.upload_id}"]
+
+
+def new_reader(session: UploadSession, pool: WorkerPool, deadline: float = None,
+               draining: threading.Event = None) -> ChunkReader:
+    return ChunkReader(session, pool.slot, deadline or time.time() + 60, threading.Condition(),
+                       draining or threading.Event())
+
+
+def test_chunk_reader_holds_a_slot_only_while_reading(app_path):
+    session, pool = new_session(app_path), WorkerPool("extraction", 1, 0, 1)
+    session.write_chunk(0, b"abcd", digest(b"abcd"))
+    reader, data = new_reader(session, pool), []
+    thread = threading.Thread(target=lambda: data.append(reader.read()))
+    thread.start()
+    # The first chunk is read, then the reader waits for the second one without holding the slot
+    time.sleep(0.2)
+    assert thread.is_alive()
+    assert pool.stats()["running"] == 0
+    session.write_chunk(1, b"efgh", digest(b"efgh"))
+    session.finalize(2)
+    thread.join(timeout=5)
+    assert data == [b"abcdefgh"]
+    assert pool.stats()["running"] == 1
+    reader.release()
+    assert pool.stats()["running"] == 0
+    assert not reader.changed()
+    session.write_chunk(1, b"EFGH", digest(b"EFGH"))
+    assert reader.changed()
+
+
+def test_chunk_reader_stops(app_path):
+    session, pool = new_session(app_path), WorkerPool("extraction", 1, 0, 1)
+    session.write_chunk(0, b"abcd", digest(b"abcd"))
+    session.write_chunk(2, b"ijkl", digest(b"ijkl"))
+    session.finalize(3)
+    with pytest.raises(ArchiveError, match="chunk 1 is missing"):
+        new_reader(session, pool).read()
+
+    session = new_session(app_path, "1" * 32)
+    with pytest.raises(ArchiveError, match="Upload session expired"):
+        new_reader(session, pool, deadline=time.time() - 1).read()
+    draining = threading.Event()
+    draining.set()
+    with pytest.raises(ArchiveError, match="Server is shutting down"):
+        new_reader(session, pool, draining=draining).read()
+    session.remove()
+    with pytest.raises(ArchiveError, match="Upload session was removed"):
+        new_reader(session, pool).read()
+
+
+def create(client, **params) -> dict:
+    response = client.post("/projects/demo/uploads", params={"chunk_size": 64, **params})
+    assert response.status_code == 200, response.text
+    return response.json()
+
+
+def put(client, upload_id: str, index: int, data: bytes):
+    return client.put(f"/projects/demo/uploads/{upload_id}/chunks/{index}", content=data,
+                      params={"checksum": digest(data)})
+
+
+def test_chunked_upload_resumes_and_finalizes(client, app_path):
+    data = zstd_bytes([member(f"f{i}.txt", data=os.urandom(64)) for i in range(4)])
+    chunks = split(data, 64)
+    upload = create(client, commit_hash="a" * 40, level=3, long_distance="true")
+    for index in range(0, len(chunks), 2):
+        assert put(client, upload["upload_id"], index, chunks[index]).status_code == 200
+
+    # Extraction started with the first chunk and waits for the second one without holding a slot
+    assert upload["upload_id"] in app.get_upload_manager().futures
+    assert app.get_extraction_pool().stats()["running"] == 0
+
+    # An interrupted client asks which chunks arrived and sends the rest
+    response = client.post(f"/projects/demo/uploads/{upload['upload_id']}/finalize",
+                           params={"chunks": len(chunks)})
+    assert response.status_code == 409
+    assert response.json()["missing"] == list(range(1, len(chunks), 2))
+    upload_session = client.get(f"/projects/demo/uploads/{upload['upload_id']}").json()
+    assert (upload_session["level"], upload_session["long_distance"], upload_session["dictionary_id"]) == (3, True, None)
+    received = upload_session["chunks"]
+    for index in sorted(set(range(len(chunks))) - {x["index"] for x in received}):
+        assert put(client, upload["upload_id"], index, chunks[index]).status_code == 200
+
+    response = client.post(f"/projects/demo/uploads/{upload['upload_id']}/finalize",
+                           params={"chunks": len(chunks), "checksum": digest(data)})
+    assert response.status_code == 200, response.text
+    assert response.json()["deployment_id"] == upload["deployment_id"]
+    assert response.json()["files"] == 4
+    project_path = ProjectPath(str(app_path), "demo")
+    assert os.path.isdir(project_path.deployment(upload["deployment_id"]))
+    assert not os.path.exists(project_path.upload(upload["upload_id"]))
+    assert client.get(f"/projects/demo/uploads/{upload['upload_id']}").status_code == 404
+
+
+def test_chunked_upload_checksum_mismatch_is_rejected(client, app_path):
+    data = zstd_bytes([member("a.txt", data=b"hello")])
+    upload = create(client)
+    assert put(client, upload["upload_id"], 0, data).status_code == 200
+    response = client.post(f"/projects/demo/uploads/{upload['upload_id']}/finalize",
+                           params={"chunks": 1, "checksum": "0" * 64})
+    assert response.status_code == 400
+    assert not os.path.exists(ProjectPath(str(app_path), "demo").deployment(upload["deployment_id"]))
+
+    response = client.put(f"/projects/demo/uploads/{upload['upload_id']}/chunks/0", content=data,
+                          params={"checksum": "0" * 64})
+    assert response.status_code == 400
+
+
+def test_oversized_chunk_is_rejected(client, monkeypatch):
+    monkeypatch.setenv("MAX_UPLOAD_CHUNK_SIZE", "1024")
+    upload = create(client)
+    assert put(client, upload["upload_id"], 0, b"x" * 2048).status_code == 413
+
+    # Without a Content-Length the body is read until it crosses the limit
+    def body():
+        for _ in range(4):
+            yield b"x" * 512
+
+    response = client.put(f"/projects/demo/uploads/{upload['upload_id']}/chunks/0", content=body(),
+                          params={"checksum": digest(b"x" * 2048)})
+    assert response.status_code == 413
+    assert client.get(f"/projects/demo/uploads/{upload['upload_id']}").json()["chunks"] == []
+
+
+def test_expired_session_is_gone(client, monkeypatch):
+    monkeypatch.setenv("UPLOAD_SESSION_TIMEOUT", "0")
+    upload = create(client)
+    time.sleep(1.1)
+    assert put(client, upload["upload_id"], 0, b"data").status_code == 410